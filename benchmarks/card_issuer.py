@@ -0,0 +1,66 @@
+'''
+Compares get_credit_card_issuer() with the loop over CARD_TYPES patterns it
+replaced.
+
+Run from the repository root:
+
+    python benchmarks/card_issuer.py [-n NUMBER]
+'''
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa
+django.setup()
+
+from payments.core import CARD_TYPES, get_credit_card_issuer  # noqa
+
+NUMBERS = [
+    '4111111111111111',
+    '5555555555554444',
+    '378282246310005',
+    '6011111111111117',
+    '30569309025904',
+    '3530111333300000',
+    '6759649826438453',
+    '1234567890123456']
+
+
+def match_patterns(number):
+    for regexp, card_type, name in CARD_TYPES:
+        if re.match(regexp, number):
+            return card_type, name
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    for number in NUMBERS:
+        assert match_patterns(number) == get_credit_card_issuer(number)
+
+    print('%d iterations of %d numbers, microseconds per number' % (
+        args.number, len(NUMBERS)))
+    for name, func in [
+            ('patterns', match_patterns),
+            ('ranges', get_credit_card_issuer)]:
+
+        def classify_all():
+            for number in NUMBERS:
+                func(number)
+
+        timing = timeit.timeit(classify_all, number=args.number)
+        print('%-10s %10.2f' % (
+            name, timing / args.number / len(NUMBERS) * 1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Compares validate_card_numbers() with validating the numbers one by one
+like CreditCardNumberField does.
+
+Run from the repository root:
+
+    python benchmarks/card_validation.py [-n NUMBER]
+'''
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa
+django.setup()
+
+from payments.bins import import_numpy  # noqa
+from payments.cards import (  # noqa
+    is_luhn_valid, normalize_card_number, validate_card_numbers)
+from payments.core import get_credit_card_issuer  # noqa
+
+PREFIXES = ['4', '51', '55', '34', '37', '6011', '35', '36', '67', '99']
+
+
+def generate_numbers(count):
+    generator = random.Random(0)
+    numbers = []
+    for i in range(count):
+        prefix = generator.choice(PREFIXES)
+        length = generator.choice([14, 15, 16, 16, 16, 19])
+        number = prefix + ''.join(
+            generator.choice('0123456789')
+            for j in range(length - len(prefix)))
+        if i % 4 == 0:
+            number = ' '.join(
+                number[j:j + 4] for j in range(0, len(number), 4))
+        numbers.append(number)
+    return numbers
+
+
+def validate_one_by_one(numbers):
+    results = []
+    for number in numbers:
+        number = normalize_card_number(number)
+        results.append(
+            (number, is_luhn_valid(number), get_credit_card_issuer(number)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n', '--number', type=int, default=1000000)
+    args = parser.parse_args()
+    try:
+        import_numpy()
+    except ImportError as e:
+        parser.error(str(e))
+
+    numbers = generate_numbers(args.number)
+    print('%d numbers, seconds' % (len(numbers),))
+    started = time.time()
+    validate_one_by_one(numbers)
+    print('%-12s %8.2f' % ('one by one', time.time() - started))
+    started = time.time()
+    validate_card_numbers(numbers)
+    print('%-12s %8.2f' % ('vectorised', time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
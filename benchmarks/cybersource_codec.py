@@ -0,0 +1,77 @@
+'''
+Compares the suds and the template codecs of the CyberSource provider.
+
+Run from the repository root:
+
+    python benchmarks/cybersource_codec.py [-n NUMBER]
+'''
+from __future__ import print_function, unicode_literals
+import argparse
+from datetime import date
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa
+django.setup()
+
+from suds.client import SoapClient  # noqa
+
+from payments.cybersource import CyberSourceProvider  # noqa
+from payments.cybersource.test_cybersource import Payment, REPLY  # noqa
+
+CARD_DATA = {
+    'name': 'John Doe',
+    'number': '4111111111111111',
+    'expiration': date(2030, 5, 1),
+    'cvv2': '123'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    payment = Payment()
+    payment.attrs.merchant_defined_data = {'1': 'foo', '2': 'bar'}
+    reply = REPLY.encode('utf-8')
+
+    suds_provider = CyberSourceProvider(merchant_id='abcd', password='1234')
+    client = suds_provider.client
+    client.set_options(nosend=True)
+    soap_client = SoapClient(client, client.service.runTransaction.method)
+
+    def suds_encode():
+        params = suds_provider._prepare_sale(payment, CARD_DATA)
+        return client.service.runTransaction(**params).envelope
+
+    def suds_decode():
+        return suds_provider._serialize_response(
+            soap_client.process_reply(reply))
+
+    provider = CyberSourceProvider(
+        merchant_id='abcd', password='1234', codec='template')
+
+    def template_encode():
+        params = provider._prepare_sale(payment, CARD_DATA)
+        return provider.codec.encode(params, 'abcd', '1234')
+
+    def template_decode():
+        return provider.codec.decode(reply)
+
+    print('%d iterations, microseconds per call' % (args.number,))
+    print('%-10s %10s %10s' % ('', 'encode', 'decode'))
+    for name, encode, decode in [
+            ('suds', suds_encode, suds_decode),
+            ('template', template_encode, template_decode)]:
+        timings = [
+            timeit.timeit(func, number=args.number) / args.number * 1000000
+            for func in (encode, decode)]
+        print('%-10s %10.1f %10.1f' % (name, timings[0], timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,8 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import pgettext_lazy
 
+default_app_config = 'payments.apps.PaymentsConfig'
+
 PurchasedItem = namedtuple('PurchasedItem',
                            'name, quantity, price, currency, sku')
 
@@ -30,6 +32,27 @@ class PaymentStatus:
         (ERROR, pgettext_lazy('payment status', 'Error')),
         (INPUT, pgettext_lazy('payment status', 'Input'))]
 
+    #: Statuses a payment can move to from each status, see
+    #: BasePayment.transition_status(). A failed retry of a payment in ERROR
+    #: moves it to ERROR again with the new message.
+    TRANSITIONS = {
+        WAITING: (INPUT, PREAUTH, CONFIRMED, REJECTED, ERROR),
+        INPUT: (WAITING, PREAUTH, CONFIRMED, REJECTED, ERROR),
+        PREAUTH: (CONFIRMED, REFUNDED, REJECTED, ERROR),
+        CONFIRMED: (REFUNDED,),
+        ERROR: (WAITING, INPUT, PREAUTH, CONFIRMED, REJECTED, ERROR),
+        REJECTED: (),
+        REFUNDED: ()}
+
+    @classmethod
+    def get_sources(cls, status):
+        '''
+        Returns the statuses a payment can move to *status* from
+        '''
+        return sorted(
+            source for source, targets in cls.TRANSITIONS.items()
+            if status in targets)
+
 
 class FraudStatus:
     UNKNOWN = 'unknown'
@@ -44,6 +67,19 @@ class FraudStatus:
         (REVIEW, pgettext_lazy('fraud status', 'Review'))]
 
 
+class CallbackStatus:
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+
+    CHOICES = [
+        (PENDING, pgettext_lazy('callback status', 'Pending')),
+        (PROCESSING, pgettext_lazy('callback status', 'Processing')),
+        (PROCESSED, pgettext_lazy('callback status', 'Processed')),
+        (FAILED, pgettext_lazy('callback status', 'Failed'))]
+
+
 class RedirectNeeded(Exception):
     pass
 
@@ -60,19 +96,38 @@ class ExternalPostNeeded(Exception):
     pass
 
 
-def get_payment_model():
-    '''
-    Return the Payment model that is active in this project
-    '''
+def _get_model(setting_name):
+    value = getattr(settings, setting_name, None)
     try:
-        app_label, model_name = settings.PAYMENT_MODEL.split('.')
+        app_label, model_name = value.split('.')
     except (ValueError, AttributeError):
-        raise ImproperlyConfigured('PAYMENT_MODEL must be of the form '
-                                   '"app_label.model_name"')
-    payment_model = get_model(app_label, model_name)
-    if payment_model is None:
+        raise ImproperlyConfigured('%s must be of the form '
+                                   '"app_label.model_name"' % (setting_name,))
+    model = get_model(app_label, model_name)
+    if model is None:
         msg = (
-            'PAYMENT_MODEL refers to model "%s" that has not been installed' %
-            settings.PAYMENT_MODEL)
+            '%s refers to model "%s" that has not been installed' %
+            (setting_name, value))
         raise ImproperlyConfigured(msg)
-    return payment_model
+    return model
+
+
+def get_payment_model():
+    '''
+    Return the Payment model that is active in this project
+    '''
+    return _get_model('PAYMENT_MODEL')
+
+
+def get_callback_model():
+    '''
+    Return the model storing queued callbacks, see PAYMENT_CALLBACK_MODEL
+    '''
+    return _get_model('PAYMENT_CALLBACK_MODEL')
+
+
+def get_outbox_model():
+    '''
+    Return the model storing status change events, see PAYMENT_OUTBOX_MODEL
+    '''
+    return _get_model('PAYMENT_OUTBOX_MODEL')
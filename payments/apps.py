@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+import logging
+
+from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentsConfig(AppConfig):
+    name = 'payments'
+    verbose_name = 'Payments'
+
+    def ready(self):
+        if getattr(settings, 'PAYMENT_WARM_UP', False):
+            warm_up_providers()
+
+
+def warm_up_providers(variants=None):
+    '''
+    Builds the providers of all variants, or of *variants*, and logs the
+    time each one took. Returns the results of ProviderRegistry.warm_up().
+    '''
+    from .core import registry
+    results = registry.warm_up(variants)
+    for variant, timing, error in results:
+        if error is not None:
+            logger.error('Building the provider of variant %s failed: %s',
+                         variant, error)
+        else:
+            logger.info(
+                'Provider of variant %s ready, import %.1fms, init %.1fms',
+                variant, timing.import_time * 1000, timing.init_time * 1000)
+    return results
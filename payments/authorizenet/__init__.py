@@ -2,7 +2,6 @@ from __future__ import unicode_literals
 
 from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponseForbidden
-import requests
 
 from .forms import PaymentForm
 from .. import PaymentStatus, RedirectNeeded
@@ -55,7 +54,7 @@ class AuthorizeNetProvider(BasicProvider):
 
     def get_payment_response(self, payment, extra_data=None):
         post = self.get_product_data(payment, extra_data)
-        return requests.post(self.endpoint, data=post)
+        return self.session.post(self.endpoint, data=post)
 
     def get_form(self, payment, data=None):
         if payment.status == PaymentStatus.WAITING:
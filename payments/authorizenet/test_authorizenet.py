@@ -44,7 +44,7 @@ class TestAuthorizeNetProvider(TestCase):
             '',
             '1234']
 
-        with patch('requests.post') as mocked_post:
+        with patch('requests.Session.post') as mocked_post:
             post = MagicMock()
             post.text = '|'.join(response_data)
             mocked_post.return_value = post
@@ -68,7 +68,7 @@ class TestAuthorizeNetProvider(TestCase):
             '',
             '1234']
 
-        with patch('requests.post') as mocked_post:
+        with patch('requests.Session.post') as mocked_post:
             post = MagicMock()
             post.ok = False
             post.text = '|'.join(response_data)
@@ -0,0 +1,401 @@
+'''
+Classification of card numbers by their leading digits (BIN/IIN) and
+length, see get_credit_card_issuer().
+'''
+from __future__ import unicode_literals
+from bisect import bisect_right
+import io
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+#: Patterns of the card types known to get_credit_card_issuer(), compiled
+#: into CARD_RANGES
+CARD_TYPES = [
+    (r'^4[0-9]{12}(?:[0-9]{3})?$', 'visa', 'VISA'),
+    (r'^5[1-5][0-9]{14}$', 'mastercard', 'MasterCard'),
+    (r'^6(?:011|5[0-9]{2})[0-9]{12}$', 'discover', 'Discover'),
+    (r'^3[47][0-9]{13}$', 'amex', 'American Express'),
+    (r'^(?:(?:2131|1800|35\d{3})\d{11})$', 'jcb', 'JCB'),
+    (r'^(?:3(?:0[0-5]|[68][0-9])[0-9]{11})$', 'diners', 'Diners Club'),
+    (r'^(?:5[0678]\d\d|6304|6390|67\d\d)\d{8,15}$', 'maestro', 'Maestro')]
+
+DIGITS = '0123456789'
+
+
+class CardPatternParser(object):
+    '''
+    Expands a pattern of CARD_TYPES into (leading digits, lengths of the
+    digits following them) pairs. Digits, classes of digits, non-capturing
+    groups, alternatives and bounded repetitions are supported, as long as
+    the digits following the leading ones can be any digit.
+    '''
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.position = 0
+
+    def parse(self):
+        expansions = self.parse_alternatives()
+        if self.position < len(self.pattern):
+            self.fail()
+        merged = {}
+        for prefix, tails in expansions:
+            if not prefix:
+                self.fail()
+            merged[prefix] = merged.get(prefix, frozenset()) | tails
+        return sorted(merged.items())
+
+    def fail(self):
+        raise ValueError('Unsupported card pattern: %s' % (self.pattern,))
+
+    def peek(self):
+        return self.pattern[self.position:self.position + 1]
+
+    def read(self, count=1):
+        value = self.pattern[self.position:self.position + count]
+        self.position += count
+        return value
+
+    def parse_alternatives(self):
+        expansions = self.parse_sequence()
+        while self.peek() == '|':
+            self.read()
+            expansions += self.parse_sequence()
+        return expansions
+
+    def parse_sequence(self):
+        expansions = [('', frozenset([0]))]
+        while self.peek() and self.peek() not in '|)':
+            if self.peek() in '^$':
+                self.read()
+                continue
+            atom = self.parse_repeat(self.parse_atom())
+            expansions = self.concat(expansions, atom)
+        return expansions
+
+    def parse_atom(self):
+        char = self.read()
+        if char == '(':
+            if self.read(2) != '?:':
+                self.fail()
+            expansions = self.parse_alternatives()
+            if self.read() != ')':
+                self.fail()
+            return expansions
+        if char == '[':
+            digits = set()
+            while self.peek() and self.peek() != ']':
+                first = self.read()
+                if self.peek() == '-':
+                    self.read()
+                    last = self.read()
+                    digits.update(DIGITS[DIGITS.index(first):
+                                         DIGITS.index(last) + 1])
+                else:
+                    digits.add(first)
+            if self.read() != ']' or not digits <= set(DIGITS):
+                self.fail()
+            return self.digit_set(digits)
+        if char == '\\':
+            if self.read() != 'd':
+                self.fail()
+            return self.digit_set(DIGITS)
+        if char and char in DIGITS:
+            return [(char, frozenset([0]))]
+        self.fail()
+
+    def digit_set(self, digits):
+        if set(digits) == set(DIGITS):
+            return [('', frozenset([1]))]
+        return [(digit, frozenset([0])) for digit in sorted(digits)]
+
+    def parse_repeat(self, atom):
+        if self.peek() == '?':
+            self.read()
+            low, high = 0, 1
+        elif self.peek() == '{':
+            self.read()
+            end = self.pattern.find('}', self.position)
+            if end < 0:
+                self.fail()
+            bounds = self.read(end - self.position).split(',')
+            self.read()
+            low, high = int(bounds[0]), int(bounds[-1])
+        else:
+            return atom
+        expansions = []
+        repeated = [('', frozenset([0]))]
+        for count in range(high + 1):
+            if count >= low:
+                expansions += repeated
+            repeated = self.concat(repeated, atom)
+        return expansions
+
+    def concat(self, left, right):
+        expansions = []
+        for prefix, tails in left:
+            for other_prefix, other_tails in right:
+                if other_prefix and tails != frozenset([0]):
+                    # leading digits following any digit
+                    self.fail()
+                expansions.append((prefix + other_prefix, frozenset(
+                    tail + other for tail in tails for other in other_tails)))
+        return expansions
+
+
+def compile_card_types(card_types):
+    '''
+    Returns the ranges of leading digits, as (first, last, lengths,
+    card_type, name), matching the (pattern, card_type, name) entries of
+    *card_types*, see CardPatternParser
+    '''
+    ranges = []
+    for pattern, card_type, name in card_types:
+        prefixes = {}
+        for prefix, tails in CardPatternParser(pattern).parse():
+            lengths = tuple(sorted(len(prefix) + tail for tail in tails))
+            prefixes.setdefault((len(prefix), lengths), []).append(
+                int(prefix))
+        for (digits, lengths), values in sorted(prefixes.items()):
+            values.sort()
+            first = last = values[0]
+            # consecutive prefixes make a single range
+            for value in values[1:] + [None]:
+                if value is not None and value == last + 1:
+                    last = value
+                    continue
+                ranges.append((
+                    '%0*d' % (digits, first), '%0*d' % (digits, last),
+                    lengths, card_type, name))
+                first = last = value
+    return ranges
+
+
+#: Ranges of leading digits of the card types known to
+#: get_credit_card_issuer(), as (first, last, lengths, card_type, name)
+CARD_RANGES = compile_card_types(CARD_TYPES)
+
+
+def import_numpy():
+    '''
+    Imports NumPy for the classification of arrays of numbers, only done
+    when they are first classified so that loading payments does not.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError(
+            'Classifying arrays of card numbers requires NumPy, install '
+            'it with: pip install django-payments[numpy]')
+    return numpy
+
+
+class CardClassifier(object):
+    '''
+    Finds the card type of a number in a table of ranges of its leading
+    digits, the longest matching range with an accepted length wins.
+    Ranges covering the same number of digits must not overlap.
+
+    Ranges of up to max_expanded prefixes are expanded into a dict of
+    prefixes, so most numbers are classified with a few dict lookups. Wider
+    ranges are looked up with a binary search.
+    '''
+    max_expanded = 1000
+
+    def __init__(self, ranges):
+        levels = {}
+        for first, last, lengths, card_type, name in ranges:
+            if (len(first) != len(last) or not first.isdigit() or
+                    not last.isdigit() or int(first) > int(last)):
+                raise ValueError('Invalid card range: %s-%s' % (first, last))
+            levels.setdefault(len(first), []).append(
+                (int(first), int(last), frozenset(lengths), card_type, name))
+        self.prefixes = {}
+        self.levels = []
+        self.entries = []
+        self._arrays = None
+        for digits in sorted(levels, reverse=True):
+            entries = sorted(levels[digits])
+            for previous, entry in zip(entries, entries[1:]):
+                if entry[0] <= previous[1]:
+                    raise ValueError('Overlapping card ranges: %s-%s' % (
+                        entry[0], previous[1]))
+            self.entries.append((digits, entries))
+            table = []
+            for first, last, lengths, card_type, name in entries:
+                if last - first < self.max_expanded:
+                    for prefix in range(first, last + 1):
+                        self.prefixes['%0*d' % (digits, prefix)] = (
+                            lengths, card_type, name)
+                else:
+                    table.append((first, last, lengths, card_type, name))
+            self.levels.append(
+                (digits, [entry[0] for entry in table], table))
+
+    def classify(self, number):
+        '''
+        Returns the card type and issuer name of *number* or (None, None)
+        '''
+        if not number or not number.isdigit():
+            return None, None
+        length = len(number)
+        prefixes = self.prefixes
+        for digits, starts, table in self.levels:
+            entry = prefixes.get(number[:digits])
+            if entry is not None and length in entry[0]:
+                return entry[1], entry[2]
+            if table and digits <= length:
+                prefix = int(number[:digits])
+                index = bisect_right(starts, prefix) - 1
+                if index >= 0:
+                    first, last, lengths, card_type, name = table[index]
+                    if prefix <= last and length in lengths:
+                        return card_type, name
+        return None, None
+
+    def _get_arrays(self, max_length):
+        np = import_numpy()
+        if self._arrays is None or self._arrays[0] < max_length:
+            max_length = max([max_length] + [
+                length for digits, entries in self.entries
+                for entry in entries for length in entry[2]])
+            levels = []
+            for digits, entries in self.entries:
+                accepted = np.zeros((len(entries), max_length + 1), bool)
+                for index, entry in enumerate(entries):
+                    accepted[index, list(entry[2])] = True
+                levels.append((
+                    digits,
+                    np.array([entry[0] for entry in entries], np.int64),
+                    np.array([entry[1] for entry in entries], np.int64),
+                    accepted,
+                    np.array([entry[3] for entry in entries], object),
+                    np.array([entry[4] for entry in entries], object)))
+            self._arrays = (max_length, levels)
+        return self._arrays[1]
+
+    def classify_array(self, digits, lengths):
+        '''
+        Classifies many numbers at once with NumPy. *digits* is a matrix
+        of the digits of the numbers, padded on the right, and *lengths*
+        their lengths; rows of length 0 are skipped. Returns object arrays
+        of the card types and issuer names, None where unknown.
+        '''
+        np = import_numpy()
+        card_types = np.full(len(lengths), None, object)
+        names = np.full(len(lengths), None, object)
+        found = np.zeros(len(lengths), bool)
+        for level, firsts, lasts, accepted, level_types, level_names in (
+                self._get_arrays(digits.shape[1])):
+            if level > digits.shape[1]:
+                continue
+            rows = np.nonzero(~found & (lengths >= level))[0]
+            if not len(rows):
+                continue
+            weights = 10 ** np.arange(level - 1, -1, -1, dtype=np.int64)
+            prefixes = digits[rows, :level].astype(np.int64).dot(weights)
+            index = np.searchsorted(firsts, prefixes, side='right') - 1
+            hit = index >= 0
+            index[~hit] = 0
+            hit &= prefixes <= lasts[index]
+            hit &= accepted[index, lengths[rows]]
+            rows, index = rows[hit], index[hit]
+            card_types[rows] = level_types[index]
+            names[rows] = level_names[index]
+            found[rows] = True
+        return card_types, names
+
+
+def parse_lengths(value):
+    lengths = set()
+    for part in value.split():
+        if '-' in part:
+            low, high = part.split('-', 1)
+            lengths.update(range(int(low), int(high) + 1))
+        else:
+            lengths.add(int(part))
+    return tuple(sorted(lengths))
+
+
+def load_card_ranges(path):
+    '''
+    Reads a table of card ranges from *path*, one
+    ``first,last,lengths,card_type,name`` line per range where lengths is
+    a space separated list of lengths or ``min-max`` spans. Empty lines and
+    lines starting with ``#`` are skipped.
+    '''
+    ranges = []
+    with io.open(path, encoding='utf-8') as table:
+        for line_number, line in enumerate(table, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                first, last, lengths, card_type, name = [
+                    field.strip() for field in line.split(',', 4)]
+                ranges.append(
+                    (first, last, parse_lengths(lengths), card_type, name))
+            except ValueError:
+                raise ValueError('Invalid card range in %s, line %d' % (
+                    path, line_number))
+    return ranges
+
+
+class ChainedClassifier(object):
+    '''
+    Asks each of *classifiers* in turn, the first to know the card wins
+    '''
+    def __init__(self, classifiers):
+        self.classifiers = classifiers
+
+    def classify(self, number):
+        for classifier in self.classifiers:
+            card_type, name = classifier.classify(number)
+            if card_type is not None:
+                return card_type, name
+        return None, None
+
+    def classify_array(self, digits, lengths):
+        np = import_numpy()
+        card_types = names = None
+        for classifier in self.classifiers:
+            found_types, found_names = classifier.classify_array(
+                digits, lengths)
+            if card_types is None:
+                card_types, names = found_types, found_names
+                continue
+            missing = np.equal(card_types, None)
+            card_types[missing] = found_types[missing]
+            names[missing] = found_names[missing]
+        return card_types, names
+
+
+DEFAULT_CLASSIFIER = CardClassifier(CARD_RANGES)
+
+_classifier = None
+
+
+def get_card_classifier():
+    '''
+    Returns the classifier of card numbers. The ranges of the file named by
+    the PAYMENT_CARD_RANGES setting, if any, are looked up before the
+    built-in ones. The classifier is built once and rebuilt when the
+    setting changes.
+    '''
+    global _classifier
+    if _classifier is None:
+        path = getattr(settings, 'PAYMENT_CARD_RANGES', None)
+        if path:
+            _classifier = ChainedClassifier([
+                CardClassifier(load_card_ranges(path)), DEFAULT_CLASSIFIER])
+        else:
+            _classifier = DEFAULT_CLASSIFIER
+    return _classifier
+
+
+@receiver(setting_changed)
+def reset_card_classifier(setting, **kwargs):
+    global _classifier
+    if setting == 'PAYMENT_CARD_RANGES':
+        _classifier = None
@@ -20,9 +20,11 @@ class BraintreeProvider(BasicProvider):
         if not sandbox:
             environment = braintree.Environment.Production
 
-        braintree.Configuration.configure(
+        # a gateway of its own instead of the global configuration, so
+        # variants of different accounts can run in the same process
+        self.gateway = braintree.BraintreeGateway(braintree.Configuration(
             environment, merchant_id=self.merchant_id,
-            public_key=self.public_key, private_key=self.private_key)
+            public_key=self.public_key, private_key=self.private_key))
         super(BraintreeProvider, self).__init__(**kwargs)
         if not self._capture:
             raise ImproperlyConfigured(
@@ -1,7 +1,5 @@
 from __future__ import unicode_literals
 
-import braintree
-
 from ..forms import CreditCardPaymentFormWithName
 from .. import PaymentStatus
 
@@ -14,7 +12,7 @@ class BraintreePaymentForm(CreditCardPaymentFormWithName):
         data = self.cleaned_data
 
         if not self.errors and not self.payment.transaction_id:
-            result = braintree.Transaction.sale({
+            result = self.provider.gateway.transaction.sale({
                 'amount': str(self.payment.total),
                 'billing': self.get_billing_data(),
                 'credit_card': self.get_credit_card_clean_data(),
@@ -59,7 +57,8 @@ class BraintreePaymentForm(CreditCardPaymentFormWithName):
             'last_name': billing["last_name"]}
 
     def save(self):
-        braintree.Transaction.submit_for_settlement(self.transaction_id)
+        self.provider.gateway.transaction.submit_for_settlement(
+            self.transaction_id)
         self.payment.transaction_id = self.transaction_id
         self.payment.captured_amount = self.payment.total
         self.payment.change_status(PaymentStatus.CONFIRMED)
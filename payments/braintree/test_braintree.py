@@ -1,4 +1,5 @@
 from __future__ import unicode_literals
+from datetime import date
 from unittest import TestCase
 try:
     from unittest.mock import patch, MagicMock
@@ -21,6 +22,8 @@ PROCESS_DATA = {
     'expiration_1': '2020',
     'cvv2': '1234'}
 
+FORM_DATA = dict(PROCESS_DATA, expiration_1=str(date.today().year + 1))
+
 
 Payment = create_test_payment()
 
@@ -33,8 +36,8 @@ class TestBraintreeProvider(TestCase):
     def test_provider_redirects_to_success_on_payment_success(self):
         provider = BraintreeProvider(MERCHANT_ID, PUBLIC_KEY, PRIVATE_KEY)
         transaction_id = '12345'
-        with patch('braintree.Transaction'):
-            with patch('braintree.Transaction.sale') as mocked_sale:
+        with patch('braintree.TransactionGateway.submit_for_settlement'):
+            with patch('braintree.TransactionGateway.sale') as mocked_sale:
                 sale = MagicMock()
                 sale.is_success = True
                 sale.transaction.id = transaction_id
@@ -50,8 +53,8 @@ class TestBraintreeProvider(TestCase):
     def test_provider_shows_validation_error_message(self):
         provider = BraintreeProvider(MERCHANT_ID, PUBLIC_KEY, PRIVATE_KEY)
         error_msg = 'error message'
-        with patch('braintree.Transaction'):
-            with patch('braintree.Transaction.sale') as mocked_sale:
+        with patch('braintree.TransactionGateway.submit_for_settlement'):
+            with patch('braintree.TransactionGateway.sale') as mocked_sale:
                 sale = MagicMock()
                 sale.is_success = False
                 sale.message = error_msg
@@ -60,3 +63,17 @@ class TestBraintreeProvider(TestCase):
                 self.assertEqual(form.errors['__all__'][0], error_msg)
         self.assertEqual(self.payment.status, PaymentStatus.ERROR)
         self.assertEqual(self.payment.captured_amount, 0)
+
+    def test_providers_use_their_own_gateway(self):
+        provider = BraintreeProvider(MERCHANT_ID, PUBLIC_KEY, PRIVATE_KEY)
+        other = BraintreeProvider('other', 'efgh5678', '5678efgh')
+        with patch('braintree.TransactionGateway.sale',
+                   autospec=True) as mocked_sale:
+            mocked_sale.return_value.is_success = False
+            mocked_sale.return_value.message = 'error'
+            provider.get_form(self.payment, data=FORM_DATA)
+            other.get_form(Payment(), data=FORM_DATA)
+        configs = [
+            call[0][0].config.merchant_id
+            for call in mocked_sale.call_args_list]
+        self.assertEqual(configs, [MERCHANT_ID, 'other'])
@@ -0,0 +1,553 @@
+'''
+Bulk operations on payments, run in parallel with a concurrency limit for
+each variant and checkpointed so that interrupted runs can be resumed.
+'''
+from __future__ import unicode_literals
+from collections import Counter, OrderedDict
+import io
+import json
+import logging
+import numbers
+import os
+import threading
+import time
+
+from django.db import connections
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from . import PaymentStatus, get_payment_model
+from .core import provider_factory
+
+logger = logging.getLogger(__name__)
+
+#: Number of errors a BulkResult keeps, the others are only counted
+MAX_ERRORS = 100
+
+
+class Checkpoint(object):
+    '''
+    Records the progress of a run in a file, one JSON object per line, so
+    that a resumed run skips the payments already handled. Failed payments
+    are tried again when *retry_failed* is set.
+
+    Payments of a variant must be started in the order of their primary
+    keys. Only the highest key of each variant below which all payments
+    were handled is kept, with the failed payments when they are retried,
+    so memory use does not grow with the number of payments.
+    '''
+    def __init__(self, path, retry_failed=False):
+        self.path = path
+        self.retry_failed = retry_failed
+        self.marks = {}
+        self.failed = set()
+        self._started = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as checkpoint:
+                for line in checkpoint:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interruption
+                        continue
+                    self._update_mark(entry['variant'], entry.get('mark'))
+                    if not retry_failed:
+                        continue
+                    key = (entry['variant'], entry['pk'])
+                    if entry['ok']:
+                        self.failed.discard(key)
+                    else:
+                        self.failed.add(key)
+
+    def __contains__(self, payment):
+        pk = get_checkpoint_key(payment.pk)
+        mark = self.marks.get(payment.variant)
+        if mark is None or pk > mark:
+            return False
+        return (payment.variant, pk) not in self.failed
+
+    def _update_mark(self, variant, mark):
+        if mark is not None and (
+                variant not in self.marks or mark > self.marks[variant]):
+            self.marks[variant] = mark
+
+    def start(self, payment):
+        '''
+        Notes that *payment* is being handled, the high-water mark of its
+        variant does not pass it until it is recorded
+        '''
+        with self._lock:
+            self._started.setdefault(payment.variant, OrderedDict())[
+                get_checkpoint_key(payment.pk)] = False
+
+    def record(self, pk, variant, error=None):
+        pk = get_checkpoint_key(pk)
+        with self._lock:
+            started = self._started.get(variant)
+            if started is not None and pk in started:
+                started[pk] = True
+                # the mark moves past the payments handled in a row
+                while started and next(iter(started.values())):
+                    self._update_mark(variant, started.popitem(last=False)[0])
+            else:
+                self._update_mark(variant, pk)
+            entry = {'pk': pk, 'variant': variant, 'ok': error is None,
+                     'mark': self.marks.get(variant)}
+            if error is not None:
+                entry['error'] = error
+                if self.retry_failed:
+                    self.failed.add((variant, pk))
+            else:
+                self.failed.discard((variant, pk))
+            with io.open(self.path, 'a', encoding='utf-8') as checkpoint:
+                checkpoint.write('%s\n' % (json.dumps(entry),))
+
+
+def get_checkpoint_key(pk):
+    '''
+    Returns *pk* as stored in a checkpoint, integers are kept so that they
+    compare in the order of the database
+    '''
+    return pk if isinstance(pk, numbers.Integral) else str(pk)
+
+
+class BulkResult(object):
+    '''
+    Counts of processed payments per variant and the first *max_errors*
+    errors met
+    '''
+    def __init__(self, max_errors=MAX_ERRORS):
+        self.succeeded = Counter()
+        self.failed = Counter()
+        self.changed = Counter()
+        self.skipped = 0
+        self.errors = []
+        self.max_errors = max_errors
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, payment, error=None, changed=False):
+        with self._lock:
+            if error is None:
+                self.succeeded[payment.variant] += 1
+                if changed:
+                    self.changed[payment.variant] += 1
+            else:
+                self.failed[payment.variant] += 1
+                if len(self.errors) < self.max_errors:
+                    self.errors.append((payment.pk, payment.variant, error))
+
+    def merge(self, other):
+        '''
+        Adds the counts and errors of another result
+        '''
+        with self._lock:
+            self.succeeded.update(other.succeeded)
+            self.failed.update(other.failed)
+            self.changed.update(other.changed)
+            self.skipped += other.skipped
+            self.errors.extend(
+                other.errors[:max(self.max_errors - len(self.errors), 0)])
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def get_summary(self):
+        '''
+        Returns the lines of a summary of the run
+        '''
+        succeeded = sum(self.succeeded.values())
+        failed = sum(self.failed.values())
+        elapsed = self.elapsed
+        lines = ['%d succeeded, %d failed, %d skipped in %.1fs (%.1f/s)' % (
+            succeeded, failed, self.skipped, elapsed,
+            (succeeded + failed) / elapsed if elapsed else 0)]
+        for variant in sorted(set(self.succeeded) | set(self.failed)):
+            line = '  %s: %d succeeded, %d failed' % (
+                variant, self.succeeded[variant], self.failed[variant])
+            if self.changed:
+                line += ', %d changed' % (self.changed[variant],)
+            lines.append(line)
+        for pk, variant, error in self.errors:
+            lines.append('  payment %s (%s): %s' % (pk, variant, error))
+        if failed > len(self.errors):
+            lines.append('  %d more errors' % (failed - len(self.errors),))
+        return lines
+
+
+def format_error(error):
+    return '%s: %s' % (type(error).__name__, error)
+
+
+def _run_operation(operation, payment, result, checkpoint):
+    changed = False
+    try:
+        changed = operation(payment)
+    except Exception as e:
+        logger.warning(
+            'Bulk operation on payment %s failed', payment.pk, exc_info=True)
+        error = format_error(e)
+    else:
+        error = None
+    result.add(payment, error, changed=bool(changed))
+    if checkpoint is not None:
+        checkpoint.record(payment.pk, payment.variant, error)
+
+
+class Workers(object):
+    '''
+    A pool of *size* threads calling *func* with the items put in its queue.
+    Each thread closes its database connections when it exits and calls
+    *notify* whenever it takes an item or exits.
+    '''
+    def __init__(self, size, func, notify):
+        self.size = size
+        self.tasks = queue.Queue()
+        self.closed = False
+        self.running = size
+        self._notify = notify
+        self._lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._work, args=(func,))
+            for i in range(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, func):
+        try:
+            while True:
+                item = self.tasks.get()
+                self._notify()
+                if item is None:
+                    return
+                func(item)
+        finally:
+            connections.close_all()
+            with self._lock:
+                self.running -= 1
+            self._notify()
+
+    @property
+    def full(self):
+        '''
+        Whether twice as many items as threads are waiting
+        '''
+        return self.tasks.qsize() >= 2 * self.size
+
+    @property
+    def idle(self):
+        return self.tasks.empty()
+
+    @property
+    def finished(self):
+        return self.running == 0
+
+    def put(self, item):
+        self.tasks.put(item)
+
+    def close(self, drop=False):
+        '''
+        Lets the threads exit once the queued items are handled, or right
+        after the running ones with *drop*
+        '''
+        if drop:
+            try:
+                while True:
+                    self.tasks.get_nowait()
+            except queue.Empty:
+                pass
+        if not self.closed:
+            self.closed = True
+            for thread in self.threads:
+                self.tasks.put(None)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+class PaymentSource(object):
+    '''
+    An iterator of payments read by run_in_bulk, all of *variant* when given,
+    with the payment read but not queued yet
+    '''
+    def __init__(self, payments, variant=None):
+        self.payments = iter(payments)
+        self.variant = variant
+        self.held = None
+
+
+def run_in_bulk(payments, operation, concurrency=4, variant_concurrency=None,
+                checkpoint=None, max_threads=32):
+    '''
+    Calls *operation* with each of *payments*, using a pool of threads for
+    each variant. A variant runs up to its *variant_concurrency* entry, or
+    *concurrency*, operations at once and all variants together use at most
+    *max_threads* threads. A variant waits for threads to be freed by the
+    others when there are not enough left. An operation fails by raising and
+    returns a true value when it changed the payment.
+
+    *payments* is a dict of iterables of the payments of each variant, or a
+    single iterable of payments of any variant. Each variant of a dict is
+    read on its own, so a slow gateway does not hold up the others, while
+    a single iterable is not read further while the variant of its next
+    payment is busy. Payments are read as the pools make progress, so an
+    iterable is never consumed much ahead of the running operations.
+
+    Payments found in *checkpoint* are skipped and the outcome of the others
+    is recorded in it, the payments of a variant must then come in the
+    order of their primary keys. Returns a BulkResult.
+    '''
+    variant_concurrency = variant_concurrency or {}
+    result = BulkResult()
+    pools = {}
+    started = []
+    progress = threading.Condition()
+
+    def notify():
+        with progress:
+            progress.notify()
+
+    def run(payment):
+        _run_operation(operation, payment, result, checkpoint)
+
+    def get_pool(variant):
+        pool = pools.get(variant)
+        if pool is not None and not pool.closed:
+            return pool
+        if pool is not None and not pool.finished:
+            # a closed pool of the variant is still running
+            return None
+        size = variant_concurrency.get(variant, concurrency)
+        if max_threads is not None:
+            size = min(size, max_threads)
+            used = sum(pool.size for pool in started if not pool.finished)
+            if used + size > max_threads:
+                return None
+        pool = pools[variant] = Workers(size, run, notify)
+        started.append(pool)
+        return pool
+
+    def feed(source):
+        '''
+        Queues payments of *source* until it is exhausted or has to wait,
+        returns whether any was queued
+        '''
+        fed = False
+        while True:
+            payment, source.held = source.held, None
+            if payment is None:
+                try:
+                    payment = next(source.payments)
+                except StopIteration:
+                    sources.remove(source)
+                    if source.variant in pools:
+                        pools[source.variant].close()
+                    return fed
+                if checkpoint is not None and payment in checkpoint:
+                    result.skipped += 1
+                    continue
+            pool = get_pool(payment.variant)
+            if pool is None or pool.full:
+                source.held = payment
+                return fed
+            if checkpoint is not None:
+                checkpoint.start(payment)
+            pool.put(payment)
+            fed = True
+
+    if isinstance(payments, dict):
+        sources = [
+            PaymentSource(variant_payments, variant)
+            for variant, variant_payments in payments.items()]
+    else:
+        sources = [PaymentSource(payments)]
+    try:
+        while sources:
+            fed = False
+            for source in list(sources):
+                fed = feed(source) or fed
+            if fed or not sources:
+                continue
+            waiting = set(
+                source.held.variant for source in sources
+                if source.held is not None and (
+                    source.held.variant not in pools or
+                    pools[source.held.variant].closed))
+            if waiting:
+                # free the threads of idle variants for the waiting ones,
+                # they get a new pool if more of their payments come
+                for variant, pool in pools.items():
+                    if pool.idle and variant not in waiting:
+                        pool.close()
+            with progress:
+                progress.wait(0.05)
+        for pool in started:
+            pool.close()
+        for pool in started:
+            pool.join()
+    except BaseException:
+        # let the running operations finish, drop the queued ones
+        for pool in started:
+            pool.close(drop=True)
+        raise
+    result.finished = time.time()
+    return result
+
+
+def iterate_payments(queryset, batch_size=1000):
+    '''
+    Yields the payments of *queryset* read in batches by iterate_by_pk
+    '''
+    for batch in iterate_by_pk(queryset, batch_size):
+        for payment in batch:
+            yield payment
+
+
+def iterate_by_variant(queryset, batch_size=1000):
+    '''
+    Returns a dict of iterators over the payments of each variant of
+    *queryset*, see iterate_payments, as accepted by run_in_bulk
+    '''
+    variants = sorted(set(
+        queryset.order_by().values_list('variant', flat=True).distinct()))
+    return OrderedDict(
+        (variant, iterate_payments(queryset.filter(variant=variant),
+                                   batch_size))
+        for variant in variants)
+
+
+def iterate_by_pk(queryset, batch_size=1000):
+    '''
+    Yields the objects of *queryset* in lists of *batch_size*, ordered by
+    primary key. Each batch is read by a query starting after the last key
+    of the previous one, so memory use and query cost do not grow with the
+    size of the table.
+    '''
+    queryset = queryset.order_by('pk')
+    batch = list(queryset[:batch_size])
+    while batch:
+        yield batch
+        if len(batch) < batch_size:
+            return
+        batch = list(queryset.filter(pk__gt=batch[-1].pk)[:batch_size])
+
+
+def capture_payment(payment):
+    if not payment.capture():
+        raise ValueError('Nothing was captured')
+
+
+def capture_payments(payments=None, **kwargs):
+    '''
+    Captures pre-authorized payments in bulk, all of them unless a
+    queryset of *payments* is given. Accepts the arguments of run_in_bulk.
+    '''
+    if payments is None:
+        payments = get_payment_model()._default_manager.all()
+    return run_in_bulk(
+        iterate_by_variant(payments.filter(status=PaymentStatus.PREAUTH)),
+        capture_payment, **kwargs)
+
+
+def release_payment(payment):
+    payment.release()
+
+
+def release_stale_payments(max_age=None, variant_max_age=None,
+                           batch_size=1000, **kwargs):
+    '''
+    Releases the pre-authorized payments created more than *max_age* (a
+    timedelta) ago, or their variant's entry of *variant_max_age*. Variants
+    without an age are left alone when *max_age* is None.
+
+    The payments of each variant are read in batches with iterate_by_pk.
+    Accepts the arguments of run_in_bulk.
+    '''
+    variant_max_age = variant_max_age or {}
+    now = timezone.now()
+    preauth = get_payment_model()._default_manager.filter(
+        status=PaymentStatus.PREAUTH)
+    payments = OrderedDict(
+        (variant, iterate_payments(
+            preauth.filter(variant=variant, created__lt=now - age),
+            batch_size))
+        for variant, age in sorted(variant_max_age.items()))
+    if max_age is not None:
+        payments.update(iterate_by_variant(
+            preauth.exclude(variant__in=list(variant_max_age)).filter(
+                created__lt=now - max_age), batch_size))
+    return run_in_bulk(payments, release_payment, **kwargs)
+
+
+def refund_payment(payment):
+    if not payment.refund():
+        raise ValueError('Nothing was refunded')
+
+
+def refund_batch(provider, payments, result, checkpoint=None):
+    '''
+    Refunds the list of *payments* with a single request to their gateway,
+    the outcome is added to *result* and recorded in *checkpoint*.
+    '''
+    if checkpoint is not None:
+        for payment in payments:
+            checkpoint.start(payment)
+    try:
+        errors = provider.refund_payments(payments)
+    except Exception as e:
+        logger.warning('Refund of %d payments failed', len(payments),
+                       exc_info=True)
+        errors = dict((payment.pk, format_error(e)) for payment in payments)
+    for payment in payments:
+        error = errors.get(payment.pk)
+        result.add(payment, error)
+        if checkpoint is not None:
+            checkpoint.record(payment.pk, payment.variant, error)
+
+
+def refund_payments(payments=None, batch_size=1000, checkpoint=None,
+                    **kwargs):
+    '''
+    Refunds the whole captured amount of confirmed payments in bulk, all of
+    them unless a queryset of *payments* is given. Providers with a
+    refund_batch_size refund their payments in batches with a single
+    request each, the others one at a time with run_in_bulk, whose
+    arguments are accepted.
+    '''
+    if payments is None:
+        payments = get_payment_model()._default_manager.all()
+    payments = payments.filter(status=PaymentStatus.CONFIRMED)
+    variants = sorted(set(
+        payments.order_by().values_list('variant', flat=True).distinct()))
+    result = BulkResult()
+    single = OrderedDict()
+    for variant in variants:
+        variant_payments = payments.filter(variant=variant)
+        try:
+            provider = provider_factory(variant)
+        except ValueError:
+            logger.warning('Skipping unknown variant %s', variant)
+            continue
+        if not provider.refund_batch_size:
+            single[variant] = iterate_payments(variant_payments, batch_size)
+            continue
+        for batch in iterate_by_pk(
+                variant_payments, provider.refund_batch_size):
+            if checkpoint is not None:
+                result.skipped += sum(
+                    1 for payment in batch if payment in checkpoint)
+                batch = [
+                    payment for payment in batch
+                    if payment not in checkpoint]
+            if batch:
+                refund_batch(provider, batch, result, checkpoint)
+    if single:
+        result.merge(run_in_bulk(
+            single, refund_payment, checkpoint=checkpoint, **kwargs))
+    result.finished = time.time()
+    return result
@@ -0,0 +1,227 @@
+'''
+Processing of provider callbacks: in a single transaction, in phases
+keeping gateway I/O out of transactions, or queued and processed later by
+a pool of workers.
+'''
+from __future__ import unicode_literals
+from collections import Counter, OrderedDict
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+import logging
+import traceback
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils.timezone import now
+
+from . import CallbackStatus, get_callback_model, get_payment_model
+from .core import provider_factory
+from .dedup import get_callback_deduplicator
+
+logger = logging.getLogger(__name__)
+
+
+def get_callback_mode():
+    '''
+    Returns the PAYMENT_CALLBACK_MODE setting: 'atomic' runs the whole
+    callback in a transaction, 'phased' keeps it closed during gateway I/O
+    for providers supporting it.
+    '''
+    mode = getattr(settings, 'PAYMENT_CALLBACK_MODE', 'atomic')
+    if mode not in ('atomic', 'phased'):
+        raise ValueError('Unknown callback mode: %r' % (mode,))
+    return mode
+
+
+def get_provider(payment):
+    try:
+        return provider_factory(payment.variant)
+    except ValueError:
+        raise Http404('No such payment')
+
+
+def process_phased_callback(request, payment, provider):
+    '''
+    Runs a callback in three phases: validation of the loaded payment,
+    gateway I/O with no transaction open and a short transaction applying
+    the result to the payment re-read with a row lock.
+    '''
+    response = provider.validate_callback(payment, request)
+    if response is not None:
+        return response
+    data = provider.fetch_callback_data(payment, request)
+    with transaction.atomic():
+        payment = type(payment)._default_manager.select_for_update().get(
+            pk=payment.pk)
+        with payment.defer_saves():
+            return provider.apply_callback_data(payment, request, data)
+
+
+def run_callback(request, token, provider=None):
+    '''
+    Calls process_data of an appropriate provider.
+
+    All saves of the payment made by the provider are merged into a single
+    one once it returns. In the phased callback mode the provider's phases
+    are run instead, see process_phased_callback. With
+    PAYMENT_CALLBACK_DEDUPLICATION enabled duplicates of a processed
+    callback get its response right away.
+
+    Raises Http404 if variant does not exist.
+    '''
+    deduplicator = get_callback_deduplicator()
+    if deduplicator is not None:
+        response = deduplicator.get_response(request, token, provider)
+        if response is not None:
+            return response
+    payment, provider, response = _run_callback(request, token, provider)
+    if deduplicator is not None:
+        deduplicator.set_response(request, payment, provider, response)
+    return response
+
+
+def _run_callback(request, token, provider):
+    Payment = get_payment_model()
+    if get_callback_mode() == 'phased':
+        payment = get_object_or_404(Payment, token=token)
+        provider = provider or get_provider(payment)
+        if provider.supports_phased_callbacks:
+            return payment, provider, process_phased_callback(
+                request, payment, provider)
+    with transaction.atomic():
+        payment = get_object_or_404(Payment, token=token)
+        provider = provider or get_provider(payment)
+        with payment.defer_saves():
+            return payment, provider, provider.process_data(payment, request)
+
+
+def is_queue_enabled():
+    '''
+    Returns the PAYMENT_QUEUE_CALLBACKS setting
+    '''
+    return getattr(settings, 'PAYMENT_QUEUE_CALLBACKS', False)
+
+
+def queue_callback(request, payment, provider):
+    '''
+    Stores the callback for process_callbacks and returns the response the
+    provider expects.
+    '''
+    Callback = get_callback_model()
+    Callback.from_request(request, payment.variant, payment.token).save()
+    return provider.get_callback_ack(request)
+
+
+def process_callback(callback):
+    '''
+    Runs a stored callback and records the outcome
+    '''
+    try:
+        provider = provider_factory(callback.variant)
+        response = run_callback(
+            callback.get_request(), callback.token, provider)
+    except Exception:
+        logger.exception('Processing callback %s failed', callback.pk)
+        callback.status = CallbackStatus.FAILED
+        callback.error = traceback.format_exc()
+    else:
+        if response.status_code < 400:
+            callback.status = CallbackStatus.PROCESSED
+        else:
+            callback.status = CallbackStatus.FAILED
+            callback.error = 'Response status %d' % (response.status_code,)
+    callback.processed = now()
+    callback.save(update_fields=['status', 'error', 'processed'])
+    return callback.status
+
+
+def _process_callbacks_in_order(callbacks):
+    try:
+        return [process_callback(callback) for callback in callbacks]
+    finally:
+        connections.close_all()
+
+
+def get_callback_lease():
+    '''
+    Returns the PAYMENT_CALLBACK_LEASE setting: the number of seconds after
+    which a callback left in the processing status, by a run that was
+    killed, is claimed again.
+    '''
+    return getattr(settings, 'PAYMENT_CALLBACK_LEASE', 600)
+
+
+def claim_callbacks(callbacks, expiry=None):
+    '''
+    Moves the *callbacks* to the processing status, each with a conditional
+    UPDATE, and returns the claimed ones by payment token so that
+    overlapping runs never process a callback twice.
+
+    Callbacks are claimed when pending or when their claim is older than
+    *expiry*, by default the callback lease ago. Payments with a callback
+    still being processed by another run are skipped, as are the callbacks
+    of a payment following one claimed by another run, keeping the
+    callbacks of each payment in order.
+    '''
+    Callback = get_callback_model()
+    manager = Callback._default_manager
+    claimed_at = now()
+    if expiry is None:
+        expiry = claimed_at - timedelta(seconds=get_callback_lease())
+    skipped = set(manager.filter(
+        status=CallbackStatus.PROCESSING, claimed__gte=expiry,
+        token__in=set(callback.token for callback in callbacks)).values_list(
+            'token', flat=True))
+    by_payment = OrderedDict()
+    for callback in callbacks:
+        if callback.token in skipped:
+            continue
+        if callback.status == CallbackStatus.PENDING:
+            unclaimed = Q(status=CallbackStatus.PENDING)
+        else:
+            unclaimed = Q(status=CallbackStatus.PROCESSING) & (
+                Q(claimed__lt=expiry) | Q(claimed__isnull=True))
+        claimed = manager.filter(unclaimed, pk=callback.pk).update(
+            status=CallbackStatus.PROCESSING, claimed=claimed_at)
+        if not claimed:
+            skipped.add(callback.token)
+            continue
+        callback.status = CallbackStatus.PROCESSING
+        callback.claimed = claimed_at
+        by_payment.setdefault(callback.token, []).append(callback)
+    return by_payment
+
+
+def process_callbacks(workers=4, limit=100):
+    '''
+    Processes up to *limit* pending callbacks in the order they were
+    received using a pool of *workers* threads. Callbacks of a payment are
+    processed one after another by the same worker. The callbacks are
+    claimed first, see claim_callbacks, so several runs can overlap, and
+    callbacks left processing by a killed run are picked up again once
+    their lease expired.
+
+    Returns the number of callbacks per resulting status.
+    '''
+    Callback = get_callback_model()
+    expiry = now() - timedelta(seconds=get_callback_lease())
+    expired = Q(status=CallbackStatus.PROCESSING) & (
+        Q(claimed__lt=expiry) | Q(claimed__isnull=True))
+    pending = list(Callback._default_manager.filter(
+        Q(status=CallbackStatus.PENDING) | expired).order_by('pk')[:limit])
+    by_payment = claim_callbacks(pending, expiry)
+    counts = Counter()
+    if not by_payment:
+        return counts
+    pool = ThreadPool(min(workers, len(by_payment)))
+    try:
+        for statuses in pool.imap_unordered(
+                _process_callbacks_in_order, by_payment.values()):
+            counts.update(statuses)
+    finally:
+        pool.close()
+        pool.join()
+    return counts
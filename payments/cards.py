@@ -0,0 +1,102 @@
+'''
+Validation of card numbers one at a time and in bulk.
+
+validate_card_numbers() checks the Luhn checksum and finds the issuer of
+many numbers at once, for example when importing stored cards. It is
+vectorised with NumPy when it is installed and falls back to checking the
+numbers one by one otherwise.
+'''
+from __future__ import unicode_literals
+from collections import namedtuple
+import re
+
+from .bins import get_card_classifier, import_numpy
+
+SEPARATORS = re.compile(r'[\s-]+')
+
+#: Outcome of validate_card_numbers(): the normalised numbers, whether their
+#: checksum is valid and their card types and issuer names, None for
+#: unknown cards. Arrays with NumPy, lists without.
+CardValidation = namedtuple(
+    'CardValidation', 'numbers, valid, card_types, names')
+
+
+def normalize_card_number(number):
+    '''
+    Removes the spaces and dashes separating groups of digits
+    '''
+    return SEPARATORS.sub('', number)
+
+
+def is_luhn_valid(number):
+    '''
+    Returns whether *number*, a string of digits, has a valid Luhn checksum
+    '''
+    digits = []
+    even = False
+    if not number.isdigit():
+        return False
+    for digit in reversed(number):
+        digit = ord(digit) - ord('0')
+        if even:
+            digit *= 2
+            if digit >= 10:
+                digit = digit % 10 + digit // 10
+        digits.append(digit)
+        even = not even
+    return sum(digits) % 10 == 0 if digits else False
+
+
+def validate_card_numbers(numbers, chunk_size=100000):
+    '''
+    Normalises *numbers*, checks their checksums and finds their card
+    types, see CardValidation. With NumPy the numbers are processed in
+    vectorised passes over chunks of *chunk_size* numbers, it is imported
+    on the first call.
+    '''
+    try:
+        np = import_numpy()
+    except ImportError:
+        np = None
+    numbers = [
+        number if number.isdigit() else normalize_card_number(number)
+        for number in numbers]
+    classifier = get_card_classifier()
+    if np is None:
+        valid = [is_luhn_valid(number) for number in numbers]
+        issuers = [classifier.classify(number) for number in numbers]
+        return CardValidation(
+            numbers, valid, [issuer[0] for issuer in issuers],
+            [issuer[1] for issuer in issuers])
+    results = [
+        _validate_chunk(numbers[start:start + chunk_size], classifier, np)
+        for start in range(0, len(numbers), chunk_size)]
+    if not results:
+        return CardValidation(
+            np.array([], object), np.array([], bool), np.array([], object),
+            np.array([], object))
+    return CardValidation(
+        np.array(numbers, object),
+        *[np.concatenate(arrays) for arrays in zip(*results)])
+
+
+def _validate_chunk(numbers, classifier, np):
+    width = max(len(number) for number in numbers) or 1
+    # one byte per character, anything but ASCII digits fails the checks
+    characters = np.array(
+        [number.encode('ascii', 'replace') for number in numbers],
+        'S%d' % (width,)).view(np.uint8).reshape(len(numbers), width)
+    padding = characters == 0
+    lengths = width - padding.sum(axis=1)
+    is_digit = (characters >= ord('0')) & (characters <= ord('9'))
+    all_digits = (is_digit | padding).all(axis=1) & (lengths > 0)
+    digits = np.where(is_digit, characters - ord('0'), 0).astype(np.uint8)
+    # double every second digit counting from the rightmost one
+    positions = lengths[:, np.newaxis] - 1 - np.arange(width)
+    doubled = positions % 2 == 1
+    values = np.where(doubled, digits * 2, digits)
+    values = np.where(values > 9, values - 9, values)
+    valid = all_digits & (values.sum(axis=1, dtype=np.int32) % 10 == 0)
+    card_types, names = classifier.classify_array(
+        digits, np.where(all_digits, lengths, 0))
+    return valid, card_types, names
@@ -8,7 +8,6 @@ import time
 
 from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponse, HttpResponseForbidden
-import requests
 
 from ..core import BasicProvider
 from .. import PaymentStatus
@@ -55,7 +54,7 @@ class CoinbaseProvider(BasicProvider):
             'ACCESS_SIGNATURE': signature,
             'ACCESS_NONCE': nonce,
             'Accept': 'application/json'}
-        response = requests.post(
+        response = self.session.post(
             api_url, data=json.dumps(data), headers=headers)
 
         response.raise_for_status()
@@ -69,6 +68,8 @@ class CoinbaseProvider(BasicProvider):
     def get_hidden_fields(self, payment):
         return {}
 
+    supports_queued_callbacks = True
+
     def process_data(self, payment, request):
         try:
             results = json.loads(request.body)
@@ -78,8 +79,7 @@ class CoinbaseProvider(BasicProvider):
         if results['order']['custom'] != self.get_custom_token(payment):
             return HttpResponseForbidden('FAILED')
 
-        if payment.status == PaymentStatus.WAITING:
-            payment.transaction_id = results['order']['transaction']['id']
-            payment.change_status(PaymentStatus.CONFIRMED)
-            payment.save()
+        payment.transition_status(
+            PaymentStatus.CONFIRMED, sources=[PaymentStatus.WAITING],
+            transaction_id=results['order']['transaction']['id'])
         return HttpResponse('OK')
@@ -66,7 +66,7 @@ class TestCoinbaseProvider(TestCase):
         self.assertEqual(type(response), HttpResponseForbidden)
 
     @patch('time.time')
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_provider_returns_checkout_url(self, mocked_post, mocked_time):
         code = '123abc'
         signature = '21d476eff7b2e6cccdfe6deb0c097ba638d5de7e775b303e' \
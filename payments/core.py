@@ -1,5 +1,12 @@
 from __future__ import unicode_literals
-import re
+from collections import namedtuple
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+import hashlib
+import threading
+import time
 try:
     from urllib.parse import urljoin, urlencode
 except ImportError:
@@ -7,6 +14,12 @@ except ImportError:
     from urlparse import urljoin
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .bins import CARD_TYPES, get_card_classifier  # noqa
+from .utils import LocalStore
 
 
 PAYMENT_VARIANTS = {
@@ -21,6 +34,12 @@ if not PAYMENT_HOST:
 
 PAYMENT_USES_SSL = getattr(settings, 'PAYMENT_USES_SSL', not settings.DEBUG)
 
+#: Options of the HTTP connection pool of every provider, overridable per
+#: variant with the ``http_options`` provider argument
+PAYMENT_HTTP_OPTIONS = getattr(settings, 'PAYMENT_HTTP_OPTIONS', {})
+
+_HTTP_SESSION_LOCK = threading.Lock()
+
 
 def get_base_url():
     """
@@ -47,12 +66,33 @@ class BasicProvider(object):
     directly. Use factory instead.
     '''
     _method = 'post'
+    _http_session = None
+    #: attrs keys the provider looks payments up by, nested keys are
+    #: separated with ``__``; see get_indexed_attrs()
+    indexed_attrs = ()
 
     def get_action(self, payment):
         return self.get_return_url(payment)
 
-    def __init__(self, capture=True):
+    def __init__(self, capture=True, http_options=None):
         self._capture = capture
+        self.http_options = dict(PAYMENT_HTTP_OPTIONS, **(http_options or {}))
+
+    @property
+    def session(self):
+        '''
+        Return the keep-alive HTTP session of this provider instance.
+
+        The session (and its connection pool) is created on first use and
+        shared by all requests handled by the provider in this process.
+        '''
+        if self._http_session is None:
+            with _HTTP_SESSION_LOCK:
+                if self._http_session is None:
+                    from .http_session import create_session
+                    self._http_session = create_session(
+                        **getattr(self, 'http_options', {}))
+        return self._http_session
 
     def get_hidden_fields(self, payment):
         '''
@@ -78,6 +118,84 @@ class BasicProvider(object):
         '''
         raise NotImplementedError()
 
+    #: whether process_data is split into validate_callback,
+    #: fetch_callback_data and apply_callback_data, see PAYMENT_CALLBACK_MODE
+    supports_phased_callbacks = False
+
+    def validate_callback(self, payment, request):
+        '''
+        First phase of a phased callback: checks the request without
+        contacting the gateway or writing the payment. Returns a response to
+        send right away or None to continue.
+        '''
+        return None
+
+    def fetch_callback_data(self, payment, request):
+        '''
+        Second phase of a phased callback: talks to the gateway with no
+        database transaction open and returns the data passed to
+        apply_callback_data. Saves made here, such as recording a gateway
+        error, are committed on their own.
+        '''
+        raise NotImplementedError()
+
+    def apply_callback_data(self, payment, request, data):
+        '''
+        Last phase of a phased callback: applies *data* to the payment
+        re-read and locked in a short transaction. Returns the response.
+        '''
+        raise NotImplementedError()
+
+    #: whether callbacks can be stored and processed later, see
+    #: PAYMENT_QUEUE_CALLBACKS
+    supports_queued_callbacks = False
+
+    def get_callback_ack(self, request):
+        '''
+        Returns the response acknowledging a queued callback
+        '''
+        from django.http import HttpResponse
+        return HttpResponse('OK')
+
+    def get_callback_fingerprint(self, request):
+        '''
+        Returns a string identifying the callback for
+        PAYMENT_CALLBACK_DEDUPLICATION, requests with the same fingerprint
+        get the same response. None disables de-duplication of the request.
+
+        The default is a hash of the whole request payload.
+        '''
+        payload = hashlib.sha1()
+        for part in (request.method, request.get_full_path()):
+            payload.update(part.encode('utf-8'))
+            payload.update(b'\n')
+        payload.update(request.body)
+        return payload.hexdigest()
+
+    #: whether the gateway can be asked for the status of payments, see
+    #: payments.sync
+    supports_status_sync = False
+    #: number of payments get_payment_statuses() queries with a single
+    #: request, None when the gateway only answers for one payment at a time
+    status_batch_size = None
+
+    def get_payment_status(self, payment):
+        '''
+        Returns the current status of *payment* at the gateway, None when
+        it is unknown.
+        '''
+        raise NotImplementedError()
+
+    def get_payment_statuses(self, payments):
+        '''
+        Returns a dict of the current status at the gateway of each of
+        *payments* by primary key. Providers with a status_batch_size query
+        them all with a single request.
+        '''
+        return dict(
+            (payment.pk, self.get_payment_status(payment))
+            for payment in payments)
+
     def get_token_from_request(self, payment, request):
         '''
         Return payment token from provider request.
@@ -104,40 +222,209 @@ class BasicProvider(object):
         ''' Refund payment, return amount which was refunded '''
         raise NotImplementedError()
 
+    #: number of payments refund_payments() refunds with a single request,
+    #: None when the gateway refunds one payment at a time
+    refund_batch_size = None
+
+    def refund_payments(self, payments):
+        '''
+        Refunds the whole captured amount of each of *payments* with a
+        single request. Returns a dict of the error of each failed refund by
+        primary key, the other payments are updated like by refund().
+        '''
+        raise NotImplementedError()
 
-PROVIDER_CACHE = {}
 
+#: Time spent importing the module of a provider and building it
+ProviderTiming = namedtuple('ProviderTiming', 'import_time, init_time')
 
-def provider_factory(variant):
+
+def get_variants():
+    return getattr(settings, 'PAYMENT_VARIANTS', PAYMENT_VARIANTS)
+
+
+def resolve_variant(variant):
     '''
-    Return the provider instance based on variant
+    Returns the (handler, config) of *variant* from PAYMENT_VARIANTS or,
+    for other variants, from the PAYMENT_VARIANT_RESOLVER callable. Raises
+    ValueError if it does not exist.
     '''
-    variants = getattr(settings, 'PAYMENT_VARIANTS', PAYMENT_VARIANTS)
-    handler, config = variants.get(variant, (None, None))
+    handler, config = get_variants().get(variant, (None, None))
+    if not handler:
+        resolver = getattr(settings, 'PAYMENT_VARIANT_RESOLVER', None)
+        if resolver:
+            if not callable(resolver):
+                resolver = import_string(resolver)
+            handler, config = resolver(variant) or (None, None)
     if not handler:
         raise ValueError('Payment variant does not exist: %s' %
                          (variant,))
-    if variant not in PROVIDER_CACHE:
-        module_path, class_name = handler.rsplit('.', 1)
-        module = __import__(
-            str(module_path), globals(), locals(), [str(class_name)])
-        class_ = getattr(module, class_name)
-        PROVIDER_CACHE[variant] = class_(**config)
-    return PROVIDER_CACHE[variant]
+    return handler, config
 
 
-CARD_TYPES = [
-    (r'^4[0-9]{12}(?:[0-9]{3})?$', 'visa', 'VISA'),
-    (r'^5[1-5][0-9]{14}$', 'mastercard', 'MasterCard'),
-    (r'^6(?:011|5[0-9]{2})[0-9]{12}$', 'discover', 'Discover'),
-    (r'^3[47][0-9]{13}$', 'amex', 'American Express'),
-    (r'^(?:(?:2131|1800|35\d{3})\d{11})$', 'jcb', 'JCB'),
-    (r'^(?:3(?:0[0-5]|[68][0-9])[0-9]{11})$', 'diners', 'Diners Club'),
-    (r'^(?:5[0678]\d\d|6304|6390|67\d\d)\d{8,15}$', 'maestro', 'Maestro')]
+class ProviderRegistry(object):
+    '''
+    Builds the provider of a variant when it is first used, so the module
+    of a provider, and the gateway SDK it imports, is only loaded for the
+    variants in use.
+
+    Providers are kept in a LocalStore bounded by the ``max_size`` and
+    ``ttl`` of PAYMENT_PROVIDER_CACHE, both unlimited by default. An
+    expired or invalidated provider is built again from the current
+    configuration of its variant. Variants that do not exist are not
+    cached, their names come from unauthenticated callback URLs.
+    '''
+    lock_count = 64
+
+    def __init__(self):
+        self._locks = [threading.Lock() for i in range(self.lock_count)]
+        self.configure()
+
+    def configure(self):
+        options = getattr(settings, 'PAYMENT_PROVIDER_CACHE', {})
+        self.providers = LocalStore(
+            max_size=options.get('max_size'), ttl=options.get('ttl'))
+
+    @property
+    def timings(self):
+        '''
+        The ProviderTiming of each cached provider by variant
+        '''
+        return dict(
+            (variant, timing)
+            for variant, (provider, timing) in self.providers.items())
+
+    def get(self, variant):
+        '''
+        Returns the provider of *variant*, raises ValueError if it does not
+        exist
+        '''
+        return self._get(variant)[0]
+
+    def _get(self, variant):
+        entry = self.providers.get(variant)
+        if entry is not None:
+            return entry
+        # variants are built concurrently unless they share a lock
+        with self._locks[hash(variant) % self.lock_count]:
+            entry = self.providers.get(variant)
+            if entry is None:
+                handler, config = resolve_variant(variant)
+                entry = self._build(handler, config)
+                self.providers.set(variant, entry)
+        return entry
+
+    def _build(self, handler, config):
+        started = time.time()
+        class_ = get_provider_class(handler)
+        imported = time.time()
+        provider = class_(**config)
+        return provider, ProviderTiming(
+            imported - started, time.time() - imported)
+
+    def invalidate(self, variant=None):
+        '''
+        Drops the provider of *variant*, or all of them, for example after
+        its credentials changed
+        '''
+        if variant is None:
+            self.providers.clear()
+        else:
+            self.providers.delete(variant)
+
+    def warm_up(self, variants=None):
+        '''
+        Builds the providers of *variants*, all of PAYMENT_VARIANTS by
+        default, ahead of their first use. Returns a list of (variant,
+        timing, error) tuples, a variant that failed to build has the
+        exception as error.
+        '''
+        if variants is None:
+            variants = sorted(get_variants())
+        results = []
+        for variant in variants:
+            try:
+                provider, timing = self._get(variant)
+            except Exception as e:
+                results.append((variant, None, e))
+            else:
+                results.append((variant, timing, None))
+        return results
+
+
+class ProviderCache(MutableMapping):
+    '''
+    The providers of the variants cached by *registry*, as a dict of
+    providers by variant
+    '''
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __getitem__(self, variant):
+        entry = self.registry.providers.get(variant)
+        if entry is None:
+            raise KeyError(variant)
+        return entry[0]
+
+    def __setitem__(self, variant, provider):
+        self.registry.providers.set(
+            variant, (provider, ProviderTiming(0, 0)))
+
+    def __delitem__(self, variant):
+        if variant not in self:
+            raise KeyError(variant)
+        self.registry.invalidate(variant)
+
+    def __iter__(self):
+        return iter(list(self.registry.timings))
+
+    def __len__(self):
+        return len(self.registry.timings)
+
+
+registry = ProviderRegistry()
+#: The cached providers by variant, see ProviderRegistry
+PROVIDER_CACHE = ProviderCache(registry)
+
+
+@receiver(setting_changed)
+def reset_providers(setting, **kwargs):
+    if setting == 'PAYMENT_PROVIDER_CACHE':
+        registry.configure()
+    elif setting in ('PAYMENT_VARIANTS', 'PAYMENT_VARIANT_RESOLVER'):
+        registry.invalidate()
+
+
+def provider_factory(variant):
+    '''
+    Return the provider instance based on variant
+    '''
+    return registry.get(variant)
+
+
+def get_provider_class(handler):
+    '''
+    Return the provider class from its dotted path
+    '''
+    module_path, class_name = handler.rsplit('.', 1)
+    module = __import__(
+        str(module_path), globals(), locals(), [str(class_name)])
+    return getattr(module, class_name)
+
+
+def get_indexed_attrs():
+    '''
+    Return the attrs keys the providers of all variants look payments up by
+    '''
+    indexed_attrs = set()
+    for handler, config in get_variants().values():
+        indexed_attrs.update(get_provider_class(handler).indexed_attrs)
+    return sorted(indexed_attrs)
 
 
 def get_credit_card_issuer(number):
-    for regexp, card_type, name in CARD_TYPES:
-        if re.match(regexp, number):
-            return card_type, name
-    return None, None
+    '''
+    Returns the card type and issuer name of a card number or (None, None),
+    see bins.get_card_classifier()
+    '''
+    return get_card_classifier().classify(number)
@@ -1,15 +1,20 @@
 from __future__ import unicode_literals
 import datetime
 import os.path
+import threading
 
 from django.core import signing
 from django.shortcuts import redirect
 from django.utils.translation import ugettext as _
+import suds.cache
 import suds.client
+import suds.plugin
+from suds.sax.document import Document
 from suds.sax.element import Element
 from suds.sudsobject import Object
 import suds.wsse
 
+from .codec import SOAP_ACTION, get_codec
 from .forms import PaymentForm
 from .. import (
     ExternalPostNeeded, FraudStatus, PaymentError, PaymentStatus,
@@ -36,42 +41,164 @@ WSDL_PATH_TEST = 'xml/CyberSourceTransaction_1.101.test.wsdl'
 WSDL_PATH = 'xml/CyberSourceTransaction_1.101.wsdl'
 
 
+class DocumentCache(suds.cache.Cache):
+    '''
+    Keeps the parsed WSDL and XSD documents in memory so that they are read
+    and parsed once per process, backed by an on-disk cache (when *location*
+    is set) so that they survive restarts.
+
+    suds builds its definitions and bindings from the documents and keeps
+    the state of the messages being decoded in them, so every client gets
+    copies of the documents to build its own.
+
+    *version* is appended to the cache keys to skip entries written for an
+    older copy of the WSDL.
+    '''
+    def __init__(self, location=None, version=''):
+        self.objects = {}
+        self.version = version
+        if location:
+            self.disk = suds.cache.ObjectCache(location=location, days=0)
+        else:
+            self.disk = suds.cache.NoCache()
+
+    def _get_key(self, id):
+        return '%s-%s' % (id, self.version)
+
+    def get(self, id):
+        key = self._get_key(id)
+        obj = self.objects.get(key)
+        if obj is None:
+            obj = self.disk.get(key)
+            if obj is None:
+                return None
+            self.objects[key] = obj
+        return copy_document(obj)
+
+    def put(self, id, object):
+        key = self._get_key(id)
+        # suds changes the document it gets back while building the
+        # definitions
+        self.objects[key] = copy_document(object)
+        self.disk.put(key, self.objects[key])
+        return object
+
+    def purge(self, id):
+        key = self._get_key(id)
+        self.objects.pop(key, None)
+        self.disk.purge(key)
+
+    def clear(self):
+        self.objects.clear()
+        self.disk.clear()
+
+
+def copy_document(document):
+    return Document(document.root().clone())
+
+
+class SecurityHeaderPlugin(suds.plugin.MessagePlugin):
+    '''
+    Adds the WS-Security header with the merchant's credentials to every
+    outgoing message.
+    '''
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+    def marshalled(self, context):
+        security_header = suds.wsse.Security()
+        security_header.tokens.append(suds.wsse.UsernameToken(
+            username=self.username, password=self.password))
+        context.envelope.getChild('Header').append(security_header.xml())
+
+
+DOCUMENT_CACHES = {}
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_document_cache(wsdl_file, location):
+    key = (wsdl_file, location)
+    if key not in DOCUMENT_CACHES:
+        version = '%d' % (os.path.getmtime(wsdl_file),)
+        DOCUMENT_CACHES[key] = DocumentCache(location, version=version)
+    return DOCUMENT_CACHES[key]
+
+
 class CyberSourceProvider(BasicProvider):
     '''CyberSource payment provider
     '''
 
     fingerprint_url = 'https://h.online-metrix.net/fp/'
+    indexed_attrs = ('xid',)
 
     def __init__(self, *args, **kwargs):
         self.merchant_id = kwargs.pop('merchant_id')
         self.password = kwargs.pop('password')
-        local_path = os.path.dirname(__file__)
+        wsdl_cache_dir = kwargs.pop('wsdl_cache_dir', None)
+        codec = kwargs.pop('codec', 'suds')
+        if codec not in ('suds', 'template'):
+            raise ValueError('Unknown codec: %s' % (codec,))
+        local_path = os.path.abspath(os.path.dirname(__file__))
+        sandbox = kwargs.pop('sandbox', True)
+        wsdl_file = os.path.join(
+            local_path, WSDL_PATH_TEST if sandbox else WSDL_PATH)
         if os.path.sep != '/':
             # ugly hack for urllib and Windows
             local_path = local_path.replace(os.path.sep, '/')
         if not local_path.startswith('/'):
             # windows paths don't start with '/'
             local_path = '/%s' % (local_path,)
-        if kwargs.pop('sandbox', True):
-            wsdl_path = 'file://%s/%s' % (local_path, WSDL_PATH_TEST)
+        if sandbox:
+            self.wsdl_path = 'file://%s/%s' % (local_path, WSDL_PATH_TEST)
             self.endpoint = (
                 'https://ics2wstest.ic3.com/commerce/1.x/transactionProcessor')
         else:
-            wsdl_path = 'file://%s/%s' % (local_path, WSDL_PATH)
+            self.wsdl_path = 'file://%s/%s' % (local_path, WSDL_PATH)
             self.endpoint = (
                 'https://ics2ws.ic3.com/commerce/1.x/transactionProcessor')
-        self.client = suds.client.Client(wsdl_path)
+        self.wsdl_cache = get_document_cache(wsdl_file, wsdl_cache_dir)
+        self._local = threading.local()
+        if codec == 'template':
+            self.codec = get_codec()
+        else:
+            self.codec = None
+            # parse the WSDL (or load it from the cache) right away
+            self._local.client = self._create_client()
         if 'fingerprint_url' in kwargs:
             self.fingerprint_url = kwargs.pop('fingerprint_url')
         self.org_id = kwargs.pop('org_id', None)
-        security_header = suds.wsse.Security()
-        security_token = suds.wsse.UsernameToken(
-            username=self.merchant_id,
-            password=self.password)
-        security_header.tokens.append(security_token)
-        self.client.set_options(soapheaders=[security_header.xml()])
         super(CyberSourceProvider, self).__init__(*args, **kwargs)
 
+    def _create_client(self):
+        plugin = SecurityHeaderPlugin(self.merchant_id, self.password)
+        with _CLIENT_LOCK:
+            return suds.client.Client(
+                self.wsdl_path, cache=self.wsdl_cache, cachingpolicy=0,
+                plugins=[plugin])
+
+    def _create(self, type_name):
+        '''
+        Return an empty request object of the given XSD type.
+        '''
+        if self.codec is not None:
+            return self.codec.create(type_name)
+        return self.client.factory.create('data:%s' % (type_name,))
+
+    @property
+    def client(self):
+        '''
+        Return the suds client of the current thread.
+
+        suds clients are not thread-safe, each thread gets its own one
+        with its own definitions, built from the WSDL documents parsed once
+        per process.
+        '''
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._create_client()
+        return client
+
     def get_form(self, payment, data=None):
         if payment.status == PaymentStatus.WAITING:
             payment.change_status(PaymentStatus.INPUT)
@@ -85,10 +212,12 @@ class CyberSourceProvider(BasicProvider):
 
     def _change_status_to_confirmed(self, payment):
         if self._capture:
-            payment.captured_amount = payment.total
-            payment.change_status(PaymentStatus.CONFIRMED)
+            payment.transition_status(
+                PaymentStatus.CONFIRMED, captured_amount=payment.total)
         else:
-            payment.change_status(PaymentStatus.PREAUTH)
+            payment.transition_status(PaymentStatus.PREAUTH)
+        # the fraud status and the response are saved either way
+        payment.save()
 
     def _set_proper_payment_status_from_reason_code(self, payment, reason_code):
         if reason_code == ACCEPTED:
@@ -127,7 +256,8 @@ class CyberSourceProvider(BasicProvider):
             self._change_status_to_confirmed(payment)
         else:
             error = self._get_error_message(reason_code)
-            payment.change_status(PaymentStatus.ERROR, message=error)
+            payment.transition_status(PaymentStatus.ERROR, message=error)
+            payment.save()
             raise PaymentError(error)
 
     def charge(self, payment, data):
@@ -250,24 +380,38 @@ class CyberSourceProvider(BasicProvider):
         return params
 
     def _make_request(self, payment, params):
-        response = self.client.service.runTransaction(**params)
+        if self.codec is not None:
+            response = self._post_envelope(params)
+        else:
+            response = self.client.service.runTransaction(**params)
         payment.attrs.last_response = self._serialize_response(response)
         return response
 
+    def _post_envelope(self, params):
+        envelope = self.codec.encode(params, self.merchant_id, self.password)
+        response = self.session.post(self.endpoint, data=envelope, headers={
+            'Content-Type': 'text/xml; charset=utf-8',
+            'SOAPAction': SOAP_ACTION})
+        reply = None
+        if response.status_code in (200, 500):
+            # raises codec.Fault on SOAP faults
+            reply = self.codec.decode(response.content)
+        response.raise_for_status()
+        return reply
+
     def _prepare_payer_auth_validation_check(self, payment, card_data,
                                              pa_response):
-        check_service = self.client.factory.create(
-            'data:PayerAuthValidateService')
+        check_service = self._create('PayerAuthValidateService')
         check_service._run = 'true'
         check_service.signedPARes = pa_response
         params = self._get_params_for_new_payment(payment)
         params['payerAuthValidateService'] = check_service
         if payment.attrs.capture:
-            service = self.client.factory.create('data:CCCreditService')
+            service = self._create('CCCreditService')
             service._run = 'true'
             params['ccCreditService'] = service
         else:
-            service = self.client.factory.create('data:CCAuthService')
+            service = self._create('CCAuthService')
             service._run = 'true'
             params['ccAuthService'] = service
         params.update({
@@ -278,10 +422,9 @@ class CyberSourceProvider(BasicProvider):
         return params
 
     def _prepare_sale(self, payment, card_data):
-        service = self.client.factory.create('data:CCCreditService')
+        service = self._create('CCCreditService')
         service._run = 'true'
-        check_service = self.client.factory.create(
-            'data:PayerAuthEnrollService')
+        check_service = self._create('PayerAuthEnrollService')
         check_service._run = 'true'
         params = self._get_params_for_new_payment(payment)
         params.update({
@@ -294,10 +437,9 @@ class CyberSourceProvider(BasicProvider):
         return params
 
     def _prepare_preauth(self, payment, card_data):
-        service = self.client.factory.create('data:CCAuthService')
+        service = self._create('CCAuthService')
         service._run = 'true'
-        check_service = self.client.factory.create(
-            'data:PayerAuthEnrollService')
+        check_service = self._create('PayerAuthEnrollService')
         check_service._run = 'true'
         params = self._get_params_for_new_payment(payment)
         params.update({
@@ -310,7 +452,7 @@ class CyberSourceProvider(BasicProvider):
         return params
 
     def _prepare_capture(self, payment, amount=None):
-        service = self.client.factory.create('data:CCCaptureService')
+        service = self._create('CCCaptureService')
         service._run = 'true'
         service.authRequestID = payment.transaction_id
         params = {
@@ -321,7 +463,7 @@ class CyberSourceProvider(BasicProvider):
         return params
 
     def _prepare_release(self, payment):
-        service = self.client.factory.create('data:CCAuthReversalService')
+        service = self._create('CCAuthReversalService')
         service._run = 'true'
         service.authRequestID = payment.transaction_id
         params = {
@@ -332,7 +474,7 @@ class CyberSourceProvider(BasicProvider):
         return params
 
     def _prepare_refund(self, payment, amount=None):
-        service = self.client.factory.create('data:CCCreditService')
+        service = self._create('CCCreditService')
         service._run = 'true'
         service.captureRequestID = payment.transaction_id
         params = {
@@ -356,7 +498,7 @@ class CyberSourceProvider(BasicProvider):
             return '042'
 
     def _prepare_card_data(self, data):
-        card = self.client.factory.create('data:Card')
+        card = self._create('Card')
         card.fullName = data['name']
         card.accountNumber = data['number']
         card.expirationMonth = data['expiration'].month
@@ -367,7 +509,7 @@ class CyberSourceProvider(BasicProvider):
 
     def _prepare_billing_data(self, payment):
         _billing_address = payment.get_billing_address()
-        billing = self.client.factory.create('data:BillTo')
+        billing = self._create('BillTo')
         billing.firstName = _billing_address["first_name"]
         billing.lastName = _billing_address["last_name"]
         billing.street1 = _billing_address["address_1"]
@@ -383,7 +525,7 @@ class CyberSourceProvider(BasicProvider):
     def _prepare_items(self, payment):
         items = []
         for i, item in enumerate(payment.get_purchased_items()):
-            purchased = self.client.factory.create('data:Item')
+            purchased = self._create('Item')
             purchased._id = i
             purchased.unitPrice = str(item.price)
             purchased.quantity = str(item.quantity)
@@ -398,16 +540,16 @@ class CyberSourceProvider(BasicProvider):
         except KeyError:
             return
         else:
-            data = self.client.factory.create('data:MerchantDefinedData')
+            data = self._create('MerchantDefinedData')
             for i, value in merchant_defined_data.items():
-                field = self.client.factory.create('data:MDDField')
+                field = self._create('MDDField')
                 field._id = int(i)
                 field.value = value
                 data.mddField.append(field)
             return data
 
     def _prepare_totals(self, payment, amount=None):
-        totals = self.client.factory.create('data:PurchaseTotals')
+        totals = self._create('PurchaseTotals')
         totals.currency = payment.currency
         if amount is None:
             totals.grandTotalAmount = str(payment.total)
@@ -421,26 +563,44 @@ class CyberSourceProvider(BasicProvider):
             response = dict(response)
             for k, v in response.items():
                 response[k] = self._serialize_response(v)
+        elif isinstance(response, list):
+            response = [self._serialize_response(v) for v in response]
         return response
 
+    supports_phased_callbacks = True
+
     def process_data(self, payment, request):
+        response = self.validate_callback(payment, request)
+        if response is not None:
+            return response
+        response = self.fetch_callback_data(payment, request)
+        return self.apply_callback_data(payment, request, response)
+
+    def validate_callback(self, payment, request):
         xid = request.POST.get('MD')
         if xid != payment.attrs.xid:
             return redirect(payment.get_failure_url())
         if payment.status in [PaymentStatus.CONFIRMED, PaymentStatus.PREAUTH]:
             return redirect(payment.get_success_url())
-        cc_data = request.GET.get('token')
         try:
-            cc_data = signing.loads(cc_data)
+            signing.loads(request.GET.get('token'))
         except:
             return redirect(payment.get_failure_url())
-        else:
-            expiration = cc_data['expiration']
-            cc_data['expiration'] = datetime.date(
-                expiration['year'], expiration['month'], 1)
+
+    def fetch_callback_data(self, payment, request):
+        cc_data = signing.loads(request.GET.get('token'))
+        expiration = cc_data['expiration']
+        cc_data['expiration'] = datetime.date(
+            expiration['year'], expiration['month'], 1)
         params = self._prepare_payer_auth_validation_check(
             payment, cc_data, request.POST.get('PaRes'))
-        response = self._make_request(payment, params)
+        return self._make_request(payment, params)
+
+    def apply_callback_data(self, payment, request, response):
+        if payment.status in [PaymentStatus.CONFIRMED, PaymentStatus.PREAUTH]:
+            # confirmed by a concurrent callback
+            return redirect(payment.get_success_url())
+        payment.attrs.last_response = self._serialize_response(response)
         payment.transaction_id = response.requestID
         try:
             self._set_proper_payment_status_from_reason_code(
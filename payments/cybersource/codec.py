@@ -0,0 +1,306 @@
+'''
+Template based codec for the CyberSource ``runTransaction`` SOAP call.
+
+The XSD is read once to precompile the tags of every complex type; requests
+are then rendered by string concatenation and replies are parsed straight
+into dicts. Both hold the same documents and values as the suds client.
+'''
+from __future__ import unicode_literals
+import os.path
+import re
+import threading
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from django.utils.encoding import force_text
+
+NS_DATA = 'urn:schemas-cybersource-com:transaction-data-1.101'
+NS_SOAP = 'http://schemas.xmlsoap.org/soap/envelope/'
+NS_WSSE = (
+    'http://docs.oasis-open.org/wss/2004/01/'
+    'oasis-200401-wss-wssecurity-secext-1.0.xsd')
+NS_XSD = 'http://www.w3.org/2001/XMLSchema'
+
+XSD_PATH = os.path.join(
+    os.path.dirname(__file__), 'xml', 'CyberSourceTransaction_1.101.xsd')
+
+SOAP_ACTION = '"runTransaction"'
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="%(soap)s"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    ' xmlns:ns0="%(soap)s" xmlns:ns1="%(data)s">'
+    '<SOAP-ENV:Header>'
+    '<wsse:Security xmlns:wsse="%(wsse)s" mustUnderstand="true">'
+    '<wsse:UsernameToken>'
+    '<wsse:Username>%%(username)s</wsse:Username>'
+    '<wsse:Password>%%(password)s</wsse:Password>'
+    '</wsse:UsernameToken></wsse:Security></SOAP-ENV:Header>'
+    '<ns0:Body><ns1:requestMessage>%%(body)s</ns1:requestMessage></ns0:Body>'
+    '</SOAP-ENV:Envelope>') % {
+        'soap': NS_SOAP, 'data': NS_DATA, 'wsse': NS_WSSE}
+
+# same rules as the suds encoder, existing entities are kept as they are
+_ESCAPES = (
+    (re.compile('&(?!(amp|lt|gt|quot|apos);)'), '&amp;'),
+    (re.compile('<'), '&lt;'), (re.compile('>'), '&gt;'),
+    (re.compile('"'), '&quot;'), (re.compile("'"), '&apos;'))
+_SPECIAL = re.compile('[&<>"\']')
+
+
+def escape(value):
+    value = force_text(value)
+    if _SPECIAL.search(value):
+        for pattern, replacement in _ESCAPES:
+            value = pattern.sub(replacement, value)
+    return value
+
+
+class Fault(Exception):
+    '''
+    A SOAP fault returned by the gateway.
+    '''
+    def __init__(self, code, string, detail=None):
+        super(Fault, self).__init__('%s: %s' % (code, string))
+        self.code = code
+        self.string = string
+        self.detail = detail
+
+
+class Record(object):
+    '''
+    A request object created by the codec, the counterpart of the objects
+    returned by ``client.factory.create()``.
+
+    Attributes starting with an underscore are rendered as XML attributes,
+    ``value`` holds the text of simple content types.
+    '''
+    def __init__(self, type_name, lists=()):
+        self.__dict__['_type'] = type_name
+        for name in lists:
+            self.__dict__[name] = []
+
+    def __repr__(self):
+        return '<Record %s>' % (self._type,)
+
+
+class Reply(dict):
+    '''
+    A decoded reply, items can also be read as attributes.
+    '''
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ComplexType(object):
+    '''
+    The elements and attributes of an XSD complex type.
+    '''
+    def __init__(self, name):
+        self.name = name
+        # (name, type name, many, optional) in schema order
+        self.elements = []
+        # (name, type name, required)
+        self.attributes = []
+        self.simple_content = None
+        self.children = {}
+        self.lists = ()
+
+    def compile(self):
+        self.children = dict(
+            (name, (type_name, many))
+            for name, type_name, many, optional in self.elements)
+        self.lists = tuple(
+            name for name, type_name, many, optional in self.elements
+            if many)
+        self.fields = [
+            (name, '<ns1:%s' % (name,), '</ns1:%s>' % (name,), type_name,
+             many, optional)
+            for name, type_name, many, optional in self.elements]
+        self.attribute_fields = [
+            ('_' + name, ' %s="' % (name,))
+            for name, type_name, required in self.attributes]
+        self.attribute_types = dict(
+            (name, type_name)
+            for name, type_name, required in self.attributes)
+
+
+class Codec(object):
+    '''
+    Renders ``runTransaction`` requests and decodes the replies using the
+    types of the CyberSource XSD.
+    '''
+    request_type = 'RequestMessage'
+    reply_type = 'ReplyMessage'
+
+    def __init__(self, xsd_file=XSD_PATH):
+        self.types = {}
+        self._load(xsd_file)
+
+    def _load(self, xsd_file):
+        tree = ElementTree.parse(xsd_file)
+        simple_types = set()
+        for node in tree.getroot():
+            if node.tag == '{%s}simpleType' % (NS_XSD,):
+                simple_types.add(node.get('name'))
+        for node in tree.getroot():
+            if node.tag != '{%s}complexType' % (NS_XSD,):
+                continue
+            complex_type = ComplexType(node.get('name'))
+            for child in node.iter():
+                if child.tag == '{%s}element' % (NS_XSD,):
+                    complex_type.elements.append((
+                        child.get('name'),
+                        self._resolve(child.get('type'), simple_types),
+                        child.get('maxOccurs', '1') != '1',
+                        child.get('minOccurs', '1') == '0'))
+                elif child.tag == '{%s}attribute' % (NS_XSD,):
+                    complex_type.attributes.append((
+                        child.get('name'),
+                        self._resolve(child.get('type'), simple_types),
+                        child.get('use') == 'required'))
+                elif child.tag == '{%s}extension' % (NS_XSD,):
+                    complex_type.simple_content = self._resolve(
+                        child.get('base'), simple_types)
+            complex_type.compile()
+            self.types[complex_type.name] = complex_type
+
+    def _resolve(self, type_name, simple_types):
+        '''
+        Return the name of a complex type or one of ``'integer'`` and
+        ``'string'`` for the leaf types.
+        '''
+        prefix, name = type_name.split(':')
+        if prefix == 'xsd':
+            return 'integer' if name == 'integer' else 'string'
+        if name in simple_types:
+            return 'string'
+        return name
+
+    def create(self, type_name):
+        '''
+        Return an empty request object of the given type.
+        '''
+        return Record(type_name, lists=self.types[type_name].lists)
+
+    def encode(self, params, username, password):
+        '''
+        Return the envelope of a ``runTransaction`` request as bytes.
+        '''
+        body = []
+        self._encode_fields(self.types[self.request_type], params, body)
+        envelope = ENVELOPE % {
+            'username': escape(username), 'password': escape(password),
+            'body': ''.join(body)}
+        return envelope.encode('utf-8')
+
+    def _encode_fields(self, complex_type, values, out):
+        if not isinstance(values, dict):
+            values = values.__dict__
+        for name, start, end, type_name, many, optional in complex_type.fields:
+            value = values.get(name)
+            if value is None or (many and not value):
+                if not optional:
+                    out.append('%s/>' % (start,))
+                continue
+            if not many:
+                value = (value,)
+            for item in value:
+                self._encode_element(start, end, type_name, item, out)
+
+    def _encode_element(self, start, end, type_name, value, out):
+        complex_type = self.types.get(type_name)
+        if complex_type is None:
+            out.append('%s>%s%s' % (start, escape(value), end))
+            return
+        values = value if isinstance(value, dict) else value.__dict__
+        out.append(start)
+        for name, attribute in complex_type.attribute_fields:
+            attr_value = values.get(name)
+            if attr_value is not None:
+                out.append('%s%s"' % (attribute, escape(attr_value)))
+        if complex_type.simple_content:
+            content = values.get('value')
+            if content is None:
+                out.append('/>')
+            else:
+                out.append('>%s%s' % (escape(content), end))
+            return
+        children = []
+        self._encode_fields(complex_type, values, children)
+        if children:
+            out.append('>')
+            out.extend(children)
+            out.append(end)
+        else:
+            out.append('/>')
+
+    def decode(self, content):
+        '''
+        Return the reply of a ``runTransaction`` response as a Reply.
+
+        Raises Fault if the response holds a SOAP fault.
+        '''
+        root = ElementTree.fromstring(content)
+        body = root.find('{%s}Body' % (NS_SOAP,))
+        if body is None or not len(body):
+            raise ValueError('Not a SOAP response')
+        message = body[0]
+        if message.tag == '{%s}Fault' % (NS_SOAP,):
+            detail = message.find('detail')
+            if detail is not None:
+                detail = self._decode_element(detail, None)
+            raise Fault(
+                message.findtext('faultcode'),
+                message.findtext('faultstring'), detail)
+        return self._decode_element(message, self.reply_type)
+
+    def _decode_element(self, element, type_name):
+        complex_type = self.types.get(type_name)
+        if not len(element) and not element.attrib:
+            text = element.text
+            if not text:
+                # suds decodes empty complex elements as empty strings
+                return '' if complex_type is not None else None
+            if type_name == 'integer':
+                return int(text)
+            return text
+        reply = Reply()
+        for name, value in element.attrib.items():
+            if (complex_type is not None and
+                    complex_type.attribute_types.get(name) == 'integer'):
+                value = int(value)
+            reply['_' + name] = value
+        if complex_type is not None and complex_type.simple_content:
+            reply['value'] = element.text
+            return reply
+        children = complex_type.children if complex_type else {}
+        for child in element:
+            name = child.tag.rpartition('}')[2]
+            child_type, many = children.get(name, (None, False))
+            value = self._decode_element(child, child_type)
+            if many:
+                reply.setdefault(name, []).append(value)
+            else:
+                reply[name] = value
+        return reply
+
+
+CODECS = {}
+_CODEC_LOCK = threading.Lock()
+
+
+def get_codec(xsd_file=XSD_PATH):
+    '''
+    Return the codec of the given XSD, shared by all variants.
+    '''
+    with _CODEC_LOCK:
+        if xsd_file not in CODECS:
+            CODECS[xsd_file] = Codec(xsd_file)
+        return CODECS[xsd_file]
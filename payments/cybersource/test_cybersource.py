@@ -1,15 +1,22 @@
 from __future__ import unicode_literals
+from datetime import date
 from decimal import Decimal
+import threading
 from unittest import TestCase
+from xml.etree import ElementTree
 from django.core import signing
 try:
     from unittest.mock import patch, MagicMock
 except ImportError:
     from mock import patch, MagicMock
 
+from suds.client import SoapClient
+
 from . import CyberSourceProvider, AUTHENTICATE_REQUIRED, ACCEPTED, \
     TRANSACTION_SETTLED
-from .. import PaymentStatus, PurchasedItem, RedirectNeeded
+from .codec import Fault
+from .. import FraudStatus, PaymentError, PaymentStatus, PurchasedItem, \
+    RedirectNeeded
 
 from ..testcommon import create_test_payment
 
@@ -197,3 +204,191 @@ class TestCybersourceProvider(TestCase):
         self.assertEqual(self.payment.status, PaymentStatus.ERROR)
         self.assertEqual(self.payment.captured_amount, 0)
         self.assertEqual(self.payment.transaction_id, transaction_id)
+
+    def test_failed_retry_records_new_error(self):
+        self.payment.status = PaymentStatus.ERROR
+        self.payment.message = 'first error'
+        with patch.object(Payment, 'save') as mocked_save, \
+                patch.object(CyberSourceProvider, '_get_error_message',
+                             return_value='second error'):
+            with self.assertRaises(PaymentError):
+                self.provider._set_proper_payment_status_from_reason_code(
+                    self.payment, 'test code')
+        self.assertEqual(self.payment.status, PaymentStatus.ERROR)
+        self.assertEqual(self.payment.message, 'second error')
+        self.assertTrue(mocked_save.called)
+
+    def test_lost_transition_saves_fraud_status(self):
+        self.payment.status = PaymentStatus.CONFIRMED
+        with patch.object(Payment, 'save') as mocked_save:
+            self.provider._set_proper_payment_status_from_reason_code(
+                self.payment, ACCEPTED)
+        self.assertEqual(self.payment.fraud_status, FraudStatus.ACCEPT)
+        self.assertTrue(mocked_save.called)
+
+
+class TestCybersourceClients(TestCase):
+
+    def setUp(self):
+        self.provider = CyberSourceProvider(
+            merchant_id=MERCHANT_ID, password=PASSWORD)
+
+    def test_threads_get_own_definitions(self):
+        clients = []
+        thread = threading.Thread(
+            target=lambda: clients.append(self.provider.client))
+        thread.start()
+        thread.join()
+        client = self.provider.client
+        self.assertIsNot(clients[0], client)
+        self.assertIsNot(clients[0].wsdl, client.wsdl)
+        self.assertIsNot(clients[0].options, client.options)
+        self.assertIsNot(
+            clients[0].service.runTransaction.method.binding.output.multiref,
+            client.service.runTransaction.method.binding.output.multiref)
+
+    def test_providers_share_parsed_documents(self):
+        self.provider.client
+        with patch('suds.reader.DocumentReader.download') as mocked_download:
+            provider = CyberSourceProvider(
+                merchant_id='other', password=PASSWORD)
+        self.assertFalse(mocked_download.called)
+        self.assertIs(provider.wsdl_cache, self.provider.wsdl_cache)
+        self.assertIsNot(provider.client.wsdl, self.provider.client.wsdl)
+
+    def test_security_header_is_sent(self):
+        client = self.provider.client
+        client.set_options(nosend=True)
+        try:
+            params = self.provider._prepare_release(Payment())
+            request = client.service.runTransaction(**params)
+        finally:
+            client.set_options(nosend=False)
+        envelope = request.envelope.decode('utf-8')
+        self.assertIn('<wsse:Username>%s</wsse:Username>' % MERCHANT_ID,
+                      envelope)
+        self.assertIn('<wsse:Password>%s</wsse:Password>' % PASSWORD,
+                      envelope)
+
+
+REPLY = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+<soap:Header/><soap:Body>
+<c:replyMessage xmlns:c="urn:schemas-cybersource-com:transaction-data-1.101">
+<c:merchantReferenceCode>523</c:merchantReferenceCode>
+<c:requestID>1234</c:requestID>
+<c:decision>ACCEPT</c:decision>
+<c:reasonCode>475</c:reasonCode>
+<c:missingField>billTo_city</c:missingField>
+<c:purchaseTotals><c:currency>USD</c:currency></c:purchaseTotals>
+<c:ccAuthReply><c:reasonCode>100</c:reasonCode><c:amount>10.00</c:amount>
+<c:authorizationCode></c:authorizationCode></c:ccAuthReply>
+<c:taxReply><c:item id="0"><c:totalTaxAmount>1.00</c:totalTaxAmount></c:item>
+</c:taxReply>
+<c:ccCaptureReply/>
+<c:payerAuthEnrollReply><c:reasonCode>475</c:reasonCode>
+<c:acsURL>https://example.com/?a=1&amp;b=2</c:acsURL>
+<c:paReq>pareq</c:paReq><c:xid>abc</c:xid></c:payerAuthEnrollReply>
+</c:replyMessage></soap:Body></soap:Envelope>'''
+
+FAULT = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+<soap:Body><soap:Fault><faultcode>wsse:FailedCheck</faultcode>
+<faultstring>Security Data : UsernameToken authentication failed.</faultstring>
+</soap:Fault></soap:Body></soap:Envelope>'''
+
+CARD_DATA = {
+    'name': 'John Doe',
+    'number': '371449635398431',
+    'expiration': date(2030, 5, 1),
+    'cvv2': '1234'}
+
+FORM_DATA = dict(PROCESS_DATA, expiration_1=str(date.today().year + 1))
+
+
+def canonical(document):
+    def _canonical(element):
+        return (element.tag, sorted(element.attrib.items()),
+                (element.text or '').strip(),
+                [_canonical(child) for child in element])
+    return _canonical(ElementTree.fromstring(document))
+
+
+class TestTemplateCodec(TestCase):
+
+    def setUp(self):
+        self.suds_provider = CyberSourceProvider(
+            merchant_id=MERCHANT_ID, password=PASSWORD)
+        self.provider = CyberSourceProvider(
+            merchant_id=MERCHANT_ID, password=PASSWORD, codec='template')
+        self.payment = Payment()
+        self.payment.transaction_id = '1234'
+        self.payment.attrs.merchant_defined_data = {
+            '1': 'Fish & Chips <large>', '2': 'foo'}
+        self.payment.attrs.capture = True
+
+    def _suds_envelope(self, params):
+        client = self.suds_provider.client
+        client.set_options(nosend=True)
+        try:
+            return client.service.runTransaction(**params).envelope
+        finally:
+            client.set_options(nosend=False)
+
+    def _assert_same_envelope(self, method, *args):
+        expected = self._suds_envelope(
+            getattr(self.suds_provider, method)(self.payment, *args))
+        envelope = self.provider.codec.encode(
+            getattr(self.provider, method)(self.payment, *args),
+            MERCHANT_ID, PASSWORD)
+        self.assertEqual(canonical(envelope), canonical(expected))
+
+    def test_unknown_codec_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            CyberSourceProvider(
+                merchant_id=MERCHANT_ID, password=PASSWORD, codec='xml')
+
+    def test_sale_envelope_matches_suds(self):
+        self._assert_same_envelope('_prepare_sale', CARD_DATA)
+
+    def test_preauth_envelope_matches_suds(self):
+        self._assert_same_envelope('_prepare_preauth', CARD_DATA)
+
+    def test_payer_auth_validation_envelope_matches_suds(self):
+        self._assert_same_envelope(
+            '_prepare_payer_auth_validation_check', CARD_DATA, 'pares')
+
+    def test_capture_release_and_refund_envelopes_match_suds(self):
+        self._assert_same_envelope('_prepare_capture', Decimal('10.00'))
+        self._assert_same_envelope('_prepare_release')
+        self._assert_same_envelope('_prepare_refund', Decimal('10.00'))
+
+    def test_reply_matches_suds(self):
+        client = self.suds_provider.client
+        soap_client = SoapClient(client, client.service.runTransaction.method)
+        expected = self.suds_provider._serialize_response(
+            soap_client.process_reply(REPLY.encode('utf-8')))
+        reply = self.provider.codec.decode(REPLY.encode('utf-8'))
+        self.assertEqual(reply, expected)
+        self.assertEqual(reply.reasonCode, AUTHENTICATE_REQUIRED)
+        self.assertEqual(reply.payerAuthEnrollReply.xid, 'abc')
+
+    def test_fault_raises(self):
+        with self.assertRaises(Fault) as exc:
+            self.provider.codec.decode(FAULT.encode('utf-8'))
+        self.assertEqual(exc.exception.code, 'wsse:FailedCheck')
+
+    @patch('requests.Session.post')
+    def test_provider_posts_envelope(self, mocked_post):
+        mocked_post.return_value = MagicMock(
+            status_code=200, content=REPLY.encode('utf-8'))
+        self.payment.transaction_id = None
+        form = self.provider.get_form(
+            payment=self.payment, data=FORM_DATA)
+        self.assertIn('PaReq', form.fields)
+        self.assertEqual(self.payment.transaction_id, '1234')
+        self.assertEqual(self.payment.attrs.xid, 'abc')
+        args, kwargs = mocked_post.call_args
+        self.assertEqual(args[0], self.provider.endpoint)
+        self.assertEqual(kwargs['headers']['SOAPAction'], '"runTransaction"')
+        self.assertIn(b'<ns1:ccCreditService run="true"/>', kwargs['data'])
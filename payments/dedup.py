@@ -0,0 +1,123 @@
+'''
+De-duplication of provider callbacks.
+
+Gateways resend notifications and customers reload return URLs. Callbacks
+are fingerprinted by their provider and the response to the first one is
+kept for a while, duplicates get it without being processed again.
+Enable it with the PAYMENT_CALLBACK_DEDUPLICATION setting.
+'''
+from __future__ import unicode_literals
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from .core import provider_factory
+from .utils import LocalStore
+
+
+class CacheStore(object):
+    '''
+    Keeps values for *ttl* seconds in a Django cache, shared by all
+    processes using it.
+    '''
+    def __init__(self, cache_alias='default', ttl=3600):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.ttl)
+
+
+STORES = {
+    'local': LocalStore,
+    'cache': CacheStore}
+
+
+def get_key(*parts):
+    digest = hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+    return 'payments:callback:%s' % (digest,)
+
+
+class CallbackDeduplicator(object):
+    '''
+    Keeps the responses to callbacks by their fingerprint, together with
+    the variant of the payment so that duplicates are answered without
+    loading it.
+    '''
+    def __init__(self, store):
+        self.store = store
+
+    def get_response(self, request, token, provider=None):
+        '''
+        Returns the response to an earlier callback with the same
+        fingerprint or None.
+        '''
+        # read the raw body before the provider parses the form, the
+        # fingerprint of the response is computed afterwards
+        request.body
+        if provider is None:
+            variant = self.store.get(get_key('variant', token))
+            if variant is None:
+                return None
+            try:
+                provider = provider_factory(variant)
+            except ValueError:
+                return None
+        fingerprint = provider.get_callback_fingerprint(request)
+        if fingerprint is None:
+            return None
+        data = self.store.get(get_key('response', token, fingerprint))
+        if data is None:
+            return None
+        status, content, headers = data
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+        return response
+
+    def set_response(self, request, payment, provider, response):
+        '''
+        Keeps a successful response to the callback
+        '''
+        if response.streaming or response.status_code >= 400:
+            return
+        fingerprint = provider.get_callback_fingerprint(request)
+        if fingerprint is None:
+            return
+        self.store.set(get_key('variant', payment.token), payment.variant)
+        self.store.set(
+            get_key('response', payment.token, fingerprint),
+            (response.status_code, response.content, list(response.items())))
+
+
+_deduplicator = None
+
+
+def get_callback_deduplicator():
+    '''
+    Returns the deduplicator configured with PAYMENT_CALLBACK_DEDUPLICATION
+    or None when it is disabled.
+    '''
+    global _deduplicator
+    options = getattr(settings, 'PAYMENT_CALLBACK_DEDUPLICATION', None)
+    if not options:
+        return None
+    if _deduplicator is None or _deduplicator[0] != options:
+        store_options = dict(options)
+        store = store_options.pop('store', 'local')
+        try:
+            store_class = STORES[store]
+        except KeyError:
+            raise ValueError('Unknown callback store: %r' % (store,))
+        _deduplicator = (
+            options, CallbackDeduplicator(store_class(**store_options)))
+    return _deduplicator[1]
@@ -61,6 +61,14 @@ class DotpayProvider(BasicProvider):
             'type': '1'}
         return data
 
+    supports_queued_callbacks = True
+
+    def get_callback_fingerprint(self, request):
+        if 't_id' in request.POST:
+            return '%s:%s' % (
+                request.POST['t_id'], request.POST.get('t_status'))
+        return super(DotpayProvider, self).get_callback_fingerprint(request)
+
     def process_data(self, payment, request):
         form = ProcessPaymentForm(payment=payment, pin=self.pin,
                                   data=request.POST or None)
@@ -67,10 +67,12 @@ class ProcessPaymentForm(forms.Form):
         status = self.cleaned_data['t_status']
         self.payment.transaction_id = self.cleaned_data['t_id']
         self.payment.save()
-        payment_status = self.payment.status
         if status == ACCEPTED:
-            self.payment.captured_amount = self.payment.total
-            self.payment.change_status(PaymentStatus.CONFIRMED)
-        elif ((status == NO_MORE_CONFIRMATION and payment_status == PaymentStatus.WAITING)
-              or status == REJECTED or status == CANCELED):
-            self.payment.change_status(PaymentStatus.REJECTED)
+            self.payment.transition_status(
+                PaymentStatus.CONFIRMED,
+                captured_amount=self.payment.total)
+        elif status == NO_MORE_CONFIRMATION:
+            self.payment.transition_status(
+                PaymentStatus.REJECTED, sources=[PaymentStatus.WAITING])
+        elif status == REJECTED or status == CANCELED:
+            self.payment.transition_status(PaymentStatus.REJECTED)
@@ -103,3 +103,12 @@ class TestDotpayProvider(TestCase):
         provider = DotpayProvider(seller_id='123', pin=PIN)
         response = provider.process_data(self.payment, request)
         self.assertEqual(type(response), HttpResponseForbidden)
+
+    def test_callback_fingerprint(self):
+        """DotpayProvider.get_callback_fingerprint() uses t_id and t_status"""
+        provider = DotpayProvider(seller_id='123', pin=PIN)
+        request = MagicMock()
+        request.POST = get_post_with_md5(PROCESS_POST)
+        self.assertEqual(
+            provider.get_callback_fingerprint(request),
+            't111:%s' % (ACCEPTED,))
@@ -7,6 +7,7 @@ from django import forms
 from django.core import validators
 from django.utils.translation import ugettext_lazy as _
 
+from .cards import is_luhn_valid, normalize_card_number
 from .core import get_credit_card_issuer
 from .utils import get_month_choices, get_year_choices
 from .widgets import CreditCardExpiryWidget, CreditCardNumberWidget
@@ -27,7 +28,7 @@ class CreditCardNumberField(forms.CharField):
 
     def to_python(self, value):
         if value is not None:
-            value = re.sub('[\s-]+', '', value)
+            value = normalize_card_number(value)
         return super(CreditCardNumberField, self).to_python(value)
 
     def validate(self, value):
@@ -46,19 +47,7 @@ class CreditCardNumberField(forms.CharField):
 
     @staticmethod
     def cart_number_checksum_validation(cls, number):
-        digits = []
-        even = False
-        if not number.isdigit():
-            return False
-        for digit in reversed(number):
-            digit = ord(digit) - ord('0')
-            if even:
-                digit *= 2
-                if digit >= 10:
-                    digit = digit % 10 + digit // 10
-            digits.append(digit)
-            even = not even
-        return sum(digits) % 10 == 0 if digits else False
+        return is_luhn_valid(number)
 
 
 
@@ -21,7 +21,6 @@ import simplejson as json
 import time
 import decimal
 
-import requests
 from django.http import HttpResponseRedirect, HttpResponseForbidden, HttpResponse
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -63,6 +62,7 @@ class PaydirektProvider(BasicProvider):
     path_void = "{}/girocheckout/api/v2/transaction/void"
 
     endpoint = "https://payment.girosolution.de"
+    indexed_attrs = ('MerchantTxId', 'BackendTxId')
 
     # DANGER: there is no playground url, check if Project has test status
     def __init__(self, merchantId, projectId, secret, default_carttype="PHYSICAL", overcapture=False, **kwargs):
@@ -124,23 +124,35 @@ class PaydirektProvider(BasicProvider):
         body = {k: v for k, v in body.items() if v}
         self.auth_for_dict(body, self.checkout_field_order)
 
-        response = requests.post(self.path_checkout.format(self.endpoint), data=body)
+        response = self.session.post(self.path_checkout.format(self.endpoint), data=body)
         json_response = json.loads(response.text)
         check_response(response, json_response)
         payment.transaction_id = json_response["reference"]
         payment.save()
         raise RedirectNeeded(json_response["redirect"])
 
+    supports_queued_callbacks = True
+
+    def get_callback_fingerprint(self, request):
+        if 'gcBackendTxId' in request.GET:
+            return '%s:%s' % (
+                request.GET['gcBackendTxId'],
+                request.GET.get('gcResultPayment'))
+        return super(PaydirektProvider, self).get_callback_fingerprint(request)
+
     def process_data(self, payment, request):
+        # the redirect of the customer and urlNotify may arrive at once, the
+        # status is only changed by the callback winning the transition
         if int(request.GET["gcResultPayment"]) == 4000:
             if not hasattr(payment.attrs, "gcBackendTxId"):
                 payment.attrs.BackendTxId = request.GET["gcBackendTxId"]
+                payment.save(update_fields=['extra_data'])
             if self._capture:
-                payment.change_status(PaymentStatus.CONFIRMED)
+                payment.transition_status(PaymentStatus.CONFIRMED)
             else:
-                payment.change_status(PaymentStatus.PREAUTH)
+                payment.transition_status(PaymentStatus.PREAUTH)
         else:
-            payment.change_status(PaymentStatus.ERROR)
+            payment.transition_status(PaymentStatus.ERROR)
         return HttpResponse('OK')
 
     def capture(self, payment, amount=None, final=True):
@@ -155,8 +167,8 @@ class PaydirektProvider(BasicProvider):
             "final": final
         }
         self.auth_for_dict(body, self.cr_field_order)
-        response = requests.post(self.path_capture.format(self.endpoint), \
-                                 data=body)
+        response = self.session.post(self.path_capture.format(self.endpoint), \
+                                     data=body)
         json_response = json.loads(response.text, use_decimal=True)
         check_response(response, json_response)
         return amount
@@ -167,8 +179,8 @@ class PaydirektProvider(BasicProvider):
             "reference": payment.transaction_id
         }
         self.auth_for_dict(body, self.void_field_order)
-        response = requests.post(self.path_void.format(self.endpoint), \
-                                 data=body)
+        response = self.session.post(self.path_void.format(self.endpoint), \
+                                     data=body)
         json_response = json.loads(response.text, use_decimal=True)
         check_response(response, json_response)
 
@@ -183,8 +195,8 @@ class PaydirektProvider(BasicProvider):
             "reference": payment.transaction_id
         }
         self.auth_for_dict(body, self.cr_field_order)
-        response = requests.post(self.path_refund.format(self.endpoint), \
-                                 data=body)
+        response = self.session.post(self.path_refund.format(self.endpoint), \
+                                     data=body)
         json_response = json.loads(response.text, use_decimal=True)
         check_response(response, json_response)
         return amount
@@ -0,0 +1,40 @@
+from __future__ import unicode_literals
+from unittest import TestCase
+try:
+    from unittest.mock import patch, MagicMock
+except ImportError:
+    from mock import patch, MagicMock
+
+from . import PaydirektProvider
+from .. import PaymentStatus
+from ..testcommon import create_test_payment
+
+MERCHANT_ID = 'test11'
+PROJECT_ID = '1234'
+SECRET = 'abcd1234'
+
+Payment = create_test_payment()
+
+
+class TestPaydirektProvider(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.provider = PaydirektProvider(MERCHANT_ID, PROJECT_ID, SECRET)
+
+    def test_process_data_confirms_payment(self):
+        request = MagicMock()
+        request.GET = {'gcResultPayment': '4000', 'gcBackendTxId': 'abc'}
+        with patch.object(Payment, 'save') as mocked_save:
+            response = self.provider.process_data(self.payment, request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.attrs.BackendTxId, 'abc')
+        mocked_save.assert_called_once_with(update_fields=['extra_data'])
+
+    def test_callback_losing_the_race_keeps_status(self):
+        self.payment.status = PaymentStatus.CONFIRMED
+        request = MagicMock()
+        request.GET = {'gcResultPayment': '4900', 'gcBackendTxId': 'abc'}
+        self.provider.process_data(self.payment, request)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
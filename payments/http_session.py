@@ -0,0 +1,70 @@
+'''
+Pooled, keep-alive HTTP sessions used by providers to talk to gateway APIs.
+'''
+from __future__ import unicode_literals
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+DEFAULT_HTTP_OPTIONS = {
+    # number of per-host connection pools kept by the session
+    'pool_connections': 10,
+    # number of connections kept alive in each pool
+    'pool_maxsize': 10,
+    # block instead of opening extra connections when the pool is exhausted
+    'pool_block': False,
+    'keep_alive': True,
+    # (connect, read) timeout in seconds
+    'timeout': (5, 30),
+    # retries on connection errors; read errors and the statuses below are
+    # only retried for idempotent methods (GET, HEAD, PUT, DELETE, ...)
+    'retries': 2,
+    'backoff_factor': 0.1,
+    'status_forcelist': (502, 503, 504)}
+
+
+class PaymentSession(requests.Session):
+    '''
+    A requests session that applies a default timeout to every request.
+    '''
+    def __init__(self, timeout=None):
+        super(PaymentSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(PaymentSession, self).request(method, url, **kwargs)
+
+
+def create_session(**options):
+    '''
+    Return a new PaymentSession configured by *options*, see
+    DEFAULT_HTTP_OPTIONS for the accepted keys.
+    '''
+    unknown = set(options) - set(DEFAULT_HTTP_OPTIONS)
+    if unknown:
+        raise ValueError(
+            'Unknown HTTP options: %s' % (', '.join(sorted(unknown)),))
+    config = dict(DEFAULT_HTTP_OPTIONS, **options)
+    retries = config['retries']
+    max_retries = Retry(
+        total=retries, connect=retries, read=retries, status=retries,
+        backoff_factor=config['backoff_factor'],
+        status_forcelist=config['status_forcelist'],
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=config['pool_connections'],
+        pool_maxsize=config['pool_maxsize'],
+        pool_block=config['pool_block'],
+        max_retries=max_retries)
+    session = PaymentSession(timeout=config['timeout'])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not config['keep_alive']:
+        session.headers['Connection'] = 'close'
+    return session
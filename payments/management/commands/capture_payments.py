@@ -0,0 +1,64 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import get_payment_model
+from ...bulk import Checkpoint, capture_payments
+
+
+def parse_pairs(values, name, convert=None):
+    pairs = {}
+    for value in values:
+        try:
+            key, value = value.split('=', 1)
+            pairs[key] = convert(value) if convert else value
+        except ValueError:
+            raise CommandError('Invalid %s: %s' % (name, value))
+    return pairs
+
+
+class Command(BaseCommand):
+    help = 'Captures pre-authorized payments in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--variant', action='append', default=[],
+            help='Only capture payments of this variant, can be repeated')
+        parser.add_argument(
+            '--filter', action='append', default=[], metavar='LOOKUP=VALUE',
+            help='Only capture payments matching this field lookup, '
+                 'e.g. created__lt=2017-06-01, can be repeated')
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help='Number of captures run at once for each variant')
+        parser.add_argument(
+            '--variant-concurrency', action='append', default=[],
+            metavar='VARIANT=N',
+            help='Number of captures run at once for this variant')
+        parser.add_argument(
+            '--max-threads', type=int, default=32,
+            help='Number of captures run at once for all variants together')
+        parser.add_argument(
+            '--checkpoint',
+            help='File recording the captured payments, an interrupted '
+                 'run is resumed when given again')
+        parser.add_argument(
+            '--retry-failed', action='store_true',
+            help='Try again the payments that failed in the checkpoint')
+
+    def handle(self, **options):
+        payments = get_payment_model()._default_manager.filter(
+            **parse_pairs(options['filter'], 'filter'))
+        if options['variant']:
+            payments = payments.filter(variant__in=options['variant'])
+        checkpoint = None
+        if options['checkpoint']:
+            checkpoint = Checkpoint(
+                options['checkpoint'], retry_failed=options['retry_failed'])
+        result = capture_payments(
+            payments, concurrency=options['concurrency'],
+            variant_concurrency=parse_pairs(
+                options['variant_concurrency'], 'variant concurrency', int),
+            max_threads=options['max_threads'], checkpoint=checkpoint)
+        for line in result.get_summary():
+            self.stdout.write(line)
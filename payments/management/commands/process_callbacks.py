@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...callbacks import process_callbacks
+
+
+class Command(BaseCommand):
+    help = 'Processes the queued provider callbacks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Number of callbacks processed at once')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of callbacks fetched at once')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep waiting for new callbacks')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds between checks for new callbacks with --loop')
+
+    def handle(self, **options):
+        while True:
+            counts = process_callbacks(
+                workers=options['workers'], limit=options['batch_size'])
+            if counts:
+                self.stdout.write(', '.join(
+                    '%s: %d' % item for item in sorted(counts.items())))
+            if sum(counts.values()) < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
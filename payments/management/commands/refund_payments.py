@@ -0,0 +1,52 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ... import get_payment_model
+from ...bulk import Checkpoint, refund_payments
+from .capture_payments import parse_pairs
+
+
+class Command(BaseCommand):
+    help = 'Refunds confirmed payments in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--variant', action='append', default=[],
+            help='Only refund payments of this variant, can be repeated')
+        parser.add_argument(
+            '--filter', action='append', default=[], metavar='LOOKUP=VALUE',
+            help='Only refund payments matching this field lookup, '
+                 'e.g. description=Concert, can be repeated')
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help='Number of refunds run at once for each variant refunding '
+                 'one payment at a time')
+        parser.add_argument(
+            '--variant-concurrency', action='append', default=[],
+            metavar='VARIANT=N',
+            help='Number of refunds run at once for this variant')
+        parser.add_argument(
+            '--checkpoint',
+            help='File recording the refunded payments, an interrupted '
+                 'run is resumed when given again')
+        parser.add_argument(
+            '--retry-failed', action='store_true',
+            help='Try again the payments that failed in the checkpoint')
+
+    def handle(self, **options):
+        payments = get_payment_model()._default_manager.filter(
+            **parse_pairs(options['filter'], 'filter'))
+        if options['variant']:
+            payments = payments.filter(variant__in=options['variant'])
+        checkpoint = None
+        if options['checkpoint']:
+            checkpoint = Checkpoint(
+                options['checkpoint'], retry_failed=options['retry_failed'])
+        result = refund_payments(
+            payments, concurrency=options['concurrency'],
+            variant_concurrency=parse_pairs(
+                options['variant_concurrency'], 'variant concurrency', int),
+            checkpoint=checkpoint)
+        for line in result.get_summary():
+            self.stdout.write(line)
@@ -0,0 +1,38 @@
+from __future__ import unicode_literals
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...outbox import get_outbox_sink, relay_events
+
+
+class Command(BaseCommand):
+    help = 'Delivers the payment status events of the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of parallel sends to the sink')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of events read at once')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep waiting for new events')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds between checks for new events with --loop')
+
+    def handle(self, **options):
+        sink = get_outbox_sink()
+        while True:
+            delivered, failed = relay_events(
+                sink, batch_size=options['batch_size'],
+                workers=options['workers'])
+            if delivered or failed:
+                self.stdout.write(
+                    'delivered: %d, failed: %d' % (delivered, failed))
+            if failed or delivered < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
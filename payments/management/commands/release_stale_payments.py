@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk import Checkpoint, release_stale_payments
+from .capture_payments import parse_pairs
+
+
+class Command(BaseCommand):
+    help = 'Releases pre-authorized payments that were never captured'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=float,
+            help='Age in days of the payments released')
+        parser.add_argument(
+            '--variant-max-age', action='append', default=[],
+            metavar='VARIANT=DAYS',
+            help='Age in days of the payments of this variant released')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of payments read at once')
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help='Number of releases run at once for each variant')
+        parser.add_argument(
+            '--variant-concurrency', action='append', default=[],
+            metavar='VARIANT=N',
+            help='Number of releases run at once for this variant')
+        parser.add_argument(
+            '--checkpoint',
+            help='File recording the outcome of each release')
+
+    def handle(self, **options):
+        variant_max_age = dict(
+            (variant, timedelta(days=days)) for variant, days in parse_pairs(
+                options['variant_max_age'], 'variant max age',
+                float).items())
+        max_age = options['max_age']
+        if max_age is None and not variant_max_age:
+            raise CommandError('Give --max-age or --variant-max-age')
+        result = release_stale_payments(
+            max_age=timedelta(days=max_age) if max_age is not None else None,
+            variant_max_age=variant_max_age,
+            batch_size=options['batch_size'],
+            concurrency=options['concurrency'],
+            variant_concurrency=parse_pairs(
+                options['variant_concurrency'], 'variant concurrency', int),
+            checkpoint=(
+                Checkpoint(options['checkpoint'])
+                if options['checkpoint'] else None))
+        for line in result.get_summary():
+            self.stdout.write(line)
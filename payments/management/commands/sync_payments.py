@@ -0,0 +1,58 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ... import get_payment_model
+from ...sync import sync_payments
+from .capture_payments import parse_pairs
+
+
+class Command(BaseCommand):
+    help = 'Updates the status of payments from their gateways'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--status', action='append', default=[],
+            help='Only sync payments with this status, waiting ones by '
+                 'default, can be repeated')
+        parser.add_argument(
+            '--variant', action='append', default=[],
+            help='Only sync payments of this variant, can be repeated')
+        parser.add_argument(
+            '--filter', action='append', default=[], metavar='LOOKUP=VALUE',
+            help='Only sync payments matching this field lookup, '
+                 'e.g. created__lt=2017-06-01, can be repeated')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of payments read at once')
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help='Number of status queries run at once for each variant')
+        parser.add_argument(
+            '--variant-concurrency', action='append', default=[],
+            metavar='VARIANT=N',
+            help='Number of status queries run at once for this variant')
+        parser.add_argument(
+            '--rate-limit', type=float,
+            help='Number of requests per second sent to each gateway')
+        parser.add_argument(
+            '--variant-rate-limit', action='append', default=[],
+            metavar='VARIANT=N',
+            help='Number of requests per second sent for this variant')
+
+    def handle(self, **options):
+        payments = get_payment_model()._default_manager.filter(
+            **parse_pairs(options['filter'], 'filter'))
+        if options['variant']:
+            payments = payments.filter(variant__in=options['variant'])
+        result = sync_payments(
+            payments, statuses=options['status'] or None,
+            batch_size=options['batch_size'],
+            rate_limit=options['rate_limit'],
+            variant_rate_limit=parse_pairs(
+                options['variant_rate_limit'], 'variant rate limit', float),
+            concurrency=options['concurrency'],
+            variant_concurrency=parse_pairs(
+                options['variant_concurrency'], 'variant concurrency', int))
+        for line in result.get_summary():
+            self.stdout.write(line)
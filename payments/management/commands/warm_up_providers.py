@@ -0,0 +1,31 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...apps import warm_up_providers
+
+
+class Command(BaseCommand):
+    help = ('Builds the providers of the payment variants and reports the '
+            'time spent importing and initializing each one')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'variant', nargs='*',
+            help='Variant to build, all of PAYMENT_VARIANTS by default')
+
+    def handle(self, **options):
+        results = warm_up_providers(options['variant'] or None)
+        failed = 0
+        self.stdout.write(
+            '%-20s %10s %10s' % ('variant', 'import ms', 'init ms'))
+        for variant, timing, error in results:
+            if error is not None:
+                failed += 1
+                self.stdout.write('%-20s failed: %s' % (variant, error))
+            else:
+                self.stdout.write('%-20s %10.1f %10.1f' % (
+                    variant, timing.import_time * 1000,
+                    timing.init_time * 1000))
+        if failed:
+            raise CommandError('%d variants failed' % (failed,))
@@ -1,16 +1,47 @@
 from __future__ import unicode_literals
+from contextlib import contextmanager
+import copy
 import json
-from uuid import uuid4
 from decimal import Decimal
+from io import BytesIO
 
 from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from .core import provider_factory
+from .tokens import get_token_generator
 from .utils import add_prefixed_address, getter_prefixed_address
-from . import FraudStatus, PaymentStatus
+from . import CallbackStatus, FraudStatus, PaymentStatus
+
+#: Number of tokens tried before giving up on saving a new payment
+TOKEN_ATTEMPTS = 10
+
+#: Positional arguments of Model.save()
+SAVE_ARGUMENTS = ('force_insert', 'force_update', 'using', 'update_fields')
+
+#: Request META kept with stored callbacks
+CALLBACK_META = (
+    'CONTENT_TYPE', 'REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT',
+    'SCRIPT_NAME', 'wsgi.url_scheme')
+
+#: HTTP headers kept with stored callbacks, others like cookies and
+#: credentials are never written to the callback table
+CALLBACK_HEADERS = getattr(settings, 'PAYMENT_CALLBACK_HEADERS', (
+    'HTTP_ACCEPT', 'HTTP_HOST', 'HTTP_USER_AGENT', 'HTTP_X_FORWARDED_FOR',
+    'HTTP_X_FORWARDED_HOST', 'HTTP_X_FORWARDED_PROTO', 'HTTP_X_SIGNATURE'))
+
+#: Store extra_data in a JSON column instead of a text column
+PAYMENT_JSON_EXTRA_DATA = getattr(settings, 'PAYMENT_JSON_EXTRA_DATA', False)
+
+if PAYMENT_JSON_EXTRA_DATA:
+    try:
+        from django.db.models import JSONField
+    except ImportError:
+        from django.contrib.postgres.fields import JSONField
 
 
 class PaymentAttributeProxy(object):
@@ -20,7 +51,7 @@ class PaymentAttributeProxy(object):
         super(PaymentAttributeProxy, self).__init__()
 
     def __getattr__(self, item):
-        data = json.loads(self._payment.extra_data or '{}')
+        data = self._payment.get_extra_data()
         try:
             return data[item]
         except KeyError as e:
@@ -29,26 +60,144 @@ class PaymentAttributeProxy(object):
     def __setattr__(self, key, value):
         if key == '_payment':
             return super(PaymentAttributeProxy, self).__setattr__(key, value)
-        try:
-            data = json.loads(self._payment.extra_data)
-        except ValueError:
-            data = {}
-        data[key] = value
-        self._payment.extra_data = json.dumps(data)
+        self._payment.update_extra_data({key: value})
 
 
 class BasePaymentLogic(object):
     """ Logic of a Payment object, e.g. for tests """
 
+    # extra_data decoded by get_extra_data(), the raw value it was decoded
+    # from and whether it was changed since
+    _extra_data = None
+    _extra_data_raw = None
+    _extra_data_changed = False
+    # nesting depth of defer_saves(), whether a save was requested within it,
+    # the callbacks waiting for that save and the outbox events written with
+    # it
+    _saves_deferred = 0
+    _deferred_save = False
+    _deferred_callbacks = ()
+    _deferred_events = ()
+
+    def get_extra_data(self):
+        '''
+        Returns extra_data decoded as a dict.
+
+        The value is decoded once and cached until extra_data is assigned a
+        different value. Use update_extra_data() or set_extra_data() to
+        change it, changes are encoded once by save().
+        '''
+        if (self._extra_data is None or
+                self._extra_data_raw is not self.extra_data):
+            if isinstance(self.extra_data, dict):
+                # stored in a JSON column
+                data = self.extra_data
+            else:
+                try:
+                    data = json.loads(self.extra_data or '{}')
+                except ValueError:
+                    data = {}
+            self._extra_data = data
+            self._extra_data_raw = self.extra_data
+            self._extra_data_changed = False
+        return self._extra_data
+
+    def set_extra_data(self, data):
+        '''
+        Replaces the whole extra_data with the given dict.
+        '''
+        self.get_extra_data()
+        self._extra_data = data
+        self._extra_data_changed = True
+
+    def update_extra_data(self, values):
+        '''
+        Updates extra_data with the keys of the given dict.
+        '''
+        self.get_extra_data().update(values)
+        self._extra_data_changed = True
+
+    def flush_extra_data(self):
+        '''
+        Encodes the changed extra_data back to its field.
+        '''
+        if (self._extra_data_changed and
+                self._extra_data_raw is self.extra_data):
+            if isinstance(self.extra_data, dict):
+                self.extra_data = self._extra_data
+            else:
+                self.extra_data = json.dumps(self._extra_data)
+            self._extra_data_raw = self.extra_data
+        self._extra_data_changed = False
+
     def change_status(self, status, message=''):
         '''
         Updates the Payment status and sends the status_changed signal.
         '''
-        from .signals import status_changed
+        from .outbox import is_outbox_enabled, record_status_change
+        from .signals import send_status_changed
+        previous_status = self.status
         self.status = status
         self.message = message
-        self.save()
-        status_changed.send(sender=type(self), instance=self)
+        if not is_outbox_enabled():
+            self.save()
+        elif self._saves_deferred:
+            # written in the same transaction as the deferred save
+            self._deferred_events.append(
+                record_status_change(self, previous_status, commit=False))
+            self.save()
+        else:
+            using = router.db_for_write(type(self), instance=self)
+            with transaction.atomic(using=using):
+                self.save()
+                record_status_change(self, previous_status)
+        self.after_save(send_status_changed, type(self), self)
+
+    @contextmanager
+    def defer_saves(self):
+        '''
+        Merges all saves made within the block into a single save at its
+        end. Callbacks registered with after_save(), like the status_changed
+        signal, run after that save. Outbox events of status changes are
+        written in a transaction with it. Nothing is saved if the block
+        raises.
+        '''
+        if not self._saves_deferred:
+            self._deferred_save = False
+            self._deferred_callbacks = []
+            self._deferred_events = []
+        self._saves_deferred += 1
+        try:
+            yield self
+        finally:
+            self._saves_deferred -= 1
+        if not self._saves_deferred:
+            callbacks = self._deferred_callbacks
+            events = self._deferred_events
+            self._deferred_callbacks = ()
+            self._deferred_events = ()
+            if events:
+                self._deferred_save = False
+                using = router.db_for_write(type(self), instance=self)
+                with transaction.atomic(using=using):
+                    self.save()
+                    for event in events:
+                        event.save()
+            elif self._deferred_save:
+                self._deferred_save = False
+                self.save()
+            for func, args, kwargs in callbacks:
+                func(*args, **kwargs)
+
+    def after_save(self, func, *args, **kwargs):
+        '''
+        Calls func right away or, within defer_saves(), after the payment is
+        saved.
+        '''
+        if self._saves_deferred:
+            self._deferred_callbacks.append((func, args, kwargs))
+        else:
+            func(*args, **kwargs)
 
     def change_fraud_status(self, status, message='', commit=True):
         available_statuses = [choice[0] for choice in FraudStatus.CHOICES]
@@ -132,22 +281,42 @@ class BasePaymentLogic(object):
         return amount
 
     def create_token(self):
-        if not self.token:
-            tries = {}  # Stores a set of tried values
-            while True:
-                token = str(uuid4())
-                if token in tries and len(tries) >= 100:  # After 100 tries we are impliying an infinite loop
-                    raise SystemExit('A possible infinite loop was detected')
-                else:
-                    if not self.__class__._default_manager.filter(token=token).exists():
-                        self.token = token
-                        break
-                tries.add(token)
+        '''
+        Sets a new token unless the payment has one, returns whether it did.
+
+        Uniqueness is enforced by the database, see BasePayment.save().
+        '''
+        if self.token:
+            return False
+        self.token = get_token_generator()()
+        return True
 
     @property
     def attrs(self):
         return PaymentAttributeProxy(self)
 
+class PaymentQuerySet(models.QuerySet):
+
+    def filter_attrs(self, **attrs):
+        '''
+        Filters payments by values stored in ``attrs``, nested keys are
+        separated with ``__``.
+
+        With a JSON extra_data column these are key lookups that can use the
+        indexes added by payments.operations.AddAttrIndex. With a text column
+        payments are matched by their encoded ``"key": value`` pairs.
+        '''
+        queryset = self
+        field = self.model._meta.get_field('extra_data')
+        for key, value in attrs.items():
+            if field.get_internal_type() == 'JSONField':
+                queryset = queryset.filter(**{'extra_data__' + key: value})
+            else:
+                queryset = queryset.filter(extra_data__contains='"%s": %s' % (
+                    key.rsplit('__', 1)[-1], json.dumps(value)))
+        return queryset
+
+
 class BasePayment(models.Model, BasePaymentLogic):
     '''
     Represents a single transaction. Each instance has one or more PaymentItem.
@@ -177,18 +346,186 @@ class BasePayment(models.Model, BasePaymentLogic):
     description = models.TextField(blank=True, default='')
     billing_email = models.EmailField(blank=True)
     customer_ip_address = models.GenericIPAddressField(blank=True, null=True)
-    extra_data = models.TextField(blank=True, default='')
+    if PAYMENT_JSON_EXTRA_DATA:
+        extra_data = JSONField(blank=True, default=dict)
+    else:
+        extra_data = models.TextField(blank=True, default='')
     message = models.TextField(blank=True, default='')
-    token = models.CharField(max_length=36, blank=True, default='')
+    token = models.CharField(
+        max_length=36, blank=True, default='', unique=True)
     captured_amount = models.DecimalField(
         max_digits=9, decimal_places=2, default=Decimal('0.0'))
 
+    objects = PaymentQuerySet.as_manager()
+
+    # values of the fields when the payment was loaded or last saved
+    _loaded_values = None
+
     class Meta:
         abstract = True
 
-    def save(self, **kwargs):
-        self.create_token()
-        return super(BasePayment, self).save(**kwargs)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(BasePayment, cls).from_db(db, field_names, values)
+        instance._store_loaded_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(BasePayment, self).refresh_from_db(using=using, fields=fields)
+        if fields is None or self._loaded_values is None:
+            self._store_loaded_values()
+            return
+        for field in self._meta.concrete_fields:
+            if field.name in fields or field.attname in fields:
+                self._loaded_values[field.attname] = self._get_loaded_value(
+                    field.attname)
+
+    def _store_loaded_values(self):
+        deferred = self.get_deferred_fields()
+        self._loaded_values = dict(
+            (field.attname, self._get_loaded_value(field.attname))
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred)
+
+    def _get_loaded_value(self, attname):
+        value = getattr(self, attname)
+        if isinstance(value, (dict, list)):
+            # a JSON column changed in place must still differ from it
+            value = copy.deepcopy(value)
+        return value
+
+    def get_changed_fields(self):
+        '''
+        Returns the names of the fields changed since the payment was loaded
+        or last saved.
+        '''
+        changed = []
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.attname not in self.__dict__:
+                # deferred fields are only present once they are assigned
+                continue
+            if (field.attname not in self._loaded_values or
+                    getattr(self, field.attname) !=
+                    self._loaded_values[field.attname]):
+                changed.append(field.name)
+        return changed
+
+    def _save_with_new_token(self, **kwargs):
+        '''
+        Saves the payment, picking another token if the new one is taken.
+
+        Within a transaction the save runs in a savepoint so that a failed
+        attempt does not abort the transaction.
+        '''
+        using = kwargs.get('using') or router.db_for_write(
+            type(self), instance=self)
+        for attempt in range(TOKEN_ATTEMPTS):
+            try:
+                if connections[using].in_atomic_block:
+                    with transaction.atomic(using=using):
+                        super(BasePayment, self).save(**kwargs)
+                else:
+                    super(BasePayment, self).save(**kwargs)
+                return
+            except IntegrityError:
+                token_taken = type(self)._default_manager.using(
+                    using).filter(token=self.token).exists()
+                if not token_taken:
+                    raise
+                self.token = ''
+                self.create_token()
+        raise IntegrityError(
+            'Could not generate a unique token in %d attempts' % (
+                TOKEN_ATTEMPTS,))
+
+    def transition_status(self, status, message='', sources=None, **fields):
+        '''
+        Moves the payment to *status* with a single conditional UPDATE,
+        applied only if the status stored in the database can move to it
+        (see PaymentStatus.TRANSITIONS) or is one of *sources*. Returns
+        whether it was applied, the payment is left unchanged otherwise.
+
+        Other *fields* that only change with the status, like the captured
+        amount, are written by the same UPDATE so that the outbox event
+        holds them.
+
+        Concurrent callbacks use it to resolve which one changes the status
+        without locking the row. The status_changed signal is sent like in
+        change_status().
+        '''
+        from .outbox import is_outbox_enabled, record_status_change
+        from .signals import send_status_changed
+        if sources is None:
+            sources = PaymentStatus.get_sources(status)
+        previous_status = self.status
+        # the database save() would write to
+        using = router.db_for_write(type(self), instance=self)
+        if is_outbox_enabled():
+            with transaction.atomic(using=using):
+                updated = self._update_status(
+                    status, message, sources, using, fields)
+                if updated:
+                    record_status_change(self, previous_status)
+        else:
+            updated = self._update_status(
+                status, message, sources, using, fields)
+        if updated:
+            self.after_save(send_status_changed, type(self), self)
+        return updated
+
+    def _update_status(self, status, message, sources, using, fields):
+        values = dict(
+            fields, status=status, message=message, modified=timezone.now())
+        updated = type(self)._default_manager.using(using).filter(
+            pk=self.pk, status__in=sources).update(**values)
+        if not updated:
+            return False
+        for name, value in values.items():
+            attname = self._meta.get_field(name).attname
+            setattr(self, attname, value)
+            if self._loaded_values is not None:
+                self._loaded_values[attname] = self._get_loaded_value(attname)
+        return True
+
+    def save(self, *args, **kwargs):
+        '''
+        Saves the payment, writing only the changed fields (and the
+        modification date) of payments that were loaded or saved before.
+        '''
+        if args:
+            if len(args) > len(SAVE_ARGUMENTS):
+                raise TypeError('save() takes at most %d arguments' % (
+                    len(SAVE_ARGUMENTS),))
+            # positional arguments of Model.save()
+            kwargs.update(zip(SAVE_ARGUMENTS, args))
+        if self._saves_deferred:
+            self._deferred_save = True
+            return
+        # a JSON column changed in place compares equal to its loaded value
+        extra_data_changed = self._extra_data_changed
+        self.flush_extra_data()
+        new_token = self.create_token()
+        if (self._loaded_values is not None and not self._state.adding and
+                kwargs.get('update_fields') is None and
+                not kwargs.get('force_insert')):
+            update_fields = self.get_changed_fields()
+            if extra_data_changed and 'extra_data' not in update_fields:
+                update_fields.append('extra_data')
+            if not update_fields:
+                return
+            if 'modified' not in update_fields:
+                update_fields.append('modified')
+            kwargs['update_fields'] = update_fields
+        if new_token:
+            self._save_with_new_token(**kwargs)
+        else:
+            super(BasePayment, self).save(**kwargs)
+        if self._loaded_values is None or kwargs.get('update_fields') is None:
+            self._store_loaded_values()
+        else:
+            for name in kwargs['update_fields']:
+                attname = self._meta.get_field(name).attname
+                self._loaded_values[attname] = self._get_loaded_value(attname)
 
 @add_prefixed_address("billing")
 class BasePaymentWithAddress(BasePayment):
@@ -198,3 +535,96 @@ class BasePaymentWithAddress(BasePayment):
 
     class Meta:
         abstract = True
+
+
+class BaseCallback(models.Model):
+    '''
+    A provider callback stored by the callback views to be processed later,
+    see payments.callbacks.
+    '''
+    variant = models.CharField(max_length=255)
+    #: Token of the payment, callbacks of a payment are processed in order
+    token = models.CharField(max_length=36, db_index=True)
+    method = models.CharField(max_length=10)
+    path = models.TextField()
+    query_string = models.TextField(blank=True, default='')
+    #: JSON encoded headers and the request META needed to replay it
+    meta = models.TextField(blank=True, default='')
+    body = models.BinaryField(blank=True, default=b'')
+    status = models.CharField(
+        max_length=10, choices=CallbackStatus.CHOICES,
+        default=CallbackStatus.PENDING, db_index=True)
+    error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    #: When a run of process_callbacks last claimed the callback
+    claimed = models.DateTimeField(null=True, blank=True)
+    processed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_request(cls, request, variant, token):
+        meta = dict(
+            (key, value) for key, value in request.META.items()
+            if key in CALLBACK_HEADERS or key in CALLBACK_META)
+        return cls(
+            variant=variant, token=token, method=request.method,
+            path=request.path_info,
+            query_string=request.META.get('QUERY_STRING', ''),
+            meta=json.dumps(meta), body=request.body)
+
+    def get_request(self):
+        '''
+        Rebuilds the stored request
+        '''
+        body = bytes(self.body)
+        environ = json.loads(self.meta) if self.meta else {}
+        environ.update({
+            'REQUEST_METHOD': self.method,
+            'PATH_INFO': self.path,
+            'QUERY_STRING': self.query_string,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': BytesIO(body)})
+        return WSGIRequest(environ)
+
+
+class BaseOutboxEvent(models.Model):
+    '''
+    A status change of a payment, written in the same transaction as the
+    payment and delivered by the relay_outbox command, see payments.outbox.
+    '''
+    token = models.CharField(max_length=36, db_index=True)
+    variant = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=PaymentStatus.CHOICES)
+    previous_status = models.CharField(
+        max_length=10, choices=PaymentStatus.CHOICES, blank=True, default='')
+    #: JSON encoded details of the payment
+    payload = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    delivered = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_payment(cls, payment, previous_status=''):
+        return cls(
+            token=payment.token, variant=payment.variant,
+            status=payment.status, previous_status=previous_status or '',
+            payload=json.dumps({
+                'message': payment.message,
+                'transaction_id': payment.transaction_id or '',
+                'currency': payment.currency,
+                'total': str(payment.total),
+                'captured_amount': str(payment.captured_amount)}))
+
+    def to_dict(self):
+        return {
+            'id': self.pk,
+            'token': self.token,
+            'variant': self.variant,
+            'status': self.status,
+            'previous_status': self.previous_status,
+            'created': self.created.isoformat() if self.created else None,
+            'payload': json.loads(self.payload) if self.payload else {}}
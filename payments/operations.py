@@ -0,0 +1,112 @@
+'''
+Migration operations for storing extra_data in a JSON column and indexing
+the attrs payments are looked up by.
+'''
+from __future__ import unicode_literals
+import hashlib
+import json
+
+from django.db.migrations.operations.base import Operation
+
+
+class PrepareJSONExtraData(Operation):
+    '''
+    Replaces empty and malformed extra_data values with an empty object so
+    that the text column can be altered to a JSON column. Run it right
+    before the AlterField operation.
+    '''
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(
+                schema_editor.connection.alias, model):
+            return
+        manager = model._base_manager.using(schema_editor.connection.alias)
+        manager.filter(extra_data='').update(extra_data='{}')
+        malformed = []
+        rows = manager.exclude(extra_data='{}').values_list(
+            'pk', 'extra_data')
+        for pk, extra_data in rows.iterator():
+            try:
+                json.loads(extra_data)
+            except ValueError:
+                malformed.append(pk)
+        if malformed:
+            manager.filter(pk__in=malformed).update(extra_data='{}')
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        pass
+
+    def describe(self):
+        return 'Prepare extra_data of %s for a JSON column' % (
+            self.model_name,)
+
+
+class AddAttrIndex(Operation):
+    '''
+    Adds an index on a key of a JSON extra_data column so that
+    ``Payment.objects.filter_attrs()`` lookups on that key are index seeks.
+
+    Nested keys are separated with ``__``. Only PostgreSQL is supported,
+    the operation does nothing on other databases. Use ``concurrently=True``
+    in a non-atomic migration to avoid locking large tables.
+    '''
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, attr, concurrently=False):
+        self.model_name = model_name
+        self.attr = attr
+        self.concurrently = concurrently
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def get_index_name(self, model):
+        digest = hashlib.md5(self.attr.encode('utf-8')).hexdigest()[:8]
+        return '%s_attr_%s' % (model._meta.db_table[:48], digest)
+
+    def get_expression(self, model, schema_editor):
+        column = schema_editor.quote_name(
+            model._meta.get_field('extra_data').column)
+        keys = self.attr.split('__')
+        if len(keys) == 1:
+            return '(%s -> %s)' % (column, schema_editor.quote_value(keys[0]))
+        return '(%s #> %s)' % (
+            column, schema_editor.quote_value('{%s}' % (','.join(keys),)))
+
+    def _run(self, schema_editor, model):
+        return (
+            schema_editor.connection.vendor == 'postgresql' and
+            self.allow_migrate_model(schema_editor.connection.alias, model))
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self._run(schema_editor, model):
+            schema_editor.execute('CREATE INDEX %s%s ON %s (%s)' % (
+                'CONCURRENTLY ' if self.concurrently else '',
+                schema_editor.quote_name(self.get_index_name(model)),
+                schema_editor.quote_name(model._meta.db_table),
+                self.get_expression(model, schema_editor)))
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self._run(schema_editor, model):
+            schema_editor.execute('DROP INDEX %s%s' % (
+                'CONCURRENTLY ' if self.concurrently else '',
+                schema_editor.quote_name(self.get_index_name(model))))
+
+    def describe(self):
+        return 'Add index on attrs %s of %s' % (self.attr, self.model_name)
@@ -0,0 +1,155 @@
+'''
+Transactional outbox of payment status changes.
+
+With PAYMENT_OUTBOX_MODEL set every status change writes an event in the
+same transaction as the payment. The relay_outbox command delivers the
+events to the sink configured with PAYMENT_OUTBOX_SINK and marks them as
+delivered once the sink accepted them, so each event is delivered at least
+once, in order for each payment.
+'''
+from __future__ import unicode_literals
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import io
+import json
+import logging
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+from . import get_outbox_model
+
+logger = logging.getLogger(__name__)
+
+
+def is_outbox_enabled():
+    '''
+    Returns whether status changes are written to the outbox
+    '''
+    return bool(getattr(settings, 'PAYMENT_OUTBOX_MODEL', None))
+
+
+def record_status_change(payment, previous_status, commit=True):
+    '''
+    Writes the event of the status change of *payment*, returns it unsaved
+    when *commit* is false
+    '''
+    Event = get_outbox_model()
+    event = Event.from_payment(payment, previous_status)
+    if commit:
+        event.save()
+    return event
+
+
+class Sink(object):
+    '''
+    Base class of the destinations of outbox events.
+    '''
+    def send(self, events):
+        '''
+        Delivers the list of events, as dicts, raises if it failed.
+        '''
+        raise NotImplementedError()
+
+
+class FileSink(Sink):
+    '''
+    Appends the events to a file, one JSON object per line.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, events):
+        with self._lock:
+            with io.open(self.path, 'a', encoding='utf-8') as output:
+                for event in events:
+                    output.write('%s\n' % (json.dumps(event, sort_keys=True),))
+
+
+class HTTPSink(Sink):
+    '''
+    Posts the events to *url* as ``{"events": [...]}``, any response
+    status other than 2xx is a failure.
+    '''
+    def __init__(self, url, headers=None, http_options=None):
+        from .http_session import create_session
+        self.url = url
+        self.headers = dict(
+            {'Content-Type': 'application/json'}, **(headers or {}))
+        self.session = create_session(**(http_options or {}))
+
+    def send(self, events):
+        response = self.session.post(
+            self.url, data=json.dumps({'events': events}),
+            headers=self.headers)
+        response.raise_for_status()
+
+
+def get_outbox_sink():
+    '''
+    Returns the sink configured with PAYMENT_OUTBOX_SINK, a tuple of the
+    dotted path of the sink class and its arguments.
+    '''
+    try:
+        path, options = settings.PAYMENT_OUTBOX_SINK
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(
+            'PAYMENT_OUTBOX_SINK must be a (path, options) tuple')
+    return import_string(path)(**options)
+
+
+def send_events(sink, events):
+    '''
+    Sends *events* to *sink* and marks them as delivered, returns the
+    number of delivered events.
+    '''
+    Event = get_outbox_model()
+    try:
+        sink.send([event.to_dict() for event in events])
+    except Exception:
+        logger.exception('Delivering %d outbox events failed', len(events))
+        return 0
+    Event._default_manager.filter(
+        pk__in=[event.pk for event in events]).update(delivered=now())
+    return len(events)
+
+
+def _send_events_in_thread(sink, events):
+    try:
+        return send_events(sink, events)
+    finally:
+        connections.close_all()
+
+
+def relay_events(sink, batch_size=100, workers=1):
+    '''
+    Delivers up to *batch_size* undelivered events to *sink* in the order
+    they were written, split in up to *workers* parallel sends. The events
+    of a payment are always sent together and in order.
+
+    Returns the numbers of delivered and failed events.
+    '''
+    Event = get_outbox_model()
+    events = list(Event._default_manager.filter(
+        delivered__isnull=True).order_by('pk')[:batch_size])
+    chunks = [[] for i in range(workers)]
+    for event in events:
+        key = zlib.crc32(event.token.encode('utf-8')) & 0xffffffff
+        chunks[key % workers].append(event)
+    chunks = [chunk for chunk in chunks if chunk]
+    if len(chunks) <= 1:
+        delivered = sum(send_events(sink, chunk) for chunk in chunks)
+    else:
+        pool = ThreadPool(len(chunks))
+        try:
+            delivered = sum(pool.map(
+                partial(_send_events_in_thread, sink), chunks))
+        finally:
+            pool.close()
+            pool.join()
+    return delivered, len(events) - delivered
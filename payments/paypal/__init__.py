@@ -1,18 +1,18 @@
 from __future__ import unicode_literals
-from datetime import timedelta
 from decimal import Decimal, ROUND_HALF_UP
 from functools import wraps
+import hashlib
 try:
     from itertools import ifilter as filter
 except ImportError:
     pass
 import json
 import logging
+import threading
+import time
 
 from django.http import HttpResponseForbidden
 from django.shortcuts import redirect
-from django.utils import timezone
-import requests
 from requests.exceptions import HTTPError
 
 from .forms import PaymentForm
@@ -24,11 +24,94 @@ logger = logging.getLogger(__name__)
 
 CENTS = Decimal('0.01')
 
+#: Payment statuses of the states of PayPal sales, authorizations and
+#: captures
+STATUSES = {
+    'completed': PaymentStatus.CONFIRMED,
+    'authorized': PaymentStatus.PREAUTH,
+    'captured': PaymentStatus.CONFIRMED,
+    'denied': PaymentStatus.REJECTED,
+    'failed': PaymentStatus.REJECTED,
+    'expired': PaymentStatus.REJECTED,
+    'voided': PaymentStatus.REFUNDED,
+    'refunded': PaymentStatus.REFUNDED}
+
 
 class UnauthorizedRequest(Exception):
     pass
 
 
+class AccessTokenCache(object):
+    '''
+    Process-wide store of OAuth access tokens.
+
+    Tokens are kept in memory, or in the Django cache named *cache_alias* so
+    that all worker processes share a single token.
+    '''
+    refresh_lock_timeout = 30
+
+    def __init__(self, cache_alias=None):
+        self.cache_alias = cache_alias
+        self._tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _get_cache(self):
+        from django.core.cache import caches
+        return caches[self.cache_alias]
+
+    def get(self, key):
+        if self.cache_alias:
+            return self._get_cache().get(key)
+        return self._tokens.get(key)
+
+    def set(self, key, token):
+        if self.cache_alias:
+            timeout = max(int(token['expires_at'] - time.time()), 1)
+            self._get_cache().set(key, token, timeout)
+        else:
+            self._tokens[key] = token
+
+    def delete(self, key):
+        if self.cache_alias:
+            self._get_cache().delete(key)
+        else:
+            self._tokens.pop(key, None)
+
+    def acquire(self, key, blocking=True):
+        '''
+        Claim the right to fetch a new token for *key*.
+
+        With a Django cache backend the claim is shared by all processes and
+        never blocks; a process that fails to claim it fetches its own token
+        only when it has none left.
+        '''
+        if self.cache_alias:
+            return self._get_cache().add(
+                key + ':refresh', 1, self.refresh_lock_timeout)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        return lock.acquire(blocking)
+
+    def release(self, key):
+        if self.cache_alias:
+            self._get_cache().delete(key + ':refresh')
+        else:
+            self._locks[key].release()
+
+
+TOKEN_CACHES = {}
+
+
+def get_token_cache(cache_alias=None):
+    '''
+    Return the AccessTokenCache shared by all providers using *cache_alias*.
+    '''
+    if cache_alias not in TOKEN_CACHES:
+        TOKEN_CACHES[cache_alias] = AccessTokenCache(cache_alias)
+    return TOKEN_CACHES[cache_alias]
+
+
 def authorize(fun):
     @wraps(fun)
     def wrapper(*args, **kwargs):
@@ -39,12 +122,7 @@ def authorize(fun):
             response = fun(*args, **kwargs)
         except HTTPError as e:
             if e.response.status_code == 401:
-                last_auth_response = self.get_last_response(
-                    payment, is_auth=True)
-                if 'access_token' in last_auth_response:
-                    del last_auth_response['access_token']
-                    self.set_response_data(
-                        payment, last_auth_response, is_auth=True)
+                self.reset_access_token(self.access_token)
                 self.access_token = self.get_access_token(payment)
                 response = fun(*args, **kwargs)
             else:
@@ -57,12 +135,26 @@ def authorize(fun):
 class PaypalProvider(BasicProvider):
     '''
     paypal.com payment provider
+
+    token_cache:
+        name of the Django cache used to share OAuth tokens between
+        processes, tokens are only shared within the process by default
+    token_refresh_margin:
+        number of seconds before expiry when a token gets refreshed
     '''
+    indexed_attrs = ('payer_info__payer_id', 'payer_info__email')
+
     def __init__(self, client_id, secret,
-                 endpoint='https://api.sandbox.paypal.com', **kwargs):
+                 endpoint='https://api.sandbox.paypal.com', token_cache=None,
+                 token_refresh_margin=300, **kwargs):
         self.secret = secret
         self.client_id = client_id
         self.endpoint = endpoint
+        self.token_cache = get_token_cache(token_cache)
+        self.token_cache_key = 'payments-paypal-token-%s' % (
+            hashlib.sha1(('%s %s' % (endpoint, client_id)).encode(
+                'utf-8')).hexdigest(),)
+        self.token_refresh_margin = token_refresh_margin
         self.oauth2_url = self.endpoint + '/v1/oauth2/token'
         self.payments_url = self.endpoint + '/v1/payments/payment'
         self.payment_execute_url = self.payments_url + '/%(id)s/execute/'
@@ -71,7 +163,7 @@ class PaypalProvider(BasicProvider):
         super(PaypalProvider, self).__init__(**kwargs)
 
     def set_response_data(self, payment, response, is_auth=False):
-        extra_data = json.loads(payment.extra_data or '{}')
+        extra_data = {}
         if is_auth:
             extra_data['auth_response'] = response
         else:
@@ -79,26 +171,21 @@ class PaypalProvider(BasicProvider):
             if 'links' in response:
                 extra_data['links'] = dict(
                     (link['rel'], link) for link in response['links'])
-        payment.extra_data = json.dumps(extra_data)
+        payment.update_extra_data(extra_data)
 
     def set_response_links(self, payment, response):
         transaction = response['transactions'][0]
         related_resources = transaction['related_resources'][0]
         resource_key = 'sale' if self._capture else 'authorization'
         links = related_resources[resource_key]['links']
-        extra_data = json.loads(payment.extra_data or '{}')
-        extra_data['links'] = dict((link['rel'], link) for link in links)
-        payment.extra_data = json.dumps(extra_data)
+        payment.update_extra_data({
+            'links': dict((link['rel'], link) for link in links)})
 
     def set_error_data(self, payment, error):
-        extra_data = json.loads(payment.extra_data or '{}')
-        extra_data['error'] = error
-        payment.extra_data = json.dumps(extra_data)
+        payment.update_extra_data({'error': error})
 
     def _get_links(self, payment):
-        extra_data = json.loads(payment.extra_data or '{}')
-        links = extra_data.get('links', {})
-        return links
+        return payment.get_extra_data().get('links', {})
 
     @authorize
     def post(self, payment, *args, **kwargs):
@@ -107,7 +194,7 @@ class PaypalProvider(BasicProvider):
             'Authorization': self.access_token}
         if 'data' in kwargs:
             kwargs['data'] = json.dumps(kwargs['data'])
-        response = requests.post(*args, **kwargs)
+        response = self.session.post(*args, **kwargs)
         try:
             data = response.json()
         except ValueError:
@@ -131,34 +218,86 @@ class PaypalProvider(BasicProvider):
             self.set_response_data(payment, data)
         return data
 
+    @authorize
+    def get(self, payment, url):
+        response = self.session.get(url, headers={
+            'Content-Type': 'application/json',
+            'Authorization': self.access_token})
+        response.raise_for_status()
+        return response.json()
+
     def get_last_response(self, payment, is_auth=False):
-        extra_data = json.loads(payment.extra_data or '{}')
+        extra_data = payment.get_extra_data()
         if is_auth:
             return extra_data.get('auth_response', {})
         return extra_data.get('response', {})
 
-    def get_access_token(self, payment):
-        last_auth_response = self.get_last_response(payment, is_auth=True)
-        created = payment.created
-        now = timezone.now()
-        if ('access_token' in last_auth_response and
-                'expires_in' in last_auth_response and
-                (created + timedelta(
-                    seconds=last_auth_response['expires_in'])) > now):
-            return '%s %s' % (last_auth_response['token_type'],
-                              last_auth_response['access_token'])
-        else:
-            headers = {'Accept': 'application/json',
-                       'Accept-Language': 'en_US'}
-            post = {'grant_type': 'client_credentials'}
-            response = requests.post(self.oauth2_url, data=post,
+    def _get_authorization(self, token):
+        return '%s %s' % (token['token_type'], token['access_token'])
+
+    def _fetch_access_token(self):
+        headers = {'Accept': 'application/json',
+                   'Accept-Language': 'en_US'}
+        post = {'grant_type': 'client_credentials'}
+        requested = time.time()
+        response = self.session.post(self.oauth2_url, data=post,
                                      headers=headers,
                                      auth=(self.client_id, self.secret))
-            response.raise_for_status()
-            data = response.json()
-            last_auth_response.update(data)
-            self.set_response_data(payment, last_auth_response, is_auth=True)
-            return '%s %s' % (data['token_type'], data['access_token'])
+        response.raise_for_status()
+        data = response.json()
+        token = {
+            'token_type': data['token_type'],
+            'access_token': data['access_token'],
+            'expires_at': requested + data.get('expires_in', 0)}
+        self.token_cache.set(self.token_cache_key, token)
+        return token
+
+    def get_access_token(self, payment=None):
+        '''
+        Return the authorization header value for the cached OAuth token,
+        fetching a new token when needed.
+
+        A token that is about to expire is refreshed by a single caller while
+        the others keep using it.
+        '''
+        key = self.token_cache_key
+        token = self.token_cache.get(key)
+        now = time.time()
+        if token and token['expires_at'] > now:
+            if token['expires_at'] - self.token_refresh_margin > now:
+                return self._get_authorization(token)
+            if self.token_cache.acquire(key, blocking=False):
+                try:
+                    token = self._fetch_access_token()
+                except Exception:
+                    logger.warning(
+                        'Paypal access token refresh failed', exc_info=True)
+                finally:
+                    self.token_cache.release(key)
+            return self._get_authorization(token)
+        if self.token_cache.acquire(key):
+            try:
+                token = self.token_cache.get(key)
+                if not token or token['expires_at'] <= time.time():
+                    token = self._fetch_access_token()
+            finally:
+                self.token_cache.release(key)
+        else:
+            token = self._fetch_access_token()
+        return self._get_authorization(token)
+
+    def reset_access_token(self, authorization=None):
+        '''
+        Drop the cached OAuth token.
+
+        When *authorization* is given the token is only dropped if it still
+        is the one rejected by PayPal, not one already refreshed by another
+        caller.
+        '''
+        token = self.token_cache.get(self.token_cache_key)
+        if token and (authorization is None or
+                      self._get_authorization(token) == authorization):
+            self.token_cache.delete(self.token_cache_key)
 
     def get_transactions_items(self, payment):
         for purchased_item in payment.get_purchased_items():
@@ -214,27 +353,53 @@ class PaypalProvider(BasicProvider):
         payment.change_status(PaymentStatus.WAITING)
         raise RedirectNeeded(redirect_to['href'])
 
+    supports_phased_callbacks = True
+
     def process_data(self, payment, request):
-        success_url = payment.get_success_url()
+        response = self.validate_callback(payment, request)
+        if response is not None:
+            return response
+        executed_payment = self.fetch_callback_data(payment, request)
+        return self.apply_callback_data(payment, request, executed_payment)
+
+    def validate_callback(self, payment, request):
         if not 'token' in request.GET:
             return HttpResponseForbidden('FAILED')
+
+    def fetch_callback_data(self, payment, request):
         payer_id = request.GET.get('PayerID')
-        if not payer_id:
+        if payer_id:
+            return self.execute_payment(payment, payer_id)
+
+    def apply_callback_data(self, payment, request, executed_payment):
+        success_url = payment.get_success_url()
+        if executed_payment is None:
             if payment.status != PaymentStatus.CONFIRMED:
-                payment.change_status(PaymentStatus.REJECTED)
+                payment.transition_status(PaymentStatus.REJECTED)
                 return redirect(payment.get_failure_url())
             else:
                 return redirect(success_url)
-        executed_payment = self.execute_payment(payment, payer_id)
+        self.set_response_data(payment, executed_payment)
         self.set_response_links(payment, executed_payment)
         payment.attrs.payer_info = executed_payment['payer']['payer_info']
         if self._capture:
-            payment.captured_amount = payment.total
-            payment.change_status(PaymentStatus.CONFIRMED)
+            payment.transition_status(
+                PaymentStatus.CONFIRMED, captured_amount=payment.total)
         else:
-            payment.change_status(PaymentStatus.PREAUTH)
+            payment.transition_status(PaymentStatus.PREAUTH)
+        # the response is saved even if a concurrent callback won
+        payment.save()
         return redirect(success_url)
 
+    supports_status_sync = True
+
+    def get_payment_status(self, payment):
+        links = self._get_links(payment)
+        if 'self' not in links:
+            return None
+        resource = self.get(payment, links['self']['href'])
+        return STATUSES.get(resource.get('state'))
+
     def create_payment(self, payment, extra_data=None):
         product_data = self.get_product_data(payment, extra_data)
         payment = self.post(payment, self.payments_url, data=product_data)
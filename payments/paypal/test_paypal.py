@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 import json
+import time
 from decimal import Decimal
 from unittest import TestCase
 try:
@@ -7,10 +8,9 @@ try:
 except ImportError:
     from mock import patch, MagicMock
 
-from django.utils import timezone
 from requests import HTTPError
 
-from . import PaypalProvider, PaypalCardProvider
+from . import PaypalProvider, PaypalCardProvider, TOKEN_CACHES
 from .. import RedirectNeeded, PaymentError, PaymentStatus
 from ..testcommon import create_test_payment
 
@@ -40,9 +40,10 @@ class TestPaypalProvider(TestCase):
     def setUp(self):
         self.payment = Payment()
         self.provider = PaypalProvider(secret=SECRET, client_id=CLIENT_ID)
+        self.provider.reset_access_token()
 
     def test_provider_raises_redirect_needed_on_success(self):
-        with patch('requests.post') as mocked_post:
+        with patch('requests.Session.post') as mocked_post:
             transaction_id = '1234'
             data = MagicMock()
             data.return_value = {
@@ -62,7 +63,7 @@ class TestPaypalProvider(TestCase):
         self.assertEqual(self.payment.captured_amount, Decimal('0'))
         self.assertEqual(self.payment.transaction_id, transaction_id)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_provider_captures_payment(self, mocked_post):
         data = MagicMock()
         data.return_value = {
@@ -76,7 +77,7 @@ class TestPaypalProvider(TestCase):
         self.provider.capture(self.payment)
         self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_provider_handles_captured_payment(self, mocked_post):
         data = MagicMock()
         data.return_value = {
@@ -87,7 +88,7 @@ class TestPaypalProvider(TestCase):
         self.provider.capture(self.payment)
         self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_provider_refunds_payment(self, mocked_post):
         data = MagicMock()
         data.return_value = {
@@ -100,7 +101,7 @@ class TestPaypalProvider(TestCase):
         self.provider.refund(self.payment)
         self.assertEqual(self.payment.status, PaymentStatus.REFUNDED)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch('payments.paypal.redirect')
     def test_provider_redirects_on_success_captured_payment(
             self, mocked_redirect, mocked_post):
@@ -126,7 +127,7 @@ class TestPaypalProvider(TestCase):
         self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
         self.assertEqual(self.payment.captured_amount, self.payment.total)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch('payments.paypal.redirect')
     def test_provider_redirects_on_success_preauth_payment(
             self, mocked_redirect, mocked_post):
@@ -154,6 +155,57 @@ class TestPaypalProvider(TestCase):
         self.assertEqual(self.payment.status, PaymentStatus.PREAUTH)
         self.assertEqual(self.payment.captured_amount, Decimal('0'))
 
+    @patch('requests.Session.post')
+    @patch('payments.paypal.redirect')
+    def test_provider_applies_executed_payment_to_reloaded_payment(
+            self, mocked_redirect, mocked_post):
+        data = MagicMock()
+        data.return_value = {
+            'token_type': 'test_token_type',
+            'access_token': 'test_access_token',
+            'payer': {'payer_info': 'test123'},
+            'transactions': [
+                {'related_resources': [{
+                    'sale': {'links': ''},
+                    'authorization': {'links': ''}}]}
+            ]}
+        post = MagicMock()
+        post.json = data
+        post.status_code = 200
+        mocked_post.return_value = post
+
+        request = MagicMock()
+        request.GET = {'token': 'test', 'PayerID': '1234'}
+        self.assertIsNone(
+            self.provider.validate_callback(self.payment, request))
+        executed_payment = self.provider.fetch_callback_data(
+            self.payment, request)
+        reloaded_payment = Payment()
+        self.provider.apply_callback_data(
+            reloaded_payment, request, executed_payment)
+
+        self.assertEqual(reloaded_payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(reloaded_payment.attrs.payer_info, 'test123')
+        self.assertEqual(
+            reloaded_payment.get_extra_data()['response'], executed_payment)
+
+    @patch('payments.paypal.redirect')
+    def test_callback_losing_the_race_keeps_status(self, mocked_redirect):
+        executed_payment = {
+            'payer': {'payer_info': 'test123'},
+            'transactions': [{'related_resources': [{
+                'sale': {'links': ''}, 'authorization': {'links': ''}}]}]}
+        payment = Payment()
+        payment.status = PaymentStatus.REFUNDED
+        request = MagicMock()
+        with patch.object(Payment, 'save') as mocked_save:
+            self.provider.apply_callback_data(
+                payment, request, executed_payment)
+        self.assertEqual(payment.status, PaymentStatus.REFUNDED)
+        self.assertEqual(payment.captured_amount, Decimal('0'))
+        # the response is still saved
+        self.assertTrue(mocked_save.called)
+
     @patch('payments.paypal.redirect')
     def test_provider_request_without_payerid_redirects_on_failure(
             self, mocked_redirect):
@@ -162,7 +214,7 @@ class TestPaypalProvider(TestCase):
         self.provider.process_data(self.payment, request)
         self.assertEqual(self.payment.status, PaymentStatus.REJECTED)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_provider_renews_access_token(self, mocked_post):
         new_token = 'new_test_token'
         response401 = MagicMock()
@@ -175,15 +227,98 @@ class TestPaypalProvider(TestCase):
         mocked_post.side_effect = [
             HTTPError(response=response401), response, response]
 
-        self.payment.created = timezone.now()
-        self.payment.extra_data = json.dumps({
-            'auth_response': {
-                'access_token': 'expired_token',
-                'token_type': 'token type',
-                'expires_in': 99999}})
+        self.provider.token_cache.set(self.provider.token_cache_key, {
+            'access_token': 'expired_token',
+            'token_type': 'token type',
+            'expires_at': time.time() + 99999})
         self.provider.create_payment(self.payment)
-        payment_response = json.loads(self.payment.extra_data)['auth_response']
-        self.assertEqual(payment_response['access_token'], new_token)
+        token = self.provider.token_cache.get(self.provider.token_cache_key)
+        self.assertEqual(token['access_token'], new_token)
+
+    @patch('requests.Session.post')
+    def test_access_token_is_shared_by_payments(self, mocked_post):
+        data = MagicMock()
+        data.return_value = {
+            'access_token': 'token', 'token_type': 'Bearer',
+            'expires_in': 3600}
+        response = MagicMock()
+        response.json = data
+        response.status_code = 200
+        mocked_post.return_value = response
+        provider = PaypalProvider(secret=SECRET, client_id=CLIENT_ID)
+        self.assertEqual(
+            self.provider.get_access_token(Payment()), 'Bearer token')
+        self.assertEqual(provider.get_access_token(Payment()), 'Bearer token')
+        self.assertEqual(mocked_post.call_count, 1)
+
+    @patch('requests.Session.post')
+    def test_expiring_access_token_is_refreshed_by_single_caller(
+            self, mocked_post):
+        key = self.provider.token_cache_key
+        self.provider.token_cache.set(key, {
+            'access_token': 'old', 'token_type': 'Bearer',
+            'expires_at': time.time() + 60})
+        self.assertTrue(self.provider.token_cache.acquire(key))
+        try:
+            authorization = self.provider.get_access_token(self.payment)
+        finally:
+            self.provider.token_cache.release(key)
+        self.assertEqual(authorization, 'Bearer old')
+        self.assertFalse(mocked_post.called)
+
+        data = MagicMock()
+        data.return_value = {
+            'access_token': 'new', 'token_type': 'Bearer', 'expires_in': 3600}
+        response = MagicMock()
+        response.json = data
+        mocked_post.return_value = response
+        authorization = self.provider.get_access_token(self.payment)
+        self.assertEqual(authorization, 'Bearer new')
+
+    def test_reset_keeps_refreshed_access_token(self):
+        key = self.provider.token_cache_key
+        self.provider.token_cache.set(key, {
+            'access_token': 'new', 'token_type': 'Bearer',
+            'expires_at': time.time() + 3600})
+        self.provider.reset_access_token('Bearer old')
+        self.assertEqual(
+            self.provider.token_cache.get(key)['access_token'], 'new')
+        self.provider.reset_access_token('Bearer new')
+        self.assertIsNone(self.provider.token_cache.get(key))
+
+    @patch('requests.Session.post')
+    def test_access_token_in_django_cache(self, mocked_post):
+        data = MagicMock()
+        data.return_value = {
+            'access_token': 'token', 'token_type': 'Bearer',
+            'expires_in': 3600}
+        response = MagicMock()
+        response.json = data
+        mocked_post.return_value = response
+        provider = PaypalProvider(
+            secret=SECRET, client_id=CLIENT_ID, token_cache='default')
+        provider.reset_access_token()
+        provider.get_access_token(self.payment)
+        TOKEN_CACHES.pop('default')
+        provider = PaypalProvider(
+            secret=SECRET, client_id=CLIENT_ID, token_cache='default')
+        self.assertEqual(provider.get_access_token(), 'Bearer token')
+        self.assertEqual(mocked_post.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_provider_gets_payment_status(self, mocked_get):
+        self.payment.extra_data = json.dumps({'links': {
+            'self': {'href': 'http://sale.com'}}})
+        self.provider.token_cache.set(self.provider.token_cache_key, {
+            'access_token': 'token', 'token_type': 'Bearer',
+            'expires_at': time.time() + 3600})
+        mocked_get.return_value.json.return_value = {'state': 'completed'}
+        self.assertEqual(
+            self.provider.get_payment_status(self.payment),
+            PaymentStatus.CONFIRMED)
+        self.assertEqual(mocked_get.call_args[0], ('http://sale.com',))
+        mocked_get.return_value.json.return_value = {'state': 'pending'}
+        self.assertIsNone(self.provider.get_payment_status(self.payment))
 
 
 class TestPaypalCardProvider(TestCase):
@@ -191,9 +326,10 @@ class TestPaypalCardProvider(TestCase):
     def setUp(self):
         self.payment = Payment(extra_data='')
         self.provider = PaypalCardProvider(secret=SECRET, client_id=CLIENT_ID)
+        self.provider.reset_access_token()
 
     def test_provider_raises_redirect_needed_on_success_captured_payment(self):
-        with patch('requests.post') as mocked_post:
+        with patch('requests.Session.post') as mocked_post:
             transaction_id = '1234'
             data = MagicMock()
             data.return_value = {
@@ -223,7 +359,7 @@ class TestPaypalCardProvider(TestCase):
     def test_provider_raises_redirect_needed_on_success_preauth_payment(self):
         provider = PaypalCardProvider(
             secret=SECRET, client_id=CLIENT_ID, capture=False)
-        with patch('requests.post') as mocked_post:
+        with patch('requests.Session.post') as mocked_post:
             transaction_id = '1234'
             data = MagicMock()
             data.return_value = {
@@ -253,7 +389,7 @@ class TestPaypalCardProvider(TestCase):
         self.assertTrue('refund' in links)
 
     def test_form_shows_validation_error_message(self):
-        with patch('requests.post') as mocked_post:
+        with patch('requests.Session.post') as mocked_post:
             error_message = 'error message'
             data = MagicMock()
             data.return_value = {'details': [{'issue': error_message}]}
@@ -267,7 +403,7 @@ class TestPaypalCardProvider(TestCase):
         self.assertEqual(form.errors['__all__'][0], error_message)
 
     def test_form_shows_internal_error_message(self):
-        with patch('requests.post') as mocked_post:
+        with patch('requests.Session.post') as mocked_post:
             error_message = 'error message'
             data = MagicMock()
             data.return_value = {
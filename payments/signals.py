@@ -1,5 +1,121 @@
+from __future__ import unicode_literals
+import threading
+import weakref
+
+from django.conf import settings
+from django.db import router, transaction
 from django.dispatch import Signal
 
 # Signal sent whenever status is changed for a Payment. This usually happens
 # when a transaction is either accepted or rejected.
 status_changed = Signal()
+
+# Signal sent with the list of payments (``instances``) whose status changed,
+# once per transaction when PAYMENT_SIGNAL_DELIVERY is 'on_commit' and with a
+# single payment after each change when it is 'immediate'.
+bulk_status_changed = Signal()
+
+_batches = threading.local()
+
+
+def get_signal_delivery():
+    '''
+    Returns the PAYMENT_SIGNAL_DELIVERY setting: 'immediate' sends the
+    signals right after the change, 'on_commit' once the transaction is
+    committed.
+    '''
+    delivery = getattr(settings, 'PAYMENT_SIGNAL_DELIVERY', 'immediate')
+    if delivery not in ('immediate', 'on_commit'):
+        raise ValueError('Unknown signal delivery: %r' % (delivery,))
+    return delivery
+
+
+class StatusChangeBatch(object):
+    '''
+    Status changes made within a transaction, delivered on commit. Changes
+    made in a savepoint that was rolled back are left out.
+    '''
+    def __init__(self):
+        self.events = []
+        self.pending = True
+
+    def add(self, sender, instance, hook):
+        self.events.append((sender, instance, weakref.ref(hook)))
+
+    def __call__(self):
+        self.pending = False
+        deliver_status_changes([
+            (sender, instance) for sender, instance, hook in self.events
+            if hook() is not None])
+
+
+class CommitHook(object):
+    '''
+    Runs a batch once registered with on_commit. Django drops the hooks of a
+    transaction or savepoint that is rolled back, which frees it.
+    '''
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __call__(self):
+        self.batch()
+
+
+class ChangeHook(object):
+    '''
+    Registered with on_commit for a change added to a batch, it is freed
+    like CommitHook when the savepoint of the change is rolled back.
+    '''
+    def __call__(self):
+        pass
+
+
+def deliver_status_changes(events):
+    '''
+    Sends status_changed for each (sender, instance) event, then
+    bulk_status_changed once per sender with its changed instances.
+    '''
+    senders = []
+    instances = {}
+    for sender, instance in events:
+        status_changed.send(sender=sender, instance=instance)
+        if sender not in instances:
+            senders.append(sender)
+            instances[sender] = []
+        if not any(other is instance for other in instances[sender]):
+            instances[sender].append(instance)
+    for sender in senders:
+        bulk_status_changed.send(sender=sender, instances=instances[sender])
+
+
+def get_pending_batch(using):
+    '''
+    Returns the batch of the current transaction on *using* waiting for the
+    commit, None once it was delivered or rolled back
+    '''
+    batch, hook = getattr(_batches, 'batches', {}).get(using, (None, None))
+    if batch is not None and batch.pending and hook() is not None:
+        return batch
+    return None
+
+
+def send_status_changed(sender, instance):
+    '''
+    Delivers the status change of *instance* according to
+    PAYMENT_SIGNAL_DELIVERY.
+    '''
+    using = router.db_for_write(sender, instance=instance)
+    if (get_signal_delivery() == 'immediate' or
+            not transaction.get_connection(using).in_atomic_block):
+        deliver_status_changes([(sender, instance)])
+        return
+    batch = get_pending_batch(using)
+    if batch is None:
+        batch = StatusChangeBatch()
+        hook = CommitHook(batch)
+        _batches.__dict__.setdefault('batches', {})[using] = (
+            batch, weakref.ref(hook))
+    else:
+        hook = ChangeHook()
+    batch.add(sender, instance, hook)
+    transaction.on_commit(hook, using=using)
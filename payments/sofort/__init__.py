@@ -4,12 +4,24 @@ from django.http import HttpResponseForbidden
 from django.shortcuts import redirect
 from django.template.loader import render_to_string
 from django.utils.translation import get_language
-import requests
 import xmltodict
 
 from .. import RedirectNeeded, PaymentError, PaymentStatus
 from ..core import BasicProvider
 
+STATUSES = {
+    'loss': PaymentStatus.REJECTED,
+    'refunded': PaymentStatus.REFUNDED}
+
+
+def get_error_message(refund):
+    errors = (refund.get('errors') or {}).get('error') or []
+    if isinstance(errors, dict):
+        errors = [errors]
+    return '; '.join(
+        '%s: %s' % (error.get('code'), error.get('message'))
+        for error in errors) or 'Refund %s' % (refund.get('status'),)
+
 
 class SofortProvider(BasicProvider):
 
@@ -21,12 +33,15 @@ class SofortProvider(BasicProvider):
              'endpoint', 'https://api.sofort.com/api/xml')
         super(SofortProvider, self).__init__(*args, **kwargs)
 
-    def post_request(self, xml_request):
-        response = requests.post(
+    def send_request(self, xml_request, **kwargs):
+        return self.session.post(
             self.endpoint,
             data=xml_request.encode('utf-8'),
             headers={'Content-Type': 'application/xml; charset=UTF-8'},
-            auth=(self.client_id, self.secret))
+            auth=(self.client_id, self.secret), **kwargs)
+
+    def post_request(self, xml_request):
+        response = self.send_request(xml_request)
         doc = xmltodict.parse(response.content)
         return doc, response
 
@@ -54,27 +69,42 @@ class SofortProvider(BasicProvider):
                         doc['errors']['error']['field'],
                         doc['errors']['error']['message']))
 
+    supports_phased_callbacks = True
+
     def process_data(self, payment, request):
+        response = self.validate_callback(payment, request)
+        if response is not None:
+            return response
+        doc = self.fetch_callback_data(payment, request)
+        return self.apply_callback_data(payment, request, doc)
+
+    def validate_callback(self, payment, request):
         if not 'trans' in request.GET:
             return HttpResponseForbidden('FAILED')
-        transaction_id = request.GET.get('trans')
-        payment.transaction_id = transaction_id
+
+    def fetch_callback_data(self, payment, request):
         transaction_request = render_to_string(
             'payments/sofort/transaction_request.xml',
-            {'transactions': [transaction_id]})
+            {'transactions': [request.GET.get('trans')]})
         doc, response = self.post_request(transaction_request)
+        return doc
+
+    def apply_callback_data(self, payment, request, doc):
+        payment.transaction_id = request.GET.get('trans')
         try:
             # If there is a transaction and status returned,
             # the payment was successful
             status = doc['transactions']['transaction_details']['status']
         except KeyError:
             # Payment Failed
-            payment.change_status(PaymentStatus.REJECTED)
+            payment.transition_status(PaymentStatus.REJECTED)
+            payment.save()
             return redirect(payment.get_failure_url())
         else:
-            payment.captured_amount = payment.total
-            payment.change_status(PaymentStatus.CONFIRMED)
-            payment.extra_data = json.dumps(doc)
+            # a concurrent callback may have confirmed it already
+            payment.transition_status(
+                PaymentStatus.CONFIRMED, captured_amount=payment.total)
+            payment.set_extra_data(doc)
             # overwriting names should not be possible
             #sender_data = doc['transactions']['transaction_details']['sender']
             #holder_data = sender_data['holder']
@@ -85,10 +115,80 @@ class SofortProvider(BasicProvider):
             payment.save()
             return redirect(payment.get_success_url())
 
+    supports_status_sync = True
+    #: largest number of transactions the API accepts in a
+    #: transaction_request
+    max_transactions = 100
+    status_batch_size = max_transactions
+
+    def iter_transaction_details(self, transaction_ids):
+        '''
+        Yields the transaction_details of the given transactions, querying
+        up to max_transactions of them with each request. Each response is
+        parsed from the stream as it is read, without keeping the whole
+        document, but its details are only yielded once the request is
+        finished and known not to have failed.
+
+        Raises PaymentError if a request fails or is answered with an
+        errors document.
+        '''
+        transaction_ids = list(transaction_ids)
+        for start in range(0, len(transaction_ids), self.max_transactions):
+            transaction_request = render_to_string(
+                'payments/sofort/transaction_request.xml', {
+                    'transactions': transaction_ids[
+                        start:start + self.max_transactions]})
+            details = []
+            errors = []
+
+            def add_details(path, item):
+                if path[-1][0] == 'transaction_details':
+                    details.append(item)
+                elif path[0][0] == 'errors' and path[-1][0] == 'error':
+                    errors.append(item)
+                return True
+
+            response = self.send_request(transaction_request, stream=True)
+            try:
+                if not 200 <= response.status_code < 300:
+                    raise PaymentError(
+                        'Transaction request failed with status %d' % (
+                            response.status_code,),
+                        code=response.status_code)
+                response.raw.decode_content = True
+                xmltodict.parse(
+                    response.raw, item_depth=2, item_callback=add_details)
+            finally:
+                response.close()
+            if errors:
+                raise PaymentError(
+                    'Transaction request failed',
+                    gateway_message=get_error_message({'errors': {
+                        'error': errors}}))
+            for detail in details:
+                yield detail
+
+    def get_payment_status(self, payment):
+        return self.get_payment_statuses([payment]).get(payment.pk)
+
+    def get_payment_statuses(self, payments):
+        pks = dict(
+            (payment.transaction_id, payment.pk) for payment in payments
+            if payment.transaction_id)
+        statuses = {}
+        for detail in self.iter_transaction_details(sorted(pks)):
+            pk = pks.get(detail.get('transaction'))
+            if pk is not None:
+                # like in process_data any returned status means the
+                # payment went through
+                statuses[pk] = STATUSES.get(
+                    detail.get('status'), PaymentStatus.CONFIRMED)
+        return statuses
+
     def refund(self, payment, amount=None):
         if amount is None:
             amount = payment.captured_amount
-        doc = json.loads(payment.extra_data)
+        doc = payment.get_extra_data()
         sender_data = doc['transactions']['transaction_details']['sender']
         refund_request = render_to_string(
             'payments/sofort/refund_transaction.xml', {
@@ -106,3 +206,48 @@ class SofortProvider(BasicProvider):
         payment.message = json.dumps(doc)
         payment.change_status(PaymentStatus.REFUNDED)
         return amount
+
+    refund_batch_size = 100
+
+    def refund_payments(self, payments):
+        '''
+        Raises PaymentError if the request fails or is answered with an
+        errors document, none of the payments is then refunded.
+        '''
+        payments = list(payments)
+        refund_request = render_to_string(
+            'payments/sofort/refund_transactions.xml', {
+                'title': 'Refund',
+                'refunds': [{
+                    'transaction_id': payment.transaction_id,
+                    'amount': payment.captured_amount,
+                    'comment': 'Refund %s' % (payment.description,)}
+                    for payment in payments]})
+        response = self.send_request(refund_request)
+        if not 200 <= response.status_code < 300:
+            raise PaymentError(
+                'Refund request failed with status %d' % (
+                    response.status_code,),
+                code=response.status_code)
+        doc = xmltodict.parse(response.content) or {}
+        if 'errors' in doc:
+            raise PaymentError(
+                'Refund request failed',
+                gateway_message=get_error_message(doc))
+        refunds = (doc.get('refunds') or {}).get('refund') or []
+        if isinstance(refunds, dict):
+            refunds = [refunds]
+        refunds = dict(
+            (refund.get('transaction'), refund) for refund in refunds)
+        errors = {}
+        for payment in payments:
+            refund = refunds.get(payment.transaction_id)
+            if refund is None:
+                errors[payment.pk] = 'Missing from the response'
+            elif refund.get('status') != 'ok':
+                errors[payment.pk] = get_error_message(refund)
+            else:
+                payment.captured_amount = 0
+                payment.change_status(
+                    PaymentStatus.REFUNDED, json.dumps(refund))
+        return errors
@@ -1,4 +1,5 @@
 from __future__ import unicode_literals
+import io
 import json
 from unittest import TestCase
 try:
@@ -7,7 +8,7 @@ except ImportError:
     from mock import patch, MagicMock
 
 from . import SofortProvider
-from .. import PaymentStatus, RedirectNeeded
+from .. import PaymentError, PaymentStatus, RedirectNeeded
 from ..testcommon import create_test_payment
 
 SECRET = 'abcd1234'
@@ -26,7 +27,7 @@ class TestSofortProvider(TestCase):
             id=CLIENT_ID, project_id=PROJECT_ID, key=SECRET)
 
     @patch('xmltodict.parse')
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_provider_raises_redirect_needed_on_success(
             self, mocked_post, mocked_parser):
         response = MagicMock()
@@ -39,7 +40,7 @@ class TestSofortProvider(TestCase):
             self.provider.get_form(self.payment)
 
     @patch('xmltodict.parse')
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch('payments.sofort.redirect')
     def test_provider_redirects_on_success(
             self, mocked_redirect, mocked_post, mocked_parser):
@@ -59,7 +60,7 @@ class TestSofortProvider(TestCase):
         self.assertEqual(self.payment.transaction_id, transaction_id)
 
     @patch('xmltodict.parse')
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch('payments.sofort.redirect')
     def test_provider_redirects_on_failure(
             self, mocked_redirect, mocked_post, mocked_parser):
@@ -73,7 +74,7 @@ class TestSofortProvider(TestCase):
         self.assertEqual(self.payment.transaction_id, transaction_id)
 
     @patch('xmltodict.parse')
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_provider_refunds_payment(self, mocked_post, mocked_parser):
         self.payment.extra_data = json.dumps({
             'transactions': {
@@ -87,3 +88,104 @@ class TestSofortProvider(TestCase):
         mocked_parser.return_value = {}
         self.provider.refund(self.payment)
         self.assertEqual(self.payment.status, PaymentStatus.REFUNDED)
+
+    @patch('requests.Session.post')
+    def test_provider_queries_statuses_in_batches(self, mocked_post):
+        self.provider.max_transactions = 2
+        payments = []
+        for pk, transaction_id in [(1, 'a'), (2, 'b'), (3, 'c'), (4, None)]:
+            payment = Payment()
+            payment.pk = pk
+            payment.transaction_id = transaction_id
+            payments.append(payment)
+        responses = [
+            '<transactions>'
+            '<transaction_details><transaction>a</transaction>'
+            '<status>untraceable</status></transaction_details>'
+            '<transaction_details><transaction>b</transaction>'
+            '<status>loss</status></transaction_details>'
+            '</transactions>',
+            '<transactions>'
+            '<transaction_details><transaction>c</transaction>'
+            '<status>refunded</status></transaction_details>'
+            '</transactions>']
+        mocked_post.side_effect = [
+            MagicMock(
+                status_code=200, raw=io.BytesIO(response.encode('utf-8')))
+            for response in responses]
+        statuses = self.provider.get_payment_statuses(payments)
+        self.assertEqual(statuses, {
+            1: PaymentStatus.CONFIRMED, 2: PaymentStatus.REJECTED,
+            3: PaymentStatus.REFUNDED})
+        self.assertEqual(mocked_post.call_count, 2)
+        request = mocked_post.call_args_list[0][1]['data'].decode('utf-8')
+        self.assertIn('<transaction>a</transaction>', request)
+        self.assertIn('<transaction>b</transaction>', request)
+        self.assertTrue(mocked_post.call_args[1]['stream'])
+
+    @patch('requests.Session.post')
+    def test_failed_status_query_raises(self, mocked_post):
+        payment = Payment()
+        payment.pk = 1
+        payment.transaction_id = 'a'
+        mocked_post.return_value = MagicMock(
+            status_code=401, raw=io.BytesIO(b''))
+        with self.assertRaises(PaymentError):
+            self.provider.get_payment_statuses([payment])
+        mocked_post.return_value = MagicMock(status_code=200, raw=io.BytesIO(
+            b'<errors><error><code>1000</code>'
+            b'<message>Invalid request</message></error></errors>'))
+        with self.assertRaises(PaymentError) as context:
+            self.provider.get_payment_statuses([payment])
+        self.assertEqual(
+            context.exception.gateway_message, '1000: Invalid request')
+
+    @patch('requests.Session.post')
+    def test_provider_refunds_payments_in_one_request(self, mocked_post):
+        payments = []
+        for pk, transaction_id in [(1, 'a'), (2, 'b'), (3, 'c')]:
+            payment = Payment()
+            payment.pk = pk
+            payment.transaction_id = transaction_id
+            payment.status = PaymentStatus.CONFIRMED
+            payment.captured_amount = payment.total
+            payments.append(payment)
+        mocked_post.return_value.status_code = 200
+        mocked_post.return_value.content = (
+            '<refunds>'
+            '<refund><transaction>a</transaction><status>ok</status></refund>'
+            '<refund><transaction>b</transaction><status>error</status>'
+            '<errors><error><code>8027</code><message>Invalid amount'
+            '</message></error></errors></refund>'
+            '</refunds>').encode('utf-8')
+        errors = self.provider.refund_payments(payments)
+        self.assertEqual(errors, {
+            2: '8027: Invalid amount', 3: 'Missing from the response'})
+        self.assertEqual(mocked_post.call_count, 1)
+        request = mocked_post.call_args[1]['data'].decode('utf-8')
+        self.assertEqual(request.count('<refund>'), 3)
+        self.assertEqual(payments[0].status, PaymentStatus.REFUNDED)
+        self.assertEqual(payments[0].captured_amount, 0)
+        self.assertEqual(payments[1].status, PaymentStatus.CONFIRMED)
+        self.assertEqual(payments[1].captured_amount, payments[1].total)
+
+    @patch('requests.Session.post')
+    def test_failed_refund_request_raises(self, mocked_post):
+        payment = Payment()
+        payment.pk = 1
+        payment.transaction_id = 'a'
+        payment.status = PaymentStatus.CONFIRMED
+        mocked_post.return_value.status_code = 200
+        mocked_post.return_value.content = (
+            '<errors><error><code>1000</code><message>Invalid request'
+            '</message></error></errors>').encode('utf-8')
+        with self.assertRaises(PaymentError) as context:
+            self.provider.refund_payments([payment])
+        self.assertEqual(
+            context.exception.gateway_message, '1000: Invalid request')
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+        mocked_post.return_value.status_code = 500
+        mocked_post.return_value.content = b'Internal Server Error'
+        with self.assertRaises(PaymentError) as context:
+            self.provider.refund_payments([payment])
+        self.assertEqual(context.exception.code, 500)
@@ -13,13 +13,27 @@ class StripeProvider(BasicProvider):
     form_class = ModalPaymentForm
 
     def __init__(self, public_key, secret_key, image='', name='', **kwargs):
-        stripe.api_key = secret_key
         self.secret_key = secret_key
         self.public_key = public_key
         self.image = image
         self.name = name
         super(StripeProvider, self).__init__(**kwargs)
 
+    def create_charge(self, **params):
+        '''
+        Creates a charge with the secret key of this provider, not the
+        global stripe.api_key, so variants of different accounts can run
+        in the same process.
+        '''
+        return stripe.Charge.create(api_key=self.secret_key, **params)
+
+    def retrieve_charge(self, charge_id):
+        '''
+        Returns a charge, further requests made with it use the secret key
+        of this provider
+        '''
+        return stripe.Charge.retrieve(charge_id, api_key=self.secret_key)
+
     def get_form(self, payment, data=None):
         if payment.status == PaymentStatus.WAITING:
             payment.change_status(PaymentStatus.INPUT)
@@ -33,7 +47,7 @@ class StripeProvider(BasicProvider):
 
     def capture(self, payment, amount=None, final=True):
         amount = int((amount or payment.total) * 100)
-        charge = stripe.Charge.retrieve(payment.transaction_id)
+        charge = self.retrieve_charge(payment.transaction_id)
         try:
             charge.capture(amount=amount)
         except stripe.InvalidRequestError as e:
@@ -43,13 +57,13 @@ class StripeProvider(BasicProvider):
         return Decimal(amount) / 100
 
     def release(self, payment):
-        charge = stripe.Charge.retrieve(payment.transaction_id)
+        charge = self.retrieve_charge(payment.transaction_id)
         charge.refund()
         payment.attrs.release = stripe.util.json.dumps(charge)
 
     def refund(self, payment, amount=None):
         amount = int((amount or payment.total) * 100)
-        charge = stripe.Charge.retrieve(payment.transaction_id)
+        charge = self.retrieve_charge(payment.transaction_id)
         charge.refund(amount=amount)
         payment.attrs.refund = stripe.util.json.dumps(charge)
         return Decimal(amount) / 100
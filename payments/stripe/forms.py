@@ -28,10 +28,9 @@ class StripeFormMixin(object):
 
         if not self.errors:
             if not self.payment.transaction_id:
-                stripe.api_key = self.provider.secret_key
                 _billing_address = self.payment.get_billing_address()
                 try:
-                    self.charge = stripe.Charge.create(
+                    self.charge = self.provider.create_charge(
                         capture=False,
                         amount=int(self.payment.total * 100),
                         currency=self.payment.currency,
@@ -42,7 +41,7 @@ class StripeFormMixin(object):
                 except stripe.CardError as e:
                     # Making sure we retrieve the charge
                     charge_id = e.json_body['error']['charge']
-                    self.charge = stripe.Charge.retrieve(charge_id)
+                    self.charge = self.provider.retrieve_charge(charge_id)
                     # Checking if the charge was fraudulent
                     self._handle_potentially_fraudulent_charge(
                         self.charge, commit=False)
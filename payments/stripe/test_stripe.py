@@ -44,7 +44,7 @@ def mock_stripe_Charge_retrieve(fraudulent=False):
         }
         if fraudulent:
             fraud_details['stripe_report'] = 'fraudulent'
-        mocked_charge_retrieve.side_effect = lambda charge_id: {
+        mocked_charge_retrieve.side_effect = lambda charge_id, **kwargs: {
             'id': charge_id,
             'fraud_details': fraud_details
         }
@@ -147,3 +147,18 @@ class TestStripeProvider(TestCase):
         for field_name in sensitive_fields:
             field = form[field_name]
             self.assertTrue('name=' not in str(field))
+
+    def test_providers_use_their_own_secret_key(self):
+        provider = StripeProvider(
+            name='Example.com store',
+            secret_key=SECRET_KEY, public_key=PUBLIC_KEY)
+        other = StripeProvider(
+            name='Other store', secret_key='5678efgh', public_key='efgh5678')
+        with patch('stripe.util.json.dumps'):
+            with patch('stripe.Charge.retrieve') as mocked_retrieve:
+                provider.refund(Payment())
+                other.refund(Payment())
+        self.assertEqual(
+            [call[1]['api_key'] for call in mocked_retrieve.call_args_list],
+            [SECRET_KEY, '5678efgh'])
+        self.assertNotIn(stripe.api_key, [SECRET_KEY, '5678efgh'])
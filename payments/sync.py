@@ -0,0 +1,134 @@
+'''
+Synchronisation of the status of payments with their gateways.
+
+Payments left waiting, for example when a callback never arrived, are
+looked up at the gateway and moved to the status found there through the
+usual status transitions. Providers able to query many payments with one
+request do so, the others are queried one payment at a time in parallel
+within a rate limit.
+'''
+from __future__ import unicode_literals
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from . import PaymentStatus, get_payment_model
+from .bulk import (
+    BulkResult, format_error, iterate_by_pk, iterate_payments, run_in_bulk)
+from .core import provider_factory
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    '''
+    Spaces the calls of wait() by all threads to at most *rate* per second
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def apply_gateway_status(payment, status):
+    '''
+    Moves *payment* to the *status* reported by its gateway if the current
+    status can move to it. Returns whether the payment changed.
+    '''
+    if status is None or status == payment.status:
+        return False
+    fields = {}
+    if status == PaymentStatus.CONFIRMED and not payment.captured_amount:
+        fields['captured_amount'] = payment.total
+    return payment.transition_status(status, **fields)
+
+
+def sync_payment(payment, rate_limiter=None):
+    '''
+    Queries the gateway for the status of *payment* and applies it
+    '''
+    provider = provider_factory(payment.variant)
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    return apply_gateway_status(payment, provider.get_payment_status(payment))
+
+
+def sync_batch(provider, payments, result, rate_limiter=None):
+    '''
+    Queries the gateway for the status of the list of *payments* with a
+    single request and applies them, the outcome is added to *result*.
+    '''
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    try:
+        statuses = provider.get_payment_statuses(payments)
+    except Exception as e:
+        logger.warning('Status query of %d payments failed', len(payments),
+                       exc_info=True)
+        for payment in payments:
+            result.add(payment, format_error(e))
+        return
+    for payment in payments:
+        try:
+            changed = apply_gateway_status(payment, statuses.get(payment.pk))
+        except Exception as e:
+            logger.warning('Updating payment %s failed', payment.pk,
+                           exc_info=True)
+            result.add(payment, format_error(e))
+        else:
+            result.add(payment, changed=changed)
+
+
+def sync_payments(payments=None, statuses=None, batch_size=1000,
+                  rate_limit=None, variant_rate_limit=None, **kwargs):
+    '''
+    Synchronises the status of payments with their gateways, the waiting
+    ones unless other *statuses* are given, all of them unless a queryset
+    of *payments* is given. Variants whose provider does not support it
+    are left alone.
+
+    Requests to the gateway of a variant are limited to its
+    *variant_rate_limit* entry, or *rate_limit*, per second. Accepts the
+    arguments of run_in_bulk for providers queried one payment at a time.
+    '''
+    variant_rate_limit = variant_rate_limit or {}
+    if payments is None:
+        payments = get_payment_model()._default_manager.all()
+    payments = payments.filter(
+        status__in=list(statuses or [PaymentStatus.WAITING]))
+    variants = sorted(set(
+        payments.order_by().values_list('variant', flat=True).distinct()))
+    result = BulkResult()
+    single = OrderedDict()
+    limiters = {}
+    for variant in variants:
+        try:
+            provider = provider_factory(variant)
+        except ValueError:
+            logger.warning('Skipping unknown variant %s', variant)
+            continue
+        if not provider.supports_status_sync:
+            continue
+        rate = variant_rate_limit.get(variant, rate_limit)
+        limiters[variant] = RateLimiter(rate) if rate else None
+        variant_payments = payments.filter(variant=variant)
+        if provider.status_batch_size:
+            for batch in iterate_by_pk(
+                    variant_payments, provider.status_batch_size):
+                sync_batch(provider, batch, result, limiters[variant])
+        else:
+            single[variant] = iterate_payments(variant_payments, batch_size)
+    if single:
+        result.merge(run_in_bulk(single, lambda payment: sync_payment(
+            payment, limiters[payment.variant]), **kwargs))
+    result.finished = time.time()
+    return result
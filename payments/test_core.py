@@ -1,15 +1,70 @@
 from __future__ import unicode_literals
+from datetime import datetime, timedelta
 from decimal import Decimal
-from unittest import TestCase
+import io
+import itertools
+import json
+import re
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, skipIf
 try:
-    from unittest.mock import patch, NonCallableMock
+    from unittest.mock import patch, Mock, NonCallableMock
 except ImportError:
-    from mock import  patch, NonCallableMock
+    from mock import  patch, Mock, NonCallableMock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from django.apps import apps
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, HttpResponseForbidden
+from django.test import RequestFactory, override_settings
+from django.utils.six import StringIO
 
 from payments import core
+from .bins import (
+    CARD_RANGES, CardClassifier, compile_card_types, get_card_classifier)
+from .cards import is_luhn_valid, validate_card_numbers
+from .callbacks import (
+    claim_callbacks, get_callback_mode, process_callback, process_callbacks,
+    process_phased_callback, run_callback)
+from .bulk import (
+    BulkResult, Checkpoint, iterate_by_pk, refund_payments,
+    release_stale_payments, run_in_bulk)
+from .dedup import LocalStore
+from .dummy import DummyProvider
 from .forms import CreditCardPaymentFormWithName, PaymentForm
-from .models import BasePayment
-from . import PaymentStatus
+from .models import (
+    BaseCallback, BaseOutboxEvent, BasePayment, PaymentQuerySet)
+from .operations import AddAttrIndex
+from .outbox import FileSink, relay_events
+from .signals import bulk_status_changed, status_changed
+from .sync import RateLimiter, apply_gateway_status, sync_payments
+from .tokens import (
+    CompactTokenGenerator, UUID4Generator, UUID7Generator, get_token_generator)
+from .urls import get_process_urls, process_data, static_callback
+from . import CallbackStatus, PaymentError, PaymentStatus
+
+
+class Payment(BasePayment):
+    pass
+
+
+class Callback(BaseCallback):
+    pass
+
+
+class OutboxEvent(BaseOutboxEvent):
+    pass
 
 
 class TestHelpers(TestCase):
@@ -32,6 +87,581 @@ class TestProviderFactory(TestCase):
     def test_provider_does_not_exist(self):
         self.assertRaises(ValueError, core.provider_factory, 'fake_provider')
 
+    def test_providers_are_built_once_and_timed(self):
+        registry = core.ProviderRegistry()
+        variants = {
+            'dummy': ('payments.dummy.DummyProvider', {}),
+            'broken': ('payments.dummy.MissingProvider', {})}
+        with override_settings(PAYMENT_VARIANTS=variants):
+            with patch('payments.core.get_provider_class',
+                       wraps=core.get_provider_class) as mocked_get_class:
+                provider = registry.get('dummy')
+                self.assertIs(registry.get('dummy'), provider)
+                results = registry.warm_up()
+        self.assertEqual(mocked_get_class.call_count, 2)
+        self.assertEqual([result[0] for result in results],
+                         ['broken', 'dummy'])
+        self.assertIsInstance(results[0][2], AttributeError)
+        self.assertEqual(
+            results[1], ('dummy', registry.timings['dummy'], None))
+        self.assertGreaterEqual(registry.timings['dummy'].init_time, 0)
+
+    def test_variants_are_resolved_dynamically(self):
+        resolver = Mock(side_effect=lambda variant: (
+            ('payments.dummy.DummyProvider', {})
+            if variant.startswith('tenant-') else None))
+        registry = core.ProviderRegistry()
+        with override_settings(PAYMENT_VARIANT_RESOLVER=resolver):
+            provider = registry.get('tenant-1')
+            self.assertIs(registry.get('tenant-1'), provider)
+            self.assertEqual(resolver.call_count, 1)
+            self.assertRaises(ValueError, registry.get, 'other')
+            self.assertRaises(ValueError, registry.get, 'other')
+            # unknown variants are not cached, they cannot evict providers
+            self.assertEqual(resolver.call_count, 3)
+            self.assertEqual(sorted(registry.timings), ['tenant-1'])
+            registry.invalidate('tenant-1')
+            self.assertIsNot(registry.get('tenant-1'), provider)
+        self.assertIsInstance(registry.get('default'), DummyProvider)
+
+    @patch('payments.utils.time.time')
+    def test_provider_cache_is_bounded(self, mocked_time):
+        mocked_time.return_value = 100
+        variants = dict(
+            (variant, ('payments.dummy.DummyProvider', {}))
+            for variant in ['a', 'b', 'c'])
+        cache = {'max_size': 2, 'ttl': 60}
+        with override_settings(
+                PAYMENT_VARIANTS=variants, PAYMENT_PROVIDER_CACHE=cache):
+            registry = core.ProviderRegistry()
+            a = registry.get('a')
+            b = registry.get('b')
+            registry.get('a')
+            registry.get('c')
+            self.assertEqual(sorted(registry.timings), ['a', 'c'])
+            for variant in ['junk-1', 'junk-2', 'junk-3']:
+                self.assertRaises(ValueError, registry.get, variant)
+            self.assertEqual(sorted(registry.timings), ['a', 'c'])
+            self.assertIs(registry.get('a'), a)
+            self.assertIsNot(registry.get('b'), b)
+            mocked_time.return_value = 160
+            self.assertIsNot(registry.get('a'), a)
+
+    def test_provider_cache_is_a_dict_of_providers(self):
+        registry = core.ProviderRegistry()
+        cache = core.ProviderCache(registry)
+        provider = registry.get('default')
+        self.assertRaises(ValueError, registry.get, 'other')
+        self.assertIs(cache['default'], provider)
+        self.assertIn('default', cache)
+        self.assertNotIn('other', cache)
+        self.assertEqual(list(cache.items()), [('default', provider)])
+        cache['other'] = provider
+        self.assertIs(registry.get('other'), provider)
+        del cache['other']
+        self.assertRaises(KeyError, cache.__getitem__, 'other')
+
+    @patch('payments.apps.warm_up_providers')
+    def test_providers_are_warmed_up_when_enabled(self, mocked_warm_up):
+        config = apps.get_app_config('payments')
+        config.ready()
+        self.assertFalse(mocked_warm_up.called)
+        with override_settings(PAYMENT_WARM_UP=True):
+            config.ready()
+        mocked_warm_up.assert_called_once_with()
+
+    def test_warm_up_command_reports_timings(self):
+        output = StringIO()
+        with patch.object(core, 'registry', core.ProviderRegistry()):
+            call_command('warm_up_providers', 'default', stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('default '))
+
+
+class TestCardClassifier(TestCase):
+
+    def test_ranges_match_card_patterns(self):
+        numbers = [''.join(digits) for digits in itertools.product(
+            '0123456789', repeat=2)]
+        numbers += ['1800', '2131', '6011', '6304', '6390', '3005', '3060']
+        for prefix in numbers:
+            for length in range(10, 21):
+                number = (prefix + '0123456789' * 2)[:length]
+                expected = (None, None)
+                for regexp, card_type, name in core.CARD_TYPES:
+                    if re.match(regexp, number):
+                        expected = card_type, name
+                        break
+                self.assertEqual(
+                    core.get_credit_card_issuer(number), expected, number)
+        self.assertEqual(core.get_credit_card_issuer(''), (None, None))
+        self.assertEqual(
+            core.get_credit_card_issuer('4111-1111'), (None, None))
+
+    def test_ranges_are_compiled_from_card_types(self):
+        self.assertIn(('300', '305', (14,), 'diners', 'Diners Club'),
+                      CARD_RANGES)
+        self.assertEqual(compile_card_types([
+            (r'^4[0-9]{12}(?:[0-9]{3})?$', 'visa', 'VISA'),
+            (r'^(?:5[0678]\d|639)\d{8,9}$', 'maestro', 'Maestro')]), [
+                ('4', '4', (13, 16), 'visa', 'VISA'),
+                ('50', '50', (11, 12), 'maestro', 'Maestro'),
+                ('56', '58', (11, 12), 'maestro', 'Maestro'),
+                ('639', '639', (11, 12), 'maestro', 'Maestro')])
+        for pattern in [r'^\d{16}$', r'^4\d5$', r'^4.*$', r'^4\d+$']:
+            self.assertRaises(
+                ValueError, compile_card_types, [(pattern, 'test', 'Test')])
+
+    def test_longest_range_wins(self):
+        classifier = CardClassifier([
+            ('4', '4', (16,), 'visa', 'VISA'),
+            ('457100', '457199', (16,), 'dankort', 'Dankort')])
+        self.assertEqual(
+            classifier.classify('4571000000000000'), ('dankort', 'Dankort'))
+        self.assertEqual(
+            classifier.classify('4570000000000000'), ('visa', 'VISA'))
+
+    def test_overlapping_ranges_are_rejected(self):
+        with self.assertRaises(ValueError):
+            CardClassifier([
+                ('51', '55', (16,), 'mastercard', 'MasterCard'),
+                ('55', '56', (16,), 'other', 'Other')])
+
+    def test_ranges_are_loaded_from_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ranges.csv')
+        with io.open(path, 'w', encoding='utf-8') as ranges:
+            ranges.write(
+                '# first,last,lengths,card_type,name\n'
+                '222100,272099,16,mastercard,MasterCard\n'
+                '4571,4571,16 19,dankort,Dankort, Visa\n')
+        with override_settings(PAYMENT_CARD_RANGES=path):
+            classifier = get_card_classifier()
+            self.assertIs(get_card_classifier(), classifier)
+            self.assertEqual(
+                core.get_credit_card_issuer('2221000000000009'),
+                ('mastercard', 'MasterCard'))
+            self.assertEqual(
+                core.get_credit_card_issuer('4571000000000000000'),
+                ('dankort', 'Dankort, Visa'))
+            self.assertEqual(
+                core.get_credit_card_issuer('4111111111111111'),
+                ('visa', 'VISA'))
+
+
+CARD_NUMBERS = [
+    '4111 1111 1111 1111', '4111-1111-1111-1112', '5555555555554444',
+    '378282246310005', '6011111111111117', '30569309025904',
+    '3530111333300000', '6759649826438453', '4222222222222', '0', '',
+    '4111a11111111111', '7992739871\u0663', '12345678903555']
+
+
+class TestCardValidation(TestCase):
+
+    def assert_scalar_results(self, result):
+        self.assertEqual(list(result.numbers), [
+            number.replace(' ', '').replace('-', '')
+            for number in CARD_NUMBERS])
+        self.assertEqual(
+            list(result.valid),
+            [is_luhn_valid(number) for number in result.numbers])
+        self.assertEqual(
+            list(zip(result.card_types, result.names)),
+            [core.get_credit_card_issuer(number)
+             for number in result.numbers])
+
+    @skipIf(np is None, 'NumPy is not installed')
+    def test_batch_matches_scalar_validation(self):
+        result = validate_card_numbers(CARD_NUMBERS, chunk_size=4)
+        self.assert_scalar_results(result)
+        self.assertEqual(
+            list(result.valid),
+            [True, False, True, True, True, True, True, True, True, True,
+             False, False, False, True])
+
+    @patch('payments.cards.import_numpy', side_effect=ImportError)
+    def test_batch_without_numpy(self, mocked_import):
+        result = validate_card_numbers(CARD_NUMBERS)
+        self.assertIsInstance(result.valid, list)
+        self.assert_scalar_results(result)
+
+    @skipIf(np is None, 'NumPy is not installed')
+    def test_batch_uses_card_ranges_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ranges.csv')
+        with io.open(path, 'w', encoding='utf-8') as ranges:
+            ranges.write('411111,411111,16,test,Test card\n')
+        with override_settings(PAYMENT_CARD_RANGES=path):
+            result = validate_card_numbers(CARD_NUMBERS)
+            self.assert_scalar_results(result)
+        self.assertEqual(result.card_types[0], 'test')
+
+    def test_numpy_is_imported_on_first_use(self):
+        code = (
+            'import sys; import django; django.setup(); '
+            'import payments.models; print("numpy" in sys.modules)')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='test_settings')
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], env=env,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_empty_batch(self):
+        self.assertEqual(len(validate_card_numbers([]).valid), 0)
+
+
+class TestIndexedAttrs(TestCase):
+
+    @override_settings(PAYMENT_VARIANTS={
+        'dummy': ('payments.dummy.DummyProvider', {}),
+        'paypal': ('payments.paypal.PaypalProvider', {}),
+        'cybersource': ('payments.cybersource.CyberSourceProvider', {})})
+    def test_get_indexed_attrs(self):
+        self.assertEqual(
+            core.get_indexed_attrs(),
+            ['payer_info__email', 'payer_info__payer_id', 'xid'])
+
+    @patch.object(QuerySet, 'filter')
+    def test_filter_attrs_on_text_column(self, mocked_filter):
+        PaymentQuerySet(model=Payment).filter_attrs(
+            payer_info__payer_id='ABC')
+        mocked_filter.assert_called_once_with(
+            extra_data__contains='"payer_id": "ABC"')
+
+    def test_attr_index_expression(self):
+        schema_editor = Mock()
+        schema_editor.quote_name = lambda name: '"%s"' % (name,)
+        schema_editor.quote_value = lambda value: "'%s'" % (value,)
+        self.assertEqual(
+            AddAttrIndex('payment', 'xid').get_expression(
+                Payment, schema_editor),
+            """("extra_data" -> 'xid')""")
+        self.assertEqual(
+            AddAttrIndex('payment', 'payer_info__payer_id').get_expression(
+                Payment, schema_editor),
+            """("extra_data" #> '{payer_info,payer_id}')""")
+
+
+class TestTokenGenerators(TestCase):
+
+    def test_default_generator(self):
+        self.assertIsInstance(get_token_generator(), UUID4Generator)
+        with override_settings(
+                PAYMENT_TOKEN_GENERATOR='payments.tokens.UUID7Generator'):
+            self.assertIsInstance(get_token_generator(), UUID7Generator)
+
+    def test_generators_match_their_patterns(self):
+        for generator in [
+                UUID4Generator(), UUID7Generator(), CompactTokenGenerator()]:
+            token = generator()
+            self.assertTrue(re.match('^%s$' % (generator.pattern,), token))
+            self.assertLessEqual(len(token), 36)
+
+    def test_time_ordered_tokens(self):
+        for generator in [UUID7Generator(), CompactTokenGenerator()]:
+            with patch('time.time', return_value=1500000000):
+                first = generator()
+            with patch('time.time', return_value=1500000000.001):
+                second = generator()
+            self.assertLess(first, second)
+
+    def test_process_urls_accept_uuid_tokens(self):
+        uuid_token = UUID4Generator()()
+        compact_token = CompactTokenGenerator()()
+        patterns = get_process_urls(CompactTokenGenerator())
+        self.assertEqual(len(patterns), 2)
+        for token in [uuid_token, compact_token]:
+            path = 'process/%s/' % (token,)
+            matches = [p.resolve(path) for p in patterns if p.resolve(path)]
+            self.assertEqual(matches[0].kwargs, {'token': token})
+        self.assertEqual(len(get_process_urls(UUID7Generator())), 1)
+
+
+class TestPhasedCallbacks(TestCase):
+
+    def test_default_callback_mode(self):
+        self.assertEqual(get_callback_mode(), 'atomic')
+        with override_settings(PAYMENT_CALLBACK_MODE='lazy'):
+            with self.assertRaises(ValueError):
+                get_callback_mode()
+
+    @patch('payments.callbacks.transaction.atomic')
+    @patch.object(QuerySet, 'select_for_update')
+    def test_gateway_is_called_outside_transaction(
+            self, mocked_select, mocked_atomic):
+        provider = Mock()
+        provider.validate_callback.return_value = None
+        locked_payment = Payment(pk=1, status=PaymentStatus.WAITING)
+        mocked_select.return_value.get.return_value = locked_payment
+        calls = Mock()
+        calls.attach_mock(provider, 'provider')
+        calls.attach_mock(mocked_atomic, 'atomic')
+        response = process_phased_callback(
+            'request', Payment(pk=1), provider)
+        self.assertEqual(response, provider.apply_callback_data.return_value)
+        provider.apply_callback_data.assert_called_once_with(
+            locked_payment, 'request',
+            provider.fetch_callback_data.return_value)
+        mocked_select.return_value.get.assert_called_once_with(pk=1)
+        names = [call[0] for call in calls.mock_calls]
+        self.assertLess(
+            names.index('provider.fetch_callback_data'),
+            names.index('atomic'))
+
+    @patch('payments.callbacks.transaction.atomic')
+    def test_invalid_callback_stops_early(self, mocked_atomic):
+        provider = Mock()
+        response = process_phased_callback('request', Payment(pk=1), provider)
+        self.assertEqual(response, provider.validate_callback.return_value)
+        self.assertFalse(provider.fetch_callback_data.called)
+        self.assertFalse(mocked_atomic.called)
+
+
+class TestQueuedCallbacks(TestCase):
+
+    def test_stored_request_is_replayed(self):
+        request = RequestFactory().post(
+            '/process/1234/?trans=1', {'status': 'OK'},
+            HTTP_X_SIGNATURE='abc')
+        callback = Callback.from_request(request, 'default', '1234')
+        replayed = callback.get_request()
+        self.assertEqual(replayed.method, 'POST')
+        self.assertEqual(replayed.path, '/process/1234/')
+        self.assertEqual(replayed.GET['trans'], '1')
+        self.assertEqual(replayed.body, request.body)
+        self.assertEqual(replayed.POST['status'], 'OK')
+        self.assertEqual(replayed.META['HTTP_X_SIGNATURE'], 'abc')
+
+    def test_credentials_are_not_stored(self):
+        request = RequestFactory().post(
+            '/process/1234/', {'status': 'OK'}, HTTP_COOKIE='sessionid=abc',
+            HTTP_AUTHORIZATION='Basic abc', HTTP_PROXY_AUTHORIZATION='abc',
+            HTTP_X_SIGNATURE='abc')
+        callback = Callback.from_request(request, 'default', '1234')
+        meta = json.loads(callback.meta)
+        self.assertNotIn('HTTP_COOKIE', meta)
+        self.assertNotIn('HTTP_AUTHORIZATION', meta)
+        self.assertNotIn('HTTP_PROXY_AUTHORIZATION', meta)
+        self.assertEqual(meta['HTTP_X_SIGNATURE'], 'abc')
+
+    @patch('payments.urls.get_object_or_404')
+    @patch.object(Callback, 'save')
+    def test_callback_is_queued_and_acknowledged(
+            self, mocked_save, mocked_get):
+        mocked_get.return_value = Payment(variant='default', token='1234')
+        provider = Mock(supports_queued_callbacks=True)
+        request = RequestFactory().post('/process/1234/', {'status': 'OK'})
+        with override_settings(
+                PAYMENT_QUEUE_CALLBACKS=True,
+                PAYMENT_MODEL='payments.Payment',
+                PAYMENT_CALLBACK_MODEL='payments.Callback'):
+            response = process_data(request, '1234', provider)
+        self.assertEqual(response, provider.get_callback_ack.return_value)
+        self.assertTrue(mocked_save.called)
+        self.assertFalse(provider.process_data.called)
+
+    @patch('payments.callbacks.run_callback')
+    @patch.object(Callback, 'save')
+    def test_failed_callback_is_recorded(self, mocked_save, mocked_run):
+        mocked_run.return_value = HttpResponseForbidden('FAILED')
+        callback = Callback(variant='default', token='1234', method='GET')
+        self.assertEqual(process_callback(callback), CallbackStatus.FAILED)
+        self.assertEqual(callback.error, 'Response status 403')
+        mocked_save.assert_called_once_with(
+            update_fields=['status', 'error', 'processed'])
+
+    @patch('payments.callbacks.run_callback')
+    @patch('payments.callbacks.get_callback_model')
+    @patch.object(Callback, 'save')
+    def test_callbacks_of_a_payment_are_processed_in_order(
+            self, mocked_save, mocked_get_model, mocked_run):
+        callbacks = [
+            Callback(pk=pk, variant='default', token=token, method='GET')
+            for pk, token in enumerate(['a', 'b', 'a', 'c', 'a', 'b'])]
+        manager = mocked_get_model.return_value._default_manager
+        manager.filter.return_value.order_by.return_value.\
+            __getitem__.return_value = callbacks
+        manager.filter.return_value.values_list.return_value = []
+        manager.filter.return_value.update.return_value = 1
+        processed = []
+
+        def get_request(callback):
+            return callback.pk
+
+        def run_callback(request, token, provider):
+            processed.append((token, request))
+            return HttpResponse('OK')
+
+        mocked_run.side_effect = run_callback
+        with patch.object(
+                Callback, 'get_request', autospec=True,
+                side_effect=get_request):
+            counts = process_callbacks(workers=3)
+        self.assertEqual(counts, {CallbackStatus.PROCESSED: 6})
+        for token, pks in [('a', [0, 2, 4]), ('b', [1, 5]), ('c', [3])]:
+            self.assertEqual([pk for t, pk in processed if t == token], pks)
+        self.assertEqual(
+            [callback.status for callback in callbacks],
+            [CallbackStatus.PROCESSED] * 6)
+
+    @patch('payments.callbacks.get_callback_model')
+    def test_claimed_callbacks_are_skipped(self, mocked_get_model):
+        callbacks = [
+            Callback(pk=pk, variant='default', token=token, method='GET')
+            for pk, token in enumerate(['a', 'b', 'a', 'c', 'a', 'b'])]
+        manager = mocked_get_model.return_value._default_manager
+        # 'c' is in flight in another run, which also claimed callback 2
+        claimed_elsewhere = [2]
+
+        def filter(*args, **kwargs):
+            queryset = Mock()
+            queryset.values_list.return_value = ['c']
+            queryset.update.return_value = int(
+                kwargs.get('pk') not in claimed_elsewhere)
+            return queryset
+
+        manager.filter.side_effect = filter
+        by_payment = claim_callbacks(callbacks)
+        self.assertEqual(
+            dict((token, [callback.pk for callback in claimed])
+                 for token, claimed in by_payment.items()),
+            {'a': [0], 'b': [1, 5]})
+        self.assertEqual(callbacks[0].status, CallbackStatus.PROCESSING)
+        self.assertEqual(callbacks[4].status, CallbackStatus.PENDING)
+
+
+    @patch('payments.callbacks.now')
+    @patch('payments.callbacks.get_callback_model')
+    def test_expired_claims_are_taken_over(self, mocked_get_model, mocked_now):
+        mocked_now.return_value = datetime(2017, 6, 1, 12, 0)
+        expiry = datetime(2017, 6, 1, 11, 50)
+        stale = Callback(
+            pk=1, variant='default', token='a', method='GET',
+            status=CallbackStatus.PROCESSING,
+            claimed=datetime(2017, 6, 1, 11, 0))
+        pending = Callback(pk=2, variant='default', token='a', method='GET')
+        manager = mocked_get_model.return_value._default_manager
+        manager.filter.return_value.values_list.return_value = []
+        manager.filter.return_value.update.return_value = 1
+        with override_settings(PAYMENT_CALLBACK_LEASE=600):
+            by_payment = claim_callbacks([stale, pending])
+        self.assertEqual(by_payment, {'a': [stale, pending]})
+        self.assertEqual(
+            manager.filter.call_args_list[0][1]['claimed__gte'], expiry)
+        reclaim = manager.filter.call_args_list[1][0][0]
+        self.assertIn(('claimed__lt', expiry), reclaim.children[1].children)
+        manager.filter.return_value.update.assert_called_with(
+            status=CallbackStatus.PROCESSING, claimed=mocked_now.return_value)
+        self.assertEqual(stale.claimed, mocked_now.return_value)
+
+
+class TestCallbackDeduplication(TestCase):
+
+    @patch('payments.utils.time.time')
+    def test_local_store_evicts_old_values(self, mocked_time):
+        mocked_time.return_value = 100
+        store = LocalStore(max_size=2, ttl=10)
+        store.set('a', 1)
+        store.set('b', 2)
+        self.assertEqual(store.get('a'), 1)
+        store.set('c', 3)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), 1)
+        mocked_time.return_value = 110
+        self.assertIsNone(store.get('c'))
+
+    def test_default_fingerprint(self):
+        provider = core.BasicProvider()
+        factory = RequestFactory()
+        fingerprint = provider.get_callback_fingerprint(
+            factory.post('/process/1234/', {'status': 'OK'}))
+        self.assertEqual(fingerprint, provider.get_callback_fingerprint(
+            factory.post('/process/1234/', {'status': 'OK'})))
+        self.assertNotEqual(fingerprint, provider.get_callback_fingerprint(
+            factory.post('/process/1234/', {'status': 'FAIL'})))
+
+    @patch('payments.dedup._deduplicator', None)
+    @patch('payments.callbacks._run_callback')
+    def test_duplicates_get_the_first_response(self, mocked_run):
+        provider = Mock()
+        provider.get_callback_fingerprint.return_value = 'fingerprint'
+        payment = Payment(variant='default', token='1234')
+        mocked_run.return_value = (
+            payment, provider, HttpResponse('OK', status=202))
+        request = RequestFactory().post('/process/1234/')
+        options = {'store': 'local', 'max_size': 10}
+        with override_settings(PAYMENT_CALLBACK_DEDUPLICATION=options):
+            run_callback(request, '1234')
+            with patch('payments.dedup.provider_factory') as mocked_factory:
+                mocked_factory.return_value = provider
+                response = run_callback(request, '1234')
+            mocked_factory.assert_called_once_with('default')
+        self.assertEqual(mocked_run.call_count, 1)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.content, b'OK')
+
+    @patch('payments.dedup._deduplicator', None)
+    @patch('payments.callbacks._run_callback')
+    def test_failed_callbacks_are_not_kept(self, mocked_run):
+        provider = Mock()
+        provider.get_callback_fingerprint.return_value = 'fingerprint'
+        mocked_run.return_value = (
+            Payment(variant='default', token='1234'), provider,
+            HttpResponseForbidden('FAILED'))
+        request = RequestFactory().post('/process/1234/')
+        options = {'store': 'local', 'max_size': 10}
+        with override_settings(PAYMENT_CALLBACK_DEDUPLICATION=options):
+            run_callback(request, '1234', provider)
+            run_callback(request, '1234', provider)
+        self.assertEqual(mocked_run.call_count, 2)
+
+    @patch('payments.dedup._deduplicator', None)
+    @patch('payments.callbacks._run_callback')
+    @patch('payments.urls.provider_factory')
+    def test_static_callback_keeps_multipart_body(
+            self, mocked_factory, mocked_run):
+        provider = core.BasicProvider()
+        provider.get_token_from_request = (
+            lambda request, payment: request.POST['token'])
+        mocked_factory.return_value = provider
+        mocked_run.return_value = (
+            Payment(variant='default', token='1234'), provider,
+            HttpResponse('OK'))
+        request = RequestFactory().post('/process/default/', {'token': '1234'})
+        options = {'store': 'local', 'max_size': 10}
+        with override_settings(PAYMENT_CALLBACK_DEDUPLICATION=options):
+            response = static_callback(request, 'default')
+        self.assertEqual(response.content, b'OK')
+        mocked_run.assert_called_once_with(request, '1234', provider)
+
+
+class TestProviderSession(TestCase):
+
+    def test_session_is_created_once(self):
+        provider = core.BasicProvider()
+        self.assertIs(provider.session, provider.session)
+
+    def test_session_uses_http_options(self):
+        provider = core.BasicProvider(http_options={
+            'timeout': (1, 2), 'pool_maxsize': 3, 'keep_alive': False})
+        session = provider.session
+        self.assertEqual(session.timeout, (1, 2))
+        self.assertEqual(session.get_adapter('https://')._pool_maxsize, 3)
+        self.assertEqual(session.headers['Connection'], 'close')
+
+    def test_unknown_http_option(self):
+        provider = core.BasicProvider(http_options={'pool': 3})
+        self.assertRaises(ValueError, lambda: provider.session)
+
+    @patch('requests.Session.request')
+    def test_session_applies_default_timeout(self, mocked_request):
+        provider = core.BasicProvider(http_options={'timeout': 7})
+        provider.session.post('https://example.com', data={})
+        self.assertEqual(mocked_request.call_args[1]['timeout'], 7)
+
 
 class TestBasePayment(TestCase):
 
@@ -43,6 +673,234 @@ class TestBasePayment(TestCase):
         self.assertEqual(getattr(payment.attrs, "attr5", None), None)
         self.assertEqual(hasattr(payment.attrs, "attr7"), False)
 
+    @patch('payments.models.json.loads', side_effect=json.loads)
+    def test_extra_data_is_decoded_once(self, mocked_loads):
+        payment = BasePayment(extra_data='{"attr1": "test1"}')
+        payment.attrs.attr1
+        payment.attrs.attr2 = 'test2'
+        self.assertEqual(payment.attrs.attr2, 'test2')
+        self.assertEqual(mocked_loads.call_count, 1)
+        payment.extra_data = '{"attr3": "test3"}'
+        payment.attrs.attr3
+        self.assertEqual(mocked_loads.call_count, 2)
+
+    @patch('django.db.models.Model.save')
+    def test_extra_data_is_encoded_on_save(self, mocked_save):
+        payment = BasePayment(extra_data='{"attr1": "test1"}', token='x')
+        payment.attrs.attr2 = 'test2'
+        self.assertEqual(payment.extra_data, '{"attr1": "test1"}')
+        with patch('payments.models.json.dumps') as mocked_dumps:
+            mocked_dumps.return_value = '{}'
+            payment.save()
+            payment.save()
+        mocked_dumps.assert_called_once_with(
+            {'attr1': 'test1', 'attr2': 'test2'})
+
+    @patch('django.db.models.Model.save')
+    def test_assigned_extra_data_wins_over_changes(self, mocked_save):
+        payment = BasePayment(extra_data='{"attr1": "test1"}', token='x')
+        payment.attrs.attr2 = 'test2'
+        payment.extra_data = '{"attr3": "test3"}'
+        payment.save()
+        self.assertEqual(payment.extra_data, '{"attr3": "test3"}')
+        self.assertEqual(payment.attrs.attr3, 'test3')
+
+    def test_extra_data_in_json_column(self):
+        extra_data = {'attr1': 'test1'}
+        payment = BasePayment(extra_data=extra_data)
+        self.assertEqual(payment.attrs.attr1, 'test1')
+        payment.attrs.attr2 = 'test2'
+        payment.flush_extra_data()
+        self.assertIs(payment.extra_data, extra_data)
+        self.assertEqual(extra_data['attr2'], 'test2')
+
+    def _load_payment(self, **kwargs):
+        payment = Payment(token='x', **kwargs)
+        field_names = [field.attname for field in Payment._meta.concrete_fields]
+        return Payment.from_db(
+            'default', field_names,
+            [getattr(payment, name) for name in field_names])
+
+    @patch('django.db.models.Model.save')
+    def test_save_writes_changed_fields(self, mocked_save):
+        payment = self._load_payment(pk=1, status=PaymentStatus.WAITING)
+        payment.attrs.attr1 = 'test1'
+        payment.change_status(PaymentStatus.CONFIRMED)
+        mocked_save.assert_called_once_with(update_fields=[
+            'status', 'extra_data', 'modified'])
+        payment.save()
+        self.assertEqual(mocked_save.call_count, 1)
+
+    @patch('django.db.models.Model.save')
+    def test_refresh_updates_loaded_values(self, mocked_save):
+        payment = self._load_payment(
+            pk=1, status=PaymentStatus.WAITING, transaction_id='1')
+
+        def refresh(using=None, fields=None):
+            payment.status = PaymentStatus.CONFIRMED
+            payment.transaction_id = '2'
+
+        with patch('django.db.models.Model.refresh_from_db',
+                   side_effect=refresh):
+            payment.refresh_from_db()
+        self.assertEqual(payment.get_changed_fields(), [])
+        payment.status = PaymentStatus.WAITING
+        payment.save()
+        mocked_save.assert_called_once_with(
+            update_fields=['status', 'modified'])
+
+    @patch('django.db.models.Model.save')
+    def test_refresh_of_some_fields_keeps_other_changes(self, mocked_save):
+        payment = self._load_payment(
+            pk=1, status=PaymentStatus.WAITING, transaction_id='1')
+        payment.transaction_id = '2'
+
+        def refresh(using=None, fields=None):
+            payment.status = PaymentStatus.CONFIRMED
+
+        with patch('django.db.models.Model.refresh_from_db',
+                   side_effect=refresh):
+            payment.refresh_from_db(fields=['status'])
+        self.assertEqual(payment.get_changed_fields(), ['transaction_id'])
+
+    @patch('django.db.models.Model.save')
+    def test_saves_are_deferred(self, mocked_save):
+        payment = self._load_payment(pk=1, status=PaymentStatus.WAITING)
+        received = []
+
+        def receiver(sender, instance, **kwargs):
+            received.append(mocked_save.call_count)
+
+        status_changed.connect(receiver, sender=Payment)
+        try:
+            with payment.defer_saves():
+                payment.change_status(PaymentStatus.PREAUTH)
+                payment.transaction_id = '1234'
+                payment.save()
+                payment.change_status(PaymentStatus.CONFIRMED, 'ok')
+                self.assertEqual(mocked_save.call_count, 0)
+        finally:
+            status_changed.disconnect(receiver, sender=Payment)
+        mocked_save.assert_called_once_with(update_fields=[
+            'status', 'transaction_id', 'message', 'modified'])
+        self.assertEqual(received, [1, 1])
+
+    @patch('django.db.models.Model.save')
+    def test_deferred_saves_are_dropped_on_error(self, mocked_save):
+        payment = self._load_payment(pk=1, status=PaymentStatus.WAITING)
+        with self.assertRaises(ValueError):
+            with payment.defer_saves():
+                payment.change_status(PaymentStatus.CONFIRMED)
+                raise ValueError()
+        self.assertFalse(mocked_save.called)
+
+    @patch.object(QuerySet, 'filter')
+    def test_transition_status_is_conditional_update(self, mocked_filter):
+        mocked_filter.return_value.update.return_value = 1
+        payment = self._load_payment(pk=1, status=PaymentStatus.WAITING)
+        with patch('django.db.models.Model.save') as mocked_save:
+            with payment.defer_saves():
+                self.assertTrue(
+                    payment.transition_status(PaymentStatus.CONFIRMED, 'ok'))
+        self.assertFalse(mocked_save.called)
+        mocked_filter.assert_called_once_with(
+            pk=1, status__in=[
+                PaymentStatus.ERROR, PaymentStatus.INPUT,
+                PaymentStatus.PREAUTH, PaymentStatus.WAITING])
+        kwargs = mocked_filter.return_value.update.call_args[1]
+        self.assertEqual(kwargs['status'], PaymentStatus.CONFIRMED)
+        self.assertEqual(kwargs['message'], 'ok')
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(payment.get_changed_fields(), [])
+
+    @patch.object(QuerySet, 'filter')
+    def test_lost_transition_leaves_payment_unchanged(self, mocked_filter):
+        mocked_filter.return_value.update.return_value = 0
+        payment = self._load_payment(pk=1, status=PaymentStatus.WAITING)
+        self.assertFalse(payment.transition_status(
+            PaymentStatus.REJECTED, sources=[PaymentStatus.WAITING]))
+        mocked_filter.assert_called_once_with(
+            pk=1, status__in=[PaymentStatus.WAITING])
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+
+    @patch('payments.models.transaction.atomic')
+    @patch.object(QuerySet, 'using')
+    def test_transition_uses_database_of_payment(
+            self, mocked_using, mocked_atomic):
+        mocked_using.return_value.filter.return_value.update.return_value = 1
+        payment = self._load_payment(pk=1, status=PaymentStatus.WAITING)
+        payment._state.db = 'payments'
+        with patch.object(OutboxEvent, 'save'):
+            with override_settings(
+                    PAYMENT_OUTBOX_MODEL='payments.OutboxEvent'):
+                self.assertTrue(
+                    payment.transition_status(PaymentStatus.CONFIRMED))
+        mocked_using.assert_called_once_with('payments')
+        mocked_atomic.assert_called_once_with(using='payments')
+
+    def test_status_transitions(self):
+        self.assertEqual(
+            PaymentStatus.get_sources(PaymentStatus.REFUNDED),
+            [PaymentStatus.CONFIRMED, PaymentStatus.PREAUTH])
+        self.assertEqual(
+            sorted(PaymentStatus.TRANSITIONS),
+            sorted(status for status, name in PaymentStatus.CHOICES))
+
+    @patch('django.db.models.Model.save')
+    def test_save_accepts_positional_arguments(self, mocked_save):
+        payment = self._load_payment(pk=1, status=PaymentStatus.WAITING)
+        payment.status = PaymentStatus.CONFIRMED
+        payment.save(False, False, 'default')
+        mocked_save.assert_called_once_with(
+            force_insert=False, force_update=False, using='default',
+            update_fields=['status', 'modified'])
+        self.assertRaises(TypeError, payment.save, False, False, None, None, 1)
+
+    @patch('django.db.models.Model.save')
+    def test_json_changed_in_place_is_saved(self, mocked_save):
+        payment = self._load_payment(pk=1, extra_data={'attempts': [1]})
+        payment.extra_data['attempts'].append(2)
+        payment.save()
+        mocked_save.assert_called_once_with(
+            update_fields=['extra_data', 'modified'])
+        payment.extra_data['attempts'].append(3)
+        payment.save()
+        self.assertEqual(
+            mocked_save.call_args[1]['update_fields'],
+            ['extra_data', 'modified'])
+
+    @patch('django.db.models.Model.save')
+    def test_new_token_is_saved_without_query(self, mocked_save):
+        payment = Payment()
+        with patch.object(PaymentQuerySet, 'exists') as mocked_exists:
+            payment.save()
+        self.assertFalse(mocked_exists.called)
+        self.assertEqual(len(payment.token), 36)
+
+    @patch('django.db.models.Model.save')
+    def test_taken_token_is_replaced(self, mocked_save):
+        payment = Payment()
+        tokens = []
+
+        def save(**kwargs):
+            tokens.append(payment.token)
+            if len(tokens) == 1:
+                raise IntegrityError()
+
+        mocked_save.side_effect = save
+        with patch.object(PaymentQuerySet, 'exists', return_value=True):
+            payment.save()
+        self.assertEqual(len(tokens), 2)
+        self.assertNotEqual(tokens[0], tokens[1])
+        self.assertEqual(payment.token, tokens[1])
+
+    @patch('django.db.models.Model.save', side_effect=IntegrityError())
+    def test_other_integrity_errors_are_raised(self, mocked_save):
+        payment = Payment()
+        with patch.object(PaymentQuerySet, 'exists', return_value=False):
+            self.assertRaises(IntegrityError, payment.save)
+        self.assertEqual(mocked_save.call_count, 1)
+
     def test_capture_with_wrong_status(self):
         payment = BasePayment(variant='default', status=PaymentStatus.WAITING)
         self.assertRaises(ValueError, payment.capture)
@@ -151,6 +1009,522 @@ class TestBasePayment(TestCase):
         self.assertEqual(mocked_refund_method.call_count, 1)
 
 
+class TestStatusChangedDelivery(TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.received_bulk = []
+        status_changed.connect(self.receiver, sender=Payment)
+        bulk_status_changed.connect(self.bulk_receiver, sender=Payment)
+
+    def tearDown(self):
+        status_changed.disconnect(self.receiver, sender=Payment)
+        bulk_status_changed.disconnect(self.bulk_receiver, sender=Payment)
+
+    def receiver(self, sender, instance, **kwargs):
+        self.received.append(instance)
+
+    def bulk_receiver(self, sender, instances, **kwargs):
+        self.received_bulk.append(instances)
+
+    @patch('django.db.models.Model.save')
+    def test_signals_are_sent_right_away(self, mocked_save):
+        payment = Payment(pk=1)
+        payment.change_status(PaymentStatus.CONFIRMED)
+        self.assertEqual(self.received, [payment])
+        self.assertEqual(self.received_bulk, [[payment]])
+
+    def on_commit(self, func, using=None):
+        # a plain function, a mock would keep the hooks alive
+        self.run_on_commit.append(func)
+
+    def commit(self):
+        # hooks run in order, like Django does
+        while self.run_on_commit:
+            self.run_on_commit.pop(0)()
+
+    @patch('payments.signals.transaction.get_connection')
+    @patch('django.db.models.Model.save')
+    def test_signals_are_sent_on_commit(self, mocked_save, mocked_connection):
+        mocked_connection.return_value.in_atomic_block = True
+        self.run_on_commit = []
+        first, second = Payment(pk=1), Payment(pk=2)
+        with patch('payments.signals.transaction.on_commit', self.on_commit):
+            with override_settings(PAYMENT_SIGNAL_DELIVERY='on_commit'):
+                first.change_status(PaymentStatus.PREAUTH)
+                second.change_status(PaymentStatus.CONFIRMED)
+                first.change_status(PaymentStatus.CONFIRMED)
+                self.assertEqual(self.received, [])
+                self.commit()
+                self.assertEqual(self.received, [first, second, first])
+                self.assertEqual(self.received_bulk, [[first, second]])
+                # the next transaction gets a batch of its own
+                second.change_status(PaymentStatus.REFUNDED)
+                self.commit()
+                self.assertEqual(self.received_bulk[-1], [second])
+
+    @patch('payments.signals.transaction.get_connection')
+    @patch('django.db.models.Model.save')
+    def test_signals_are_sent_right_away_outside_transaction(
+            self, mocked_save, mocked_connection):
+        mocked_connection.return_value.in_atomic_block = False
+        payment = Payment(pk=1)
+        with override_settings(PAYMENT_SIGNAL_DELIVERY='on_commit'):
+            payment.change_status(PaymentStatus.CONFIRMED)
+        self.assertEqual(self.received, [payment])
+
+    @patch('payments.signals.transaction.get_connection')
+    @patch('django.db.models.Model.save')
+    def test_rolled_back_batch_is_dropped(self, mocked_save, mocked_connection):
+        mocked_connection.return_value.in_atomic_block = True
+        self.run_on_commit = []
+        first, second = Payment(pk=1), Payment(pk=2)
+        with patch('payments.signals.transaction.on_commit', self.on_commit):
+            with override_settings(PAYMENT_SIGNAL_DELIVERY='on_commit'):
+                first.change_status(PaymentStatus.CONFIRMED)
+                # a rollback drops the registered hooks
+                del self.run_on_commit[:]
+                second.change_status(PaymentStatus.CONFIRMED)
+                self.commit()
+        self.assertEqual(self.received, [second])
+
+    @patch('payments.signals.transaction.get_connection')
+    @patch('django.db.models.Model.save')
+    def test_changes_of_rolled_back_savepoint_are_dropped(
+            self, mocked_save, mocked_connection):
+        mocked_connection.return_value.in_atomic_block = True
+        self.run_on_commit = []
+        first, second, third = Payment(pk=1), Payment(pk=2), Payment(pk=3)
+        with patch('payments.signals.transaction.on_commit', self.on_commit):
+            with override_settings(PAYMENT_SIGNAL_DELIVERY='on_commit'):
+                first.change_status(PaymentStatus.CONFIRMED)
+                hooks = len(self.run_on_commit)
+                second.change_status(PaymentStatus.CONFIRMED)
+                # rolling back the savepoint drops the hooks added within it
+                del self.run_on_commit[hooks:]
+                third.change_status(PaymentStatus.CONFIRMED)
+                self.commit()
+        self.assertEqual(self.received, [first, third])
+        self.assertEqual(self.received_bulk, [[first, third]])
+
+
+class TestOutbox(TestCase):
+
+    @patch('payments.models.transaction.atomic')
+    @patch.object(BasePayment, 'save')
+    @patch.object(OutboxEvent, 'save', autospec=True)
+    def test_status_change_is_written_with_payment(
+            self, mocked_event_save, mocked_save, mocked_atomic):
+        payment = Payment(
+            pk=1, token='1234', variant='default', currency='EUR',
+            total=Decimal('10.00'), status=PaymentStatus.WAITING)
+        with override_settings(PAYMENT_OUTBOX_MODEL='payments.OutboxEvent'):
+            payment.change_status(PaymentStatus.CONFIRMED, 'ok')
+        self.assertTrue(mocked_atomic.called)
+        self.assertTrue(mocked_save.called)
+        event = mocked_event_save.call_args[0][0]
+        self.assertEqual(event.token, '1234')
+        self.assertEqual(event.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(event.previous_status, PaymentStatus.WAITING)
+        self.assertEqual(event.to_dict()['payload']['total'], '10.00')
+
+    @patch('payments.models.transaction.atomic')
+    @patch.object(OutboxEvent, 'save', autospec=True)
+    def test_deferred_status_change_is_written_with_payment(
+            self, mocked_event_save, mocked_atomic):
+        payment = Payment(
+            pk=1, token='1234', variant='default', currency='EUR',
+            status=PaymentStatus.WAITING)
+        calls = []
+        mocked_atomic.return_value.__enter__.side_effect = (
+            lambda: calls.append('atomic'))
+        mocked_event_save.side_effect = (
+            lambda event: calls.append(('event', event.status)))
+        with override_settings(PAYMENT_OUTBOX_MODEL='payments.OutboxEvent'):
+            with patch('django.db.models.Model.save', side_effect=(
+                    lambda **kwargs: calls.append('payment'))):
+                with payment.defer_saves():
+                    payment.change_status(PaymentStatus.PREAUTH)
+                    payment.change_status(PaymentStatus.CONFIRMED)
+                    self.assertEqual(calls, [])
+        self.assertEqual(calls, [
+            'atomic', 'payment', ('event', PaymentStatus.PREAUTH),
+            ('event', PaymentStatus.CONFIRMED)])
+
+    @patch('payments.models.transaction.atomic')
+    @patch.object(QuerySet, 'filter')
+    @patch.object(OutboxEvent, 'save', autospec=True)
+    def test_transition_event_holds_fields_changed_with_status(
+            self, mocked_event_save, mocked_filter, mocked_atomic):
+        mocked_filter.return_value.update.return_value = 1
+        payment = Payment(
+            pk=1, token='1234', variant='default', currency='EUR',
+            total=Decimal('10.00'), status=PaymentStatus.WAITING)
+        payment._store_loaded_values()
+        with override_settings(PAYMENT_OUTBOX_MODEL='payments.OutboxEvent'):
+            self.assertTrue(payment.transition_status(
+                PaymentStatus.CONFIRMED, captured_amount=payment.total,
+                transaction_id='abc'))
+        kwargs = mocked_filter.return_value.update.call_args[1]
+        self.assertEqual(kwargs['captured_amount'], Decimal('10.00'))
+        self.assertEqual(kwargs['transaction_id'], 'abc')
+        payload = mocked_event_save.call_args[0][0].to_dict()['payload']
+        self.assertEqual(payload['captured_amount'], '10.00')
+        self.assertEqual(payload['transaction_id'], 'abc')
+        self.assertEqual(payment.get_changed_fields(), [])
+
+    @patch.object(OutboxEvent, 'save')
+    def test_deferred_status_change_is_dropped_on_error(
+            self, mocked_event_save):
+        payment = Payment(pk=1, token='1234', status=PaymentStatus.WAITING)
+        with override_settings(PAYMENT_OUTBOX_MODEL='payments.OutboxEvent'):
+            with self.assertRaises(ValueError):
+                with payment.defer_saves():
+                    payment.change_status(PaymentStatus.CONFIRMED)
+                    raise ValueError()
+        self.assertFalse(mocked_event_save.called)
+
+    @patch('django.db.models.Model.save')
+    def test_outbox_is_disabled_by_default(self, mocked_save):
+        with patch.object(OutboxEvent, 'save') as mocked_event_save:
+            Payment(pk=1).change_status(PaymentStatus.CONFIRMED)
+        self.assertFalse(mocked_event_save.called)
+
+    def test_file_sink(self):
+        with tempfile.NamedTemporaryFile() as output:
+            sink = FileSink(output.name)
+            sink.send([{'id': 1}, {'id': 2}])
+            sink.send([{'id': 3}])
+            lines = output.read().decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [1, 2, 3])
+
+    @patch('payments.outbox.get_outbox_model')
+    def test_events_are_relayed_in_order(self, mocked_get_model):
+        events = [
+            OutboxEvent(pk=pk, token=token, status=PaymentStatus.CONFIRMED)
+            for pk, token in enumerate(['a', 'b', 'a', 'c', 'b'])]
+        manager = mocked_get_model.return_value._default_manager
+        manager.filter.return_value.order_by.return_value.\
+            __getitem__.return_value = events
+        sink = Mock()
+        self.assertEqual(relay_events(sink, workers=2), (5, 0))
+        sent = [
+            [event['id'] for event in call[0][0]]
+            for call in sink.send.call_args_list]
+        self.assertEqual(sorted(sum(sent, [])), [0, 1, 2, 3, 4])
+        for pks in sent:
+            self.assertEqual(pks, sorted(pks))
+        for pks in [[0, 2], [1, 4]]:
+            self.assertTrue(any(set(pks) <= set(chunk) for chunk in sent))
+
+    @patch('payments.outbox.get_outbox_model')
+    def test_failed_events_are_not_marked_delivered(self, mocked_get_model):
+        manager = mocked_get_model.return_value._default_manager
+        manager.filter.return_value.order_by.return_value.\
+            __getitem__.return_value = [OutboxEvent(pk=1, token='a')]
+        sink = Mock()
+        sink.send.side_effect = IOError()
+        self.assertEqual(relay_events(sink), (0, 1))
+        self.assertFalse(manager.filter.return_value.update.called)
+
+
+class TestBulkOperations(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrency_is_limited_per_variant(self):
+        payments = [
+            Payment(pk=pk, variant=variant)
+            for pk in range(12) for variant in ['paypal', 'stripe']]
+        lock = threading.Lock()
+        running = {'paypal': 0, 'stripe': 0}
+        peaks = {'paypal': 0, 'stripe': 0}
+
+        def operation(payment):
+            with lock:
+                running[payment.variant] += 1
+                peaks[payment.variant] = max(
+                    peaks[payment.variant], running[payment.variant])
+            time.sleep(0.005)
+            with lock:
+                running[payment.variant] -= 1
+
+        result = run_in_bulk(
+            payments, operation, concurrency=3,
+            variant_concurrency={'stripe': 1})
+        self.assertEqual(result.succeeded, {'paypal': 12, 'stripe': 12})
+        self.assertLessEqual(peaks['paypal'], 3)
+        self.assertEqual(peaks['stripe'], 1)
+
+    def test_slow_variant_does_not_hold_up_the_others(self):
+        payments = {
+            'paypal': [Payment(pk=pk, variant='paypal') for pk in range(20)],
+            'stripe': [Payment(pk=pk, variant='stripe') for pk in range(20)]}
+        released = threading.Event()
+        finished = threading.Event()
+        done = []
+
+        def operation(payment):
+            if payment.variant == 'paypal':
+                released.wait(5)
+            else:
+                done.append(payment.pk)
+                if len(done) == 20:
+                    finished.set()
+
+        runner = threading.Thread(target=lambda: done.append(run_in_bulk(
+            payments, operation, concurrency=2)))
+        runner.start()
+        try:
+            self.assertTrue(finished.wait(5))
+        finally:
+            released.set()
+            runner.join()
+        self.assertEqual(done[-1].succeeded, {'paypal': 20, 'stripe': 20})
+
+    def test_threads_are_limited_in_total(self):
+        payments = {
+            variant: [Payment(pk=pk, variant=variant) for pk in range(6)]
+            for variant in ['paypal', 'stripe', 'dotpay']}
+        lock = threading.Lock()
+        counts = {'running': 0, 'peak': 0}
+
+        def operation(payment):
+            with lock:
+                counts['running'] += 1
+                counts['peak'] = max(counts['peak'], counts['running'])
+            time.sleep(0.005)
+            with lock:
+                counts['running'] -= 1
+
+        result = run_in_bulk(payments, operation, concurrency=2, max_threads=3)
+        self.assertEqual(
+            result.succeeded, {'paypal': 6, 'stripe': 6, 'dotpay': 6})
+        self.assertLessEqual(counts['peak'], 3)
+
+    def test_interrupted_run_is_resumed(self):
+        path = os.path.join(self.directory, 'checkpoint')
+        payments = [Payment(pk=pk, variant='paypal') for pk in range(4)]
+
+        def operation(payment):
+            if payment.pk == 2:
+                raise PaymentError('Declined')
+
+        result = run_in_bulk(payments, operation, checkpoint=Checkpoint(path))
+        self.assertEqual(result.succeeded, {'paypal': 3})
+        self.assertEqual(
+            result.errors, [(2, 'paypal', 'PaymentError: Declined')])
+        self.assertIn('3 succeeded, 1 failed', result.get_summary()[0])
+
+        operation = Mock()
+        result = run_in_bulk(payments, operation, checkpoint=Checkpoint(path))
+        self.assertEqual(result.skipped, 4)
+        self.assertFalse(operation.called)
+        result = run_in_bulk(
+            payments, operation,
+            checkpoint=Checkpoint(path, retry_failed=True))
+        operation.assert_called_once_with(payments[2])
+
+    @patch('payments.bulk.connections')
+    def test_connections_are_closed_once_per_thread(self, mocked_connections):
+        payments = [Payment(pk=pk, variant='paypal') for pk in range(20)]
+        result = run_in_bulk(payments, Mock(), concurrency=3)
+        self.assertEqual(result.succeeded, {'paypal': 20})
+        self.assertEqual(mocked_connections.close_all.call_count, 3)
+
+    def test_result_keeps_a_sample_of_errors(self):
+        result = BulkResult(max_errors=2)
+        for pk in range(3):
+            result.add(Payment(pk=pk, variant='paypal'), 'Declined')
+        other = BulkResult()
+        other.add(Payment(pk=3, variant='paypal'), 'Declined')
+        result.merge(other)
+        self.assertEqual(result.failed, {'paypal': 4})
+        self.assertEqual(
+            result.errors, [(0, 'paypal', 'Declined'), (1, 'paypal', 'Declined')])
+        self.assertEqual(result.get_summary()[-1], '  2 more errors')
+
+    def test_checkpoint_keeps_a_high_water_mark(self):
+        path = os.path.join(self.directory, 'checkpoint')
+        checkpoint = Checkpoint(path)
+        payments = [Payment(pk=pk, variant='paypal') for pk in range(4)]
+        for payment in payments:
+            checkpoint.start(payment)
+        checkpoint.record(1, 'paypal')
+        checkpoint.record(0, 'paypal', 'Declined')
+        checkpoint.record(3, 'paypal')
+        self.assertEqual(checkpoint.marks, {'paypal': 1})
+        self.assertEqual(
+            [payment in checkpoint for payment in payments],
+            [True, True, False, False])
+        resumed = Checkpoint(path, retry_failed=True)
+        self.assertEqual(resumed.marks, {'paypal': 1})
+        self.assertEqual(resumed.failed, set([('paypal', 0)]))
+        self.assertNotIn(payments[0], resumed)
+        self.assertIn(payments[1], resumed)
+
+    @patch('payments.bulk.iterate_by_pk')
+    @patch('payments.bulk.provider_factory')
+    def test_refunds_are_batched_when_available(
+            self, mocked_factory, mocked_iterate):
+        path = os.path.join(self.directory, 'checkpoint')
+        batch_provider = Mock(refund_batch_size=2)
+        batch_provider.refund_payments.side_effect = lambda batch: dict(
+            (payment.pk, 'Declined') for payment in batch
+            if payment.pk == 2)
+        providers = {'sofort': batch_provider,
+                     'paypal': Mock(refund_batch_size=None)}
+        mocked_factory.side_effect = providers.get
+        payments = {
+            'sofort': [Payment(pk=pk, variant='sofort') for pk in range(4)],
+            'paypal': [Payment(pk=pk, variant='paypal')
+                       for pk in range(4, 8)]}
+        queryset = Mock()
+        confirmed = queryset.filter.return_value
+        confirmed.order_by.return_value.values_list.return_value.distinct\
+            .return_value = ['sofort', 'paypal']
+        confirmed.filter.side_effect = lambda variant: variant
+        mocked_iterate.side_effect = lambda variant, size: (
+            payments[variant][i:i + size] for i in range(0, 4, size))
+        checkpoint = Checkpoint(path)
+        checkpoint.record(0, 'sofort')
+        with patch.object(BasePayment, 'refund') as mocked_refund:
+            result = refund_payments(queryset, checkpoint=checkpoint)
+        queryset.filter.assert_called_once_with(
+            status=PaymentStatus.CONFIRMED)
+        self.assertEqual(
+            [[payment.pk for payment in call[0][0]]
+             for call in batch_provider.refund_payments.call_args_list],
+            [[1], [2, 3]])
+        self.assertEqual(mocked_refund.call_count, 4)
+        self.assertEqual(result.succeeded, {'sofort': 2, 'paypal': 4})
+        self.assertEqual(result.errors, [(2, 'sofort', 'Declined')])
+        self.assertEqual(result.skipped, 1)
+        self.assertIn(Payment(pk=2, variant='sofort'), checkpoint)
+
+
+class PaymentList(object):
+    '''
+    The parts of a queryset used by iterate_by_pk, over a list of payments
+    '''
+    def __init__(self, payments, queries):
+        self.payments = payments
+        self.queries = queries
+
+    def order_by(self, field):
+        return PaymentList(
+            sorted(self.payments, key=lambda payment: payment.pk),
+            self.queries)
+
+    def filter(self, pk__gt):
+        return PaymentList(
+            [payment for payment in self.payments if payment.pk > pk__gt],
+            self.queries)
+
+    def __getitem__(self, key):
+        self.queries.append(key)
+        return self.payments[key]
+
+
+class TestStalePaymentSweeper(TestCase):
+
+    def test_payments_are_read_by_keyset(self):
+        queries = []
+        payments = PaymentList(
+            [Payment(pk=pk) for pk in [5, 3, 1, 9, 7, 11, 13]], queries)
+        batches = list(iterate_by_pk(payments, batch_size=3))
+        self.assertEqual(
+            [[payment.pk for payment in batch] for batch in batches],
+            [[1, 3, 5], [7, 9, 11], [13]])
+        self.assertEqual(len(queries), 3)
+
+    @patch('payments.bulk.run_in_bulk')
+    @patch('payments.bulk.get_payment_model')
+    def test_stale_payments_are_selected_per_variant(
+            self, mocked_get_model, mocked_run):
+        manager = mocked_get_model.return_value._default_manager
+        preauth = manager.filter.return_value
+        release_stale_payments(
+            max_age=timedelta(days=7),
+            variant_max_age={'paypal': timedelta(days=29)}, concurrency=2)
+        manager.filter.assert_called_once_with(status=PaymentStatus.PREAUTH)
+        self.assertEqual(
+            preauth.filter.call_args[1]['variant'], 'paypal')
+        preauth.exclude.assert_called_once_with(variant__in=['paypal'])
+        self.assertEqual(mocked_run.call_args[1], {'concurrency': 2})
+
+
+class TestStatusSync(TestCase):
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = RateLimiter(200)
+        started = time.time()
+        for i in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.time() - started, 0.019)
+
+    @patch.object(QuerySet, 'filter')
+    def test_gateway_status_is_applied_by_transition(self, mocked_filter):
+        mocked_filter.return_value.update.return_value = 1
+        payment = Payment(
+            pk=1, status=PaymentStatus.WAITING, total=Decimal(10))
+        with patch.object(BasePayment, 'save') as mocked_save:
+            self.assertFalse(
+                apply_gateway_status(payment, PaymentStatus.WAITING))
+            self.assertFalse(apply_gateway_status(payment, None))
+            self.assertTrue(
+                apply_gateway_status(payment, PaymentStatus.CONFIRMED))
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(payment.captured_amount, Decimal(10))
+        kwargs = mocked_filter.return_value.update.call_args[1]
+        self.assertEqual(kwargs['captured_amount'], Decimal(10))
+        self.assertFalse(mocked_save.called)
+
+    @patch('payments.sync.apply_gateway_status')
+    @patch('payments.bulk.iterate_by_pk')
+    @patch('payments.sync.iterate_by_pk')
+    @patch('payments.sync.provider_factory')
+    def test_batch_queries_are_used_when_available(
+            self, mocked_factory, mocked_iterate, mocked_bulk_iterate,
+            mocked_apply):
+        batch_provider = Mock(supports_status_sync=True, status_batch_size=2)
+        single_provider = Mock(
+            supports_status_sync=True, status_batch_size=None)
+        single_provider.get_payment_status.return_value = (
+            PaymentStatus.REJECTED)
+        providers = {
+            'sofort': batch_provider, 'paypal': single_provider,
+            'dummy': Mock(supports_status_sync=False)}
+        mocked_factory.side_effect = providers.get
+        payments = dict(
+            (variant, [Payment(pk=pk, variant=variant) for pk in range(3)])
+            for variant in providers)
+        batch_provider.get_payment_statuses.side_effect = lambda batch: dict(
+            (payment.pk, PaymentStatus.CONFIRMED) for payment in batch)
+        queryset = Mock()
+        waiting = queryset.filter.return_value
+        waiting.order_by.return_value.values_list.return_value.distinct\
+            .return_value = ['sofort', 'paypal', 'dummy', 'sofort']
+        waiting.filter.side_effect = lambda variant: variant
+        mocked_iterate.side_effect = lambda variant, size: (
+            payments[variant][i:i + size] for i in range(0, 3, size))
+        mocked_bulk_iterate.side_effect = mocked_iterate.side_effect
+        mocked_apply.side_effect = lambda payment, status: (
+            status == PaymentStatus.CONFIRMED)
+        result = sync_payments(queryset, concurrency=2)
+        queryset.filter.assert_called_once_with(
+            status__in=[PaymentStatus.WAITING])
+        self.assertEqual(batch_provider.get_payment_statuses.call_count, 2)
+        self.assertEqual(single_provider.get_payment_status.call_count, 3)
+        self.assertEqual(result.succeeded, {'sofort': 3, 'paypal': 3})
+        self.assertEqual(result.changed, {'sofort': 3})
+        mocked_iterate.assert_any_call('sofort', 2)
+
+
 class TestCreditCardPaymentForm(TestCase):
 
     def setUp(self):
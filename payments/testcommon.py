@@ -54,6 +54,17 @@ def create_test_payment(**_kwargs):
             self.status = status
             self.message = message
 
+        def transition_status(self, status, message='', sources=None,
+                              **fields):
+            if sources is None:
+                sources = PaymentStatus.get_sources(status)
+            if self.status not in sources:
+                return False
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.change_status(status, message)
+            return True
+
         def get_purchased_items(self):
             return [
                 PurchasedItem(
@@ -69,7 +80,8 @@ def create_test_payment(**_kwargs):
         def get_success_url(self):
             return 'http://success.com'
 
-        def save(self):
+        def save(self, *args, **kwargs):
+            self.flush_extra_data()
             return self
     # workaround limitation in python
     for key, val in _kwargs.items():
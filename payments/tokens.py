@@ -0,0 +1,97 @@
+'''
+Generators of payment tokens.
+
+The generator is chosen with the PAYMENT_TOKEN_GENERATOR setting, a dotted
+path to one of the classes below or to your own subclass of
+TokenGenerator.
+'''
+from __future__ import unicode_literals
+import binascii
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+#: UUID tokens, always accepted by the URLs so that existing payments keep
+#: resolving after switching generators
+UUID_PATTERN = (
+    r'[0-9a-z]{8}-[0-9a-z]{4}-[0-9a-z]{4}-[0-9a-z]{4}-[0-9a-z]{12}')
+
+# Crockford's base32, encoded values sort like the encoded numbers
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+def uuid7():
+    '''
+    Returns a time-ordered UUID (version 7): milliseconds since the epoch
+    followed by random bits.
+    '''
+    timestamp = int(time.time() * 1000) & 0xffffffffffff
+    rand = int(binascii.hexlify(os.urandom(10)), 16)
+    value = (
+        timestamp << 80 | 0x7 << 76 | (rand >> 62 & 0xfff) << 64 |
+        0x2 << 62 | rand & 0x3fffffffffffffff)
+    return uuid.UUID(int=value)
+
+
+class TokenGenerator(object):
+    '''
+    Base class of token generators. Tokens must fit in 36 characters.
+    '''
+    #: regular expression matching the generated tokens
+    pattern = UUID_PATTERN
+
+    def __call__(self):
+        raise NotImplementedError()
+
+
+class UUID4Generator(TokenGenerator):
+    '''
+    Random UUIDs, the default.
+    '''
+    def __call__(self):
+        return str(uuid.uuid4())
+
+
+class UUID7Generator(TokenGenerator):
+    '''
+    Time-ordered UUIDs, new payments are inserted next to each other in the
+    token index.
+    '''
+    def __call__(self):
+        return str(uuid7())
+
+
+class CompactTokenGenerator(TokenGenerator):
+    '''
+    Time-ordered UUIDs encoded in 26 characters of Crockford's base32.
+
+    The encoding keeps the order of the UUIDs and only uses digits and
+    upper case letters, so it is safe with case-insensitive collations.
+    '''
+    pattern = r'[0-9A-HJKMNP-TV-Z]{26}'
+
+    def __call__(self):
+        value = uuid7().int
+        chars = []
+        for i in range(26):
+            chars.append(CROCKFORD_ALPHABET[value & 0x1f])
+            value >>= 5
+        return ''.join(reversed(chars))
+
+
+_generator = None
+
+
+def get_token_generator():
+    '''
+    Returns the configured token generator.
+    '''
+    global _generator
+    path = getattr(
+        settings, 'PAYMENT_TOKEN_GENERATOR', 'payments.tokens.UUID4Generator')
+    if _generator is None or _generator[0] != path:
+        _generator = (path, import_string(path)())
+    return _generator[1]
@@ -5,39 +5,41 @@ data (asynchronous transaction updates).
 from __future__ import unicode_literals
 
 from django.conf.urls import url
+from django.db import transaction
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
-try:
-    from django.db.transaction import atomic
-except ImportError:
-    def atomic(func):
-        return func
 
 from . import get_payment_model
+from .callbacks import (
+    get_provider, is_queue_enabled, queue_callback, run_callback)
 from .core import provider_factory
+from .dedup import get_callback_deduplicator
+from .tokens import UUID_PATTERN, get_token_generator
 
 
 @csrf_exempt
-@atomic
+@transaction.non_atomic_requests
 def process_data(request, token, provider=None):
     '''
-    Calls process_data of an appropriate provider.
+    Calls process_data of an appropriate provider, see
+    payments.callbacks.run_callback.
+
+    With PAYMENT_QUEUE_CALLBACKS enabled the callbacks of providers
+    supporting it are stored and acknowledged right away instead.
 
     Raises Http404 if variant does not exist.
     '''
-    Payment = get_payment_model()
-    payment = get_object_or_404(Payment, token=token)
-    if not provider:
-        try:
-            provider = provider_factory(payment.variant)
-        except ValueError:
-            raise Http404('No such payment')
-    return provider.process_data(payment, request)
+    if is_queue_enabled():
+        payment = get_object_or_404(get_payment_model(), token=token)
+        provider = provider or get_provider(payment)
+        if provider.supports_queued_callbacks:
+            return queue_callback(request, payment, provider)
+    return run_callback(request, token, provider)
 
 
 @csrf_exempt
-@atomic
+@transaction.non_atomic_requests
 def static_callback(request, variant):
 
     try:
@@ -45,15 +47,31 @@ def static_callback(request, variant):
     except ValueError:
         raise Http404('No such provider')
 
+    if ((is_queue_enabled() and provider.supports_queued_callbacks) or
+            get_callback_deduplicator() is not None):
+        # keep the raw body for the stored callback or the fingerprint, it
+        # cannot be read once the provider parsed a multipart form below
+        request.body
     token = provider.get_token_from_request(request=request, payment=None)
     if not token:
         raise Http404('Invalid response')
     return process_data(request, token, provider)
 
 
-urlpatterns = [
-    url(r'^process/(?P<token>[0-9a-z]{8}-[0-9a-z]{4}-'
-        '[0-9a-z]{4}-[0-9a-z]{4}-[0-9a-z]{12})/$', process_data,
-        name='process_payment'),
+def get_process_urls(generator):
+    '''
+    Returns the URL patterns of process_data for tokens of the generator and
+    for UUID tokens.
+    '''
+    patterns = [UUID_PATTERN]
+    if generator.pattern != UUID_PATTERN:
+        patterns.insert(0, generator.pattern)
+    return [
+        url(r'^process/(?P<token>%s)/$' % (pattern,), process_data,
+            name='process_payment')
+        for pattern in patterns]
+
+
+urlpatterns = get_process_urls(get_token_generator()) + [
     url(r'^process/(?P<variant>[a-z-]+)/$', static_callback,
         name='static_process_payment')]
@@ -1,5 +1,8 @@
+from collections import OrderedDict
 from datetime import date
 import re
+import threading
+import time
 
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
@@ -66,3 +69,56 @@ def add_prefixed_address(prefix):
         setattr(dclass, country_area, models.CharField(max_length=256, blank=True))
         return dclass
     return class_to_customize
+
+
+class LocalStore(object):
+    '''
+    Keeps up to *max_size* values for *ttl* seconds in the memory of the
+    process, evicting the least recently used ones first. None disables
+    either limit.
+    '''
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires_at, value = self._values.pop(key)
+            except KeyError:
+                return None
+            if expires_at is not None and expires_at <= time.time():
+                return None
+            self._values[key] = (expires_at, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (
+                time.time() + self.ttl if self.ttl is not None else None,
+                value)
+            while (self.max_size is not None and
+                   len(self._values) > self.max_size):
+                self._values.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def items(self):
+        '''
+        Returns the (key, value) pairs that did not expire
+        '''
+        now = time.time()
+        with self._lock:
+            return [
+                (key, value)
+                for key, (expires_at, value) in self._values.items()
+                if expires_at is None or expires_at > now]
@@ -15,6 +15,8 @@ PACKAGES = [
     'payments.dummy',
     'payments.dotpay',
     'payments.giropay',
+    'payments.management',
+    'payments.management.commands',
     'payments.paypal',
     'payments.sagepay',
     'payments.sofort',
@@ -31,6 +33,9 @@ REQUIREMENTS = [
     'suds-jurko>=0.6',
     'xmltodict>=0.9.2']
 
+EXTRAS_REQUIRE = {
+    'numpy': ['numpy']}
+
 TEST_REQUIREMENTS = [
     'pytest',
     'pytest-django'
@@ -81,6 +86,7 @@ setup(
         'Topic :: Software Development :: Libraries :: Application Frameworks',
         'Topic :: Software Development :: Libraries :: Python Modules'],
     install_requires=REQUIREMENTS,
+    extras_require=EXTRAS_REQUIRE,
     cmdclass={
         'test': PyTest},
     tests_require=TEST_REQUIREMENTS,